@@ -0,0 +1,106 @@
+"""Precomputed ALU results for the Python CPU core (binary mode only, as on the 2A03).
+
+Each entry packs the result byte in bits 0-7 and the flags the operation
+sets in bits 8-15, laid out like the status register, so one lookup
+replaces the carry/overflow/zero/negative logic:
+
+    entry = ADC[carry << 16 | a << 8 | operand]
+    a = entry & 0xff
+    status = status & ~ADC_FLAGS | entry >> 8
+
+CMP only yields flags and is indexed by register << 8 | operand. The shift
+and rotate tables are indexed by carry << 8 | value.
+
+The tables are built on first use rather than at import, and kept in the
+cobra-nes cache so later processes only read them back with marshal.
+"""
+import sys
+from array import array
+
+TABLES = ("ADC", "SBC", "CMP", "ASL", "LSR", "ROL", "ROR")
+TABLES_CACHE_VERSION = 1
+
+CARRY = 0x01
+ZERO = 0x02
+OVERFLOW = 0x40
+NEGATIVE = 0x80
+
+ADC_FLAGS = CARRY | ZERO | OVERFLOW | NEGATIVE
+CMP_FLAGS = SHIFT_FLAGS = CARRY | ZERO | NEGATIVE
+
+ZN = bytes([ZERO] + [value & NEGATIVE for value in range(1, 256)])
+
+
+def adc_entry(a, operand, carry):
+    total = a + operand + carry
+    result = total & 0xff
+    flags = ZN[result]
+    if total > 0xff:
+        flags |= CARRY
+    if (operand ^ result) & (result ^ a) & 0x80:
+        flags |= OVERFLOW
+    return result | flags << 8
+
+
+def cmp_flags(register, operand):
+    return ZN[(register - operand) & 0xff] | (CARRY if register >= operand else 0)
+
+
+def shift_entry(result, carry_out):
+    return result | (ZN[result] | carry_out) << 8
+
+
+def build_adc():
+    return array("H", [adc_entry(a, operand, carry)
+                       for carry in (0, 1) for a in range(256) for operand in range(256)])
+
+
+def build_sbc(adc):
+    # SBC is ADC of the inverted operand, and operand ^ 0xff == 255 - operand,
+    # so every 256-entry row of the SBC table is the ADC row reversed.
+    sbc = array("H")
+    for row in range(0, len(adc), 256):
+        sbc.extend(adc[row + 255:row - 1 if row else None:-1])
+    return sbc
+
+
+def build_tables():
+    adc = build_adc()
+    return {
+        "ADC": adc,
+        "SBC": build_sbc(adc),
+        "CMP": bytes(cmp_flags(register, operand) for register in range(256) for operand in range(256)),
+        "ASL": array("H", [shift_entry((value << 1) & 0xff, value >> 7)
+                           for carry in (0, 1) for value in range(256)]),
+        "LSR": array("H", [shift_entry(value >> 1, value & 1)
+                           for carry in (0, 1) for value in range(256)]),
+        "ROL": array("H", [shift_entry((value << 1 | carry) & 0xff, value >> 7)
+                           for carry in (0, 1) for value in range(256)]),
+        "ROR": array("H", [shift_entry(value >> 1 | carry << 7, value & 1)
+                           for carry in (0, 1) for value in range(256)]),
+    }
+
+
+def load_tables(use_cache=True):
+    import cache
+    # Raw table bytes are native-endian, hence the byte order in the key.
+    path = cache.cache_path("alu", f"tables-{sys.byteorder}-v{TABLES_CACHE_VERSION}", ".marshal")
+    raw = cache.load_marshal(path) if use_cache else None
+    if isinstance(raw, dict) and set(raw) == set(TABLES):
+        return {name: data if name == "CMP" else array("H", data) for name, data in raw.items()}
+    tables = build_tables()
+    if use_cache:
+        try:
+            cache.store_marshal(path, {name: bytes(table) for name, table in tables.items()})
+        except OSError:
+            pass  # a read-only cache only costs the rebuild
+    return tables
+
+
+def __getattr__(name):
+    # First access to any table loads all of them into the module globals,
+    # after which lookups no longer reach this function.
+    if name in TABLES:
+        globals().update(load_tables())
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,369 @@
+"""Micro benchmarks for the emulator core.
+
+    python bench.py            # run everything
+    python bench.py flags      # run one benchmark
+"""
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cpu as cpu_module
+import debugger
+import rewind
+from bus import Bus
+from cartridge import Rom, Mirroring
+from opcodes import CPU_OPS_CODES, AddressingMode
+
+REPEAT = 5
+
+
+def load_snake():
+    with open("snake.nes", "rb") as f:
+        return Rom.new(f.read())
+
+
+def program_rom(program):
+    prg = bytearray(0x8000)
+    prg[0x0600:0x0600 + len(program)] = bytes(program)
+    prg[0x7ffc] = 0x00
+    prg[0x7ffd] = 0x86
+    return Rom(bytes(prg), bytes(0x2000), 0, Mirroring.HORIZONTAL)
+
+
+def alu_program(length=2000, seed=1):
+    # Straight-line loads, arithmetic, compares and shifts on RAM.
+    rng = random.Random(seed)
+    ops = [op for op in CPU_OPS_CODES
+           if op.mode not in (AddressingMode.Indirect_X, AddressingMode.Indirect_Y)
+           and op.mnemonic in ("LDA", "LDX", "LDY", "ADC", "SBC", "AND", "ORA", "EOR",
+                               "CMP", "CPX", "CPY", "ASL", "LSR", "ROL", "ROR", "INX",
+                               "INY", "DEX", "DEY", "TAX", "TXA", "STA", "INC", "DEC")]
+    program = []
+    for _ in range(length):
+        op = rng.choice(ops)
+        program.append(op.code)
+        if op.len == 2:
+            program.append(rng.randrange(0x100))
+        elif op.len == 3:
+            program.extend([rng.randrange(0x100), 0x00])
+    program.append(0x00)
+    return program_rom(program)
+
+
+def run_instructions(cpu_class, rom, setup=None):
+    bus = Bus(rom)
+    cpu = cpu_class(bus)
+    cpu.reset()
+    if setup is not None:
+        setup(cpu)
+    count = 0
+
+    def callback(_):
+        nonlocal count
+        count += 1
+
+    start = time.perf_counter()
+    cpu.run_with_callback(callback)
+    return count, time.perf_counter() - start
+
+
+def best_rate(cpu_class, rom, setup=None):
+    best = None
+    for _ in range(REPEAT):
+        count, elapsed = run_instructions(cpu_class, rom, setup)
+        if best is None or elapsed < best[1]:
+            best = (count, elapsed)
+    return best
+
+
+def count_calls(cpu_class, names, rom):
+    # Run once with the named methods/properties wrapped in counters.
+    counts = dict.fromkeys(names, 0)
+
+    def wrap(name, attr):
+        if isinstance(attr, property):
+            def fget(self):
+                counts[name] += 1
+                return attr.fget(self)
+            return property(fget, attr.fset)
+
+        def method(self, *args):
+            counts[name] += 1
+            return attr(self, *args)
+        return method
+
+    namespace = {name: wrap(name, getattr(cpu_class, name)) for name in names}
+    counted = type(f"Counted{cpu_class.__name__}", (cpu_class,), namespace)
+    instructions, _ = run_instructions(counted, rom)
+    return instructions, counts
+
+
+def bench_flags():
+    """Eager CPU flags versus LazyFlagsCPU."""
+    eager_updates = ("update_zero_and_negative_flags", "add_to_register_a", "compare",
+                     "set_carry_flag", "clear_carry_flag")
+    for label, rom in (("snake.nes", load_snake()), ("alu", alu_program())):
+        results = {}
+        for cpu_class in (cpu_module.PyCPU, cpu_module.LazyFlagsCPU):
+            count, elapsed = best_rate(cpu_class, rom)
+            results[cpu_class] = elapsed / count
+            print(f"  {label:10} {cpu_class.__name__:13} {count:6} instr "
+                  f"{elapsed / count * 1e6:6.2f} us/instr")
+        speed_up = results[cpu_module.PyCPU] / results[cpu_module.LazyFlagsCPU]
+        print(f"  {label:10} speed-up {speed_up:.2f}x")
+
+        count, calls = count_calls(cpu_module.PyCPU, eager_updates, rom)
+        print(f"  {label:10} eager flag updates: {sum(calls.values()) / count:.2f} per instr")
+        count, calls = count_calls(cpu_module.LazyFlagsCPU, ("status",), rom)
+        print(f"  {label:10} lazy materializations: {calls['status'] / count:.2f} per instr")
+
+
+CYCLES_PER_FRAME = cpu_module.CYCLES_PER_FRAME
+
+
+def vblank_wait_rom():
+    # Main loop that waits for the host to set $10 once per frame.
+    return program_rom([
+        0xa9, 0x00,        # start: LDA #$00
+        0x85, 0x10,        #        STA $10
+        0xa5, 0x10,        # wait:  LDA $10
+        0xf0, 0xfc,        #        BEQ wait
+        0xe6, 0x20,        #        INC $20
+        0x4c, 0x00, 0x86,  #        JMP start
+    ])
+
+
+def run_frames(cpu_class, rom, frames, on_frame=None):
+    # Headless frame loop: signal "vblank" in $10 and refresh the random byte
+    # at $fe every frame, the way main.main does between frames.
+    cpu = cpu_class(Bus(rom))
+    cpu.reset()
+    rng = random.Random(0)
+    frame_end = cpu.cycles
+    done = 0
+
+    start = time.perf_counter()
+    while done < frames:
+        frame_end += CYCLES_PER_FRAME
+        if not cpu.run_until(frame_end):
+            break
+        done += 1
+        cpu.mem_write(0x10, 1)
+        cpu.mem_write(0xfe, rng.randint(1, 15))
+        if on_frame is not None:
+            on_frame(cpu)
+    return done, cpu.cycles, time.perf_counter() - start
+
+
+def bench_idle():
+    """Idle-loop skipping in headless frame loops."""
+    fast = type("IdleLoopLazyFlagsCPU", (cpu_module.IdleLoopMixin, cpu_module.LazyFlagsCPU), {})
+    for label, rom, frames in (("vblank", vblank_wait_rom(), 10), ("snake.nes", load_snake(), 60)):
+        for cpu_class in (cpu_module.PyCPU, cpu_module.IdleLoopCPU, fast):
+            done, cycles, elapsed = run_frames(cpu_class, rom, frames)
+            print(f"  {label:10} {cpu_class.__name__:21} {done:3} frames {cycles:8} cycles "
+                  f"{elapsed / max(done, 1) * 1e3:8.3f} ms/frame")
+
+
+def bench_debug():
+    """Cost of debugger breakpoints and watchpoints."""
+    def attached(cpu):
+        debugger.Debugger(cpu)
+
+    def breakpoint(cpu):
+        debugger.Debugger(cpu).break_at(0xfff0)
+
+    def watch_other_page(cpu):
+        debugger.Debugger(cpu).watch(0x0700, 0x07ff, on="w")
+
+    def watch_screen(cpu):
+        debugger.Debugger(cpu).watch(0x0200, 0x05ff, on="w", condition="value > 0x10")
+
+    rom = load_snake()
+    cpu_classes = [cpu_module.PyCPU] + ([cpu_module.NativeCPU] if cpu_module.NATIVE_AVAILABLE else [])
+    for cpu_class in cpu_classes:
+        base = None
+        for label, setup in (("none", None), ("attached", attached), ("breakpoint", breakpoint),
+                             ("watch $07xx", watch_other_page), ("watch screen", watch_screen)):
+            count, elapsed = best_rate(cpu_class, rom, setup)
+            base = base or elapsed
+            print(f"  {cpu_class.__name__:9} {label:12} {elapsed / count * 1e6:6.2f} us/instr "
+                  f"{elapsed / base:5.2f}x")
+
+
+def bench_rewind():
+    """Rewind buffer capture cost, size of 60 s of snake.nes and step-back time."""
+    fast = type("IdleLoopLazyFlagsCPU", (cpu_module.IdleLoopMixin, cpu_module.LazyFlagsCPU), {})
+    buffer = None
+    capture_time = 0.0
+
+    def capture(cpu):
+        nonlocal buffer, capture_time
+        if buffer is None:
+            buffer = rewind.RewindBuffer(cpu, seconds=60)
+        start = time.perf_counter()
+        buffer.capture()
+        capture_time += time.perf_counter() - start
+
+    done, _, _ = run_frames(fast, load_snake(), 60 * 60 + 1, capture)
+    print(f"  {len(buffer)} frames captured, {capture_time / len(buffer) * 1e6:.1f} us/frame capture")
+    print(f"  buffer size {buffer.nbytes() / 1e6:.2f} MB "
+          f"({sum(len(f.delta) for f in buffer.frames) / len(buffer):.1f} delta bytes/frame)")
+
+    steps = 0
+    start = time.perf_counter()
+    while steps < 600 and buffer.step_back():
+        steps += 1
+    elapsed = time.perf_counter() - start
+    print(f"  step back {elapsed / steps * 1e6:.1f} us/frame over {steps} frames")
+
+    frames = len(buffer) // 2
+    start = time.perf_counter()
+    buffer.step_back(frames)
+    print(f"  step back {frames} frames at once in {(time.perf_counter() - start) * 1e6:.1f} us")
+
+
+def instance_bytes(make, count=1000):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [make() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del instances
+    return size / count
+
+
+def bench_inline():
+    """Register-caching InlineCPU loop, and memory per CPU/Bus instance."""
+    for label, rom in (("snake.nes", load_snake()), ("alu", alu_program())):
+        results = {}
+        for cpu_class in (cpu_module.PyCPU, cpu_module.InlineCPU):
+            count, elapsed = best_rate(cpu_class, rom)
+            results[cpu_class] = elapsed / count
+            print(f"  {label:10} {cpu_class.__name__:10} {count:6} instr "
+                  f"{elapsed / count * 1e6:6.2f} us/instr")
+        print(f"  {label:10} speed-up {results[cpu_module.PyCPU] / results[cpu_module.InlineCPU]:.2f}x")
+
+    rom = load_snake()
+    bus = Bus(rom)
+    print(f"  Bus            {instance_bytes(lambda: Bus(rom)):8.0f} bytes/instance")
+    for cpu_class in (cpu_module.PyCPU, cpu_module.LazyFlagsCPU, cpu_module.IdleLoopCPU,
+                      cpu_module.InlineCPU):
+        print(f"  {cpu_class.__name__:14} {instance_bytes(lambda: cpu_class(bus)):8.0f} bytes/instance")
+
+
+STARTUP_CODE = "import cpu, alu; alu.ADC"
+
+
+def import_times(env):
+    # Wall time of the whole process, and {module: cumulative microseconds}
+    # for its top-level imports as reported by -X importtime.
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_CODE],
+                            env=env, capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return elapsed, times
+
+
+def bench_startup():
+    """Process start to usable core (import cpu, first ALU table access)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, COBRA_NES_CACHE=tmp)
+        for label in ("empty cache", "warm cache", "warm cache"):
+            elapsed, times = import_times(env)
+            print(f"  {label:12} {elapsed * 1e3:6.1f} ms process, "
+                  f"import cpu {times['cpu'] / 1e3:5.1f} ms, all imports {sum(times.values()) / 1e3:5.1f} ms")
+
+
+def bench_env():
+    """VecEnv / SharedVecEnv steps per second on snake.nes with a random policy."""
+    import env
+    rom = load_snake()
+    cpu_classes = [cpu_module.InlineCPU] + ([cpu_module.NativeCPU] if cpu_module.NATIVE_AVAILABLE else [])
+    for cpu_class in cpu_classes:
+        vec = env.VecEnv(rom, num_envs=64, cpu_class=cpu_class)
+        print(f"  VecEnv       64 envs {cpu_class.__name__:10} {env.measure(vec, 200):8.0f} steps/s")
+        vec.close()
+    for workers in (2, os.cpu_count() or 1):
+        vec = env.SharedVecEnv(rom, num_envs=64 * workers, num_workers=workers)
+        try:
+            print(f"  SharedVecEnv {64 * workers} envs {workers} workers {env.measure(vec, 200):8.0f} steps/s")
+        finally:
+            vec.close()
+
+
+def bench_runhash():
+    """Signing snake.nes movies with runhash, and the cost of one state hash."""
+    import runhash
+    rom = load_snake()
+    movies = [runhash.random_movie(seed, 600) for seed in range(1000)]
+    start = time.perf_counter()
+    checkpoints = sum(len(runhash.signatures(runhash.new_cpu(rom), movie)) for movie in movies)
+    elapsed = time.perf_counter() - start
+    print(f"  {len(movies)} movies, {checkpoints} checkpoints  {elapsed:.2f} s  ({cpu_module.CPU.__name__})")
+    cpu = runhash.new_cpu(rom)
+    start = time.perf_counter()
+    for _ in range(10000):
+        runhash.state_hash(cpu)
+    print(f"  state_hash  {(time.perf_counter() - start) / 10000 * 1e6:.2f} us")
+
+
+def bench_profiles():
+    """Snake frames per second for each profile; rendering profiles also build the RGB frame."""
+    import profiles
+    from screen import snake_frame
+    rom = load_snake()
+    for name, profile in profiles.PROFILES.items():
+        cpu = profiles.create(rom, profile)
+        cpu.reset()
+        rng = random.Random(0)
+        frames = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < 2:
+            cpu.mem_write(0xff, rng.choice(b"wasd"))
+            cpu.mem_write(0xfe, rng.randint(1, 15))
+            if not cpu.run_until(cpu.cycles + cpu_module.CYCLES_PER_FRAME):
+                cpu.reset()
+            if profile.render:
+                snake_frame(cpu.bus)
+            frames += 1
+        rate = frames / (time.perf_counter() - start)
+        # The reference class is named CPU, which cpu.CPU rebinds to NativeCPU when built.
+        engine = "PyCPU" if type(cpu) is cpu_module.PyCPU else type(cpu).__name__
+        features = ", ".join(sorted(profile.features)) or "none"
+        print(f"  {name:9} {engine:10} {rate:10.0f} frames/s  fast paths: {features}")
+
+
+BENCHMARKS = {
+    "flags": bench_flags,
+    "idle": bench_idle,
+    "debug": bench_debug,
+    "rewind": bench_rewind,
+    "inline": bench_inline,
+    "startup": bench_startup,
+    "env": bench_env,
+    "runhash": bench_runhash,
+    "profiles": bench_profiles,
+}
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        bench = BENCHMARKS[name]
+        print(f"{name}: {bench.__doc__}")
+        bench()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
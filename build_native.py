@@ -0,0 +1,75 @@
+"""Build the optional native CPU core (_cpu_native) with cffi.
+
+    python build_native.py
+
+The opcode tables are generated from opcodes.CPU_OPS_CODES, so the native
+core and the Python core in cpu.py always agree on lengths and addressing
+modes. When the extension is importable, cpu.CPU picks it up automatically.
+"""
+import os
+from cffi import FFI
+from opcodes import CPU_OPS_CODES, CONTROL_FLOW_CODES, AddressingMode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CDEF = """
+typedef struct {
+    int a, x, y, sp, status, pc;
+    long long cycles, deadline;
+    uint8_t *ram;
+    const uint8_t *prg;
+    int prg_len;
+    const uint8_t *watch;
+    uint8_t *coverage;
+    void *handle;
+    int error;
+    int opcode;
+} cpu_state;
+
+int cpu_run(cpu_state *s, long max_steps);
+
+extern "Python" int py_mem_read(void *handle, int addr);
+extern "Python" void py_mem_write(void *handle, int addr, int data);
+"""
+
+
+def opcode_tables():
+    known = [0] * 256
+    length = [0] * 256
+    cycles = [0] * 256
+    mode = [0] * 256
+    flow = [0] * 256
+    for op in CPU_OPS_CODES:
+        known[op.code] = 1
+        length[op.code] = op.len
+        cycles[op.code] = op.cycles
+        mode[op.code] = op.mode.value
+        flow[op.code] = int(op.code in CONTROL_FLOW_CODES)
+
+    def table(name, values):
+        return f"static const int {name}[256] = {{{', '.join(map(str, values))}}};\n"
+
+    defines = "".join(f"#define MODE_{m.name.upper()} {m.value}\n" for m in AddressingMode)
+    return (defines + table("OP_KNOWN", known) + table("OP_LEN", length)
+            + table("OP_CYCLES", cycles) + table("OP_MODE", mode) + table("OP_FLOW", flow))
+
+
+def make_builder():
+    with open(os.path.join(HERE, "cpu_native.c")) as f:
+        core = f.read()
+
+    ffibuilder = FFI()
+    ffibuilder.cdef(CDEF)
+    ffibuilder.set_source(
+        "_cpu_native",
+        "#include <stdint.h>\n" + CDEF.split("int cpu_run")[0]
+        + "static int py_mem_read(void *handle, int addr);\n"
+        + "static void py_mem_write(void *handle, int addr, int data);\n"
+        + opcode_tables() + core,
+        extra_compile_args=["-O2"],
+    )
+    return ffibuilder
+
+
+if __name__ == "__main__":
+    make_builder().compile(tmpdir=HERE, verbose=True)
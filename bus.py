@@ -1,12 +1,39 @@
+import events
+
 RAM = 0x0000
+RAM_SIZE = 0x0800
+OAM_SIZE = 0x0100
 RAM_MIRRORS_END = 0x1FFF
 PPU_REGISTERS = 0x2000
 PPU_REGISTERS_MIRRORS_END = 0x3FFF
+OAM_DMA = 0x4014
 
 class Bus:
-    def __init__(self, rom):
-        self.cpu_vram = [0] * 2048
+    # No __dict__: Bus(rom, stats=True) builds a CountingBus, and tools
+    # that hook one instance (debugger) go through debugger.shadow.
+    __slots__ = ("cpu_vram", "rom", "oam", "events", "stats", "shared")
+
+    def __new__(cls, rom, stats=False, **kwargs):
+        return super().__new__(CountingBus if stats and cls is Bus else cls)
+
+    def __init__(self, rom, stats=False, ram=None, shared=False):
+        # ram: any writable 2 KB buffer (bytearray, memoryview of a NumPy
+        # row) to run on, e.g. one slot of a batch of emulators.
+        # shared: put RAM and OAM in a sharedram.SharedRam block instead,
+        # so other processes can read them (bus.shared.name).
+        self.shared = None
+        if shared:
+            import sharedram
+            self.shared = sharedram.SharedRam.create()
+            ram = self.shared.ram
+        self.cpu_vram = bytearray(RAM_SIZE) if ram is None else ram
         self.rom = rom
+        self.oam = bytearray(OAM_SIZE) if self.shared is None else self.shared.oam
+        self.events = events.EventQueue()
+        self.stats = None
+        if stats:
+            import memstats
+            self.stats = memstats.AccessStats()
 
     def read_prg_rom(self, addr):
         addr -= 0x8000
@@ -15,6 +42,10 @@ class Bus:
             addr %= 0x4000
         return self.rom.prg_rom[addr]
 
+    def oam_dma(self, page):
+        base = page << 8
+        self.oam[:] = bytes(self.mem_read(base + i) for i in range(256))
+
     def mem_read(self, addr):
         match addr:
             case addr if RAM <= addr <= RAM_MIRRORS_END:
@@ -47,5 +78,22 @@ class Bus:
             case addr if 0x8000 <= addr <= 0xFFFF:
                 raise Exception("Attempt to write to Cartridge ROM space")
 
+            case addr if addr == OAM_DMA:
+                # The copy and the CPU stall happen once this instruction ends.
+                self.events.trigger(events.OAM_DMA, data)
+
             case _:
                 print(f"Ignoring mem write-access at {addr}")
+
+
+class CountingBus(Bus):
+    # Counts every access in bus.stats (memstats.AccessStats).
+    __slots__ = ()
+
+    def mem_read(self, addr):
+        self.stats.read_counts[addr & 0xffff] += 1
+        return Bus.mem_read(self, addr)
+
+    def mem_write(self, addr, data):
+        self.stats.write_counts[addr & 0xffff] += 1
+        Bus.mem_write(self, addr, data)
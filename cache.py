@@ -0,0 +1,60 @@
+import os
+
+# hashlib, pickle and tempfile are imported where they are used: alu reads
+# its tables through this module while the CPU core is starting up.
+
+CACHE_DIR = os.environ.get(
+    "COBRA_NES_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "cobra-nes"))
+
+
+def content_hash(data):
+    import hashlib
+    return hashlib.sha1(bytes(data)).hexdigest()
+
+
+def cache_path(kind, key, suffix=".pickle"):
+    return os.path.join(CACHE_DIR, kind, f"{key}{suffix}")
+
+
+def load(path):
+    import pickle
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+        return None
+
+
+def store(path, obj):
+    import pickle
+    write_atomic(path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_marshal(path):
+    # For plain bytes/ints/dicts: marshal is built in, so nothing is imported.
+    import marshal
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def store_marshal(path, obj):
+    import marshal
+    write_atomic(path, marshal.dumps(obj))
+
+
+def write_atomic(path, data):
+    # Write to a temporary file first so concurrent workers never see a
+    # half-written cache entry.
+    import tempfile
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
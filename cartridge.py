@@ -1,3 +1,5 @@
+from collections import namedtuple
+
 NES_TAG = b'NES\x1A'
 PRG_ROM_PAGE_SIZE = 16384
 CHR_ROM_PAGE_SIZE = 8192
@@ -8,45 +10,108 @@ class Mirroring:
     FOUR_SCREEN = 3
 
 
+RomHeader = namedtuple("RomHeader", [
+    "mapper", "submapper", "screen_mirroring", "nes2", "has_trainer", "battery",
+    "prg_rom_start", "prg_rom_size", "chr_rom_size",
+    "prg_ram_size", "prg_nvram_size", "chr_ram_size", "chr_nvram_size", "timing",
+])
+
+# Mappers bus.Bus can run.
+SUPPORTED_MAPPERS = frozenset({0})
+
+
+def nes2_rom_size(lsb, msb, page_size):
+    if msb == 0xF:
+        # Exponent-multiplier notation: 2^E * (MM * 2 + 1) bytes.
+        return (1 << (lsb >> 2)) * ((lsb & 0b11) * 2 + 1)
+    return ((msb << 8) | lsb) * page_size
+
+
+def nes2_ram_size(shift):
+    return 64 << shift if shift else 0
+
+
+def parse_header(raw):
+    if raw[0:4] != NES_TAG:
+        raise ValueError("File is not in iNES file format")
+
+    mapper = (raw[7] & 0b1111_0000) | (raw[6] >> 4)
+
+    ines_ver = (raw[7] >> 2) & 0b11
+    if ines_ver not in (0, 2):
+        raise ValueError(f"Unknown iNES header version {ines_ver}")
+    nes2 = ines_ver == 2
+
+    four_screen = raw[6] & 0b1000 != 0
+    vertical_mirroring = raw[6] & 0b1 != 0
+    if four_screen:
+        screen_mirroring = Mirroring.FOUR_SCREEN
+    elif vertical_mirroring:
+        screen_mirroring = Mirroring.VERTICAL
+    else:
+        screen_mirroring = Mirroring.HORIZONTAL
+
+    skip_trainer = raw[6] & 0b100 != 0
+    battery = raw[6] & 0b10 != 0
+
+    if nes2:
+        mapper |= (raw[8] & 0b1111) << 8
+        submapper = raw[8] >> 4
+        prg_rom_size = nes2_rom_size(raw[4], raw[9] & 0b1111, PRG_ROM_PAGE_SIZE)
+        chr_rom_size = nes2_rom_size(raw[5], raw[9] >> 4, CHR_ROM_PAGE_SIZE)
+        prg_ram_size = nes2_ram_size(raw[10] & 0b1111)
+        prg_nvram_size = nes2_ram_size(raw[10] >> 4)
+        chr_ram_size = nes2_ram_size(raw[11] & 0b1111)
+        chr_nvram_size = nes2_ram_size(raw[11] >> 4)
+        timing = raw[12] & 0b11
+    else:
+        submapper = 0
+        prg_rom_size = raw[4] * PRG_ROM_PAGE_SIZE
+        chr_rom_size = raw[5] * CHR_ROM_PAGE_SIZE
+        prg_ram_size = max(raw[8], 1) * 8192
+        prg_nvram_size = chr_nvram_size = 0
+        chr_ram_size = 8192 if chr_rom_size == 0 else 0
+        timing = 0
+
+    return RomHeader(
+        mapper=mapper,
+        submapper=submapper,
+        screen_mirroring=screen_mirroring,
+        nes2=nes2,
+        has_trainer=skip_trainer,
+        battery=battery,
+        prg_rom_start=16 + (512 if skip_trainer else 0),
+        prg_rom_size=prg_rom_size,
+        chr_rom_size=chr_rom_size,
+        prg_ram_size=prg_ram_size,
+        prg_nvram_size=prg_nvram_size,
+        chr_ram_size=chr_ram_size,
+        chr_nvram_size=chr_nvram_size,
+        timing=timing,
+        )
+
+
 class Rom:
-    def __init__(self, prg_rom, chr_rom, mapper, screen_mirroring):
+    def __init__(self, prg_rom, chr_rom, mapper, screen_mirroring, header=None):
         self.prg_rom = prg_rom
         self.chr_rom = chr_rom
         self.mapper = mapper
         self.screen_mirroring = screen_mirroring
+        self.header = header
 
     @staticmethod
     def new(raw):
-        if raw[0:4] != NES_TAG:
-            raise ValueError("File is not in iNES file format")
-
-        mapper = (raw[7] & 0b1111_0000) | (raw[6] >> 4)
-    
-        ines_ver = (raw[7] >> 2) & 0b11
-        if ines_ver != 0:
-            raise ValueError("NES2.0 format is not supported")
-
-        four_screen = raw[6] & 0b1000 != 0
-        vertical_mirroring = raw[6] & 0b1 != 0
-        if four_screen:
-            screen_mirroring = Mirroring.FOUR_SCREEN
-        elif vertical_mirroring:
-            screen_mirroring = Mirroring.VERTICAL
-        else:
-            screen_mirroring = Mirroring.HORIZONTAL
+        return Rom.from_header(parse_header(raw), raw)
 
-        prg_rom_size = raw[4] * PRG_ROM_PAGE_SIZE
-        chr_rom_size = raw[5] * CHR_ROM_PAGE_SIZE
-
-        skip_trainer = raw[6] & 0b100 != 0
-        prg_rom_start = 16 + (512 if skip_trainer else 0)
-        chr_rom_start = prg_rom_start + prg_rom_size
+    @staticmethod
+    def from_header(header, raw):
+        prg_rom_start = header.prg_rom_start
+        chr_rom_start = prg_rom_start + header.prg_rom_size
 
         return Rom(
-            prg_rom = raw[prg_rom_start:prg_rom_start + prg_rom_size],
-            chr_rom = raw[chr_rom_start:chr_rom_start + chr_rom_size],
-            mapper=mapper,
-            screen_mirroring=screen_mirroring
+            prg_rom = raw[prg_rom_start:chr_rom_start],
+            chr_rom = raw[chr_rom_start:chr_rom_start + header.chr_rom_size],
+            mapper=header.mapper,
+            screen_mirroring=header.screen_mirroring,
+            header=header,
             )
-
-
@@ -1,7 +1,9 @@
 from enum import IntFlag, auto, Enum
-from typing import List, Tuple
 from bus import Bus
+import alu
+import events as events_module
 import opcodes
+from opcodes import AddressingMode
 
 class CpuFlags(IntFlag):
     CARRY = auto()
@@ -13,22 +15,37 @@ class CpuFlags(IntFlag):
     OVERFLOW = auto()
     NEGATIVE = auto()
 
+class StatusTable(dict):
+    # Status value -> CpuFlags, so table lookups can pick a CpuFlags without
+    # building one. Filled on first use: constructing all 256 at import is
+    # a noticeable part of startup.
+    def __missing__(self, value):
+        flags = self[value] = CpuFlags(value)
+        return flags
+
+
+STATUS = StatusTable()
+
 STACK = 0x0100
 STACK_RESET = 0xfd
+# NTSC: 341 * 262 / 3 CPU cycles per frame.
+CYCLES_PER_FRAME = 29781
+
+
+class StopRun(Exception):
+    pass
 
-class AddressingMode(Enum):
-        Immediate = auto()
-        ZeroPage = auto()
-        ZeroPage_X = auto()
-        ZeroPage_Y = auto()
-        Absolute = auto()
-        Absolute_X = auto()
-        Absolute_Y = auto()
-        Indirect_X = auto()
-        Indirect_Y = auto()
-        NoneAddressing = auto()
 
 class CPU:
+    # BRK ends run()/run_with_callback() instead of entering the IRQ vector,
+    # which is how test programs and snake.nes signal that they are done.
+    halt_on_brk = True
+
+    # Batch runs hold thousands of cores, so instances have no __dict__.
+    # Tools that hook one instance go through debugger.shadow.
+    __slots__ = ("register_a", "register_x", "register_y", "status", "program_counter",
+                 "stack_pointer", "cycles", "bus", "events")
+
     def __init__(self, bus):
         self.register_a = 0
         self.register_x = 0
@@ -36,7 +53,9 @@ class CPU:
         self.status = CpuFlags(0b100100)
         self.program_counter = 0
         self.stack_pointer = STACK_RESET
+        self.cycles = 0
         self.bus = bus
+        self.events = bus.events
 
     def mem_read(self, addr):
             return self.bus.mem_read(addr)
@@ -82,7 +101,7 @@ class CPU:
             base = self.mem_read(addr)
             ptr = (base + self.register_x) & 0xff
             lo = self.mem_read(ptr)
-            hi = self.mem_read(ptr + 1) & 0xff
+            hi = self.mem_read((ptr + 1) & 0xff)
             return (hi << 8) | lo
 
         if mode == AddressingMode.Indirect_Y:
@@ -159,7 +178,7 @@ class CPU:
 
     def update_negative_flags(self, result):
         if result >> 7 == 1:
-            self.status |= CpuFlags.ZERO
+            self.status |= CpuFlags.NEGATIVE
         else:
             self.status &= ~CpuFlags.NEGATIVE
 
@@ -188,6 +207,7 @@ class CPU:
         self.stack_pointer = STACK_RESET
         self.status = CpuFlags.ZERO | CpuFlags.BREAK2
         self.program_counter = self.mem_read_u16(0xFFFC)
+        self.cycles = 7
 
     def set_carry_flag(self):
         self.status |= CpuFlags.CARRY
@@ -196,27 +216,21 @@ class CPU:
         self.status &= ~CpuFlags.CARRY
 
     def add_to_register_a(self, data):
-        sum_ = self.register_a + (1 if self.status & CpuFlags.CARRY else 0)
-        carry = sum_ > 0xff
+        status = int(self.status)
+        entry = alu.ADC[(status & 1) << 16 | self.register_a << 8 | data]
+        self.register_a = entry & 0xff
+        self.status = STATUS[status & ~alu.ADC_FLAGS | entry >> 8]
 
-        if carry:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
-
-        result = sum_ & 0xff
-
-        if ((data ^ result) & (result ^ self.register_a) & 0x80) != 0:
-            self.status |= CpuFlags.OVERFLOW
-        else:
-            self.status &= ~CpuFlags.OVERFLOW
-
-        self.set_register_a(result)
+    def subtract_from_register_a(self, data):
+        status = int(self.status)
+        entry = alu.SBC[(status & 1) << 16 | self.register_a << 8 | data]
+        self.register_a = entry & 0xff
+        self.status = STATUS[status & ~alu.ADC_FLAGS | entry >> 8]
 
     def sbc(self, mode):
         addr = self.get_operand_address(mode)
         data = self.mem_read(addr)
-        self.add_to_register_a((data ^ 0xff) + 1) & 0xff
+        self.subtract_from_register_a(data)
 
     def adc(self, mode):
         addr = self.get_operand_address(mode)
@@ -242,111 +256,41 @@ class CPU:
         hi = self.stack_pop()
         return hi << 8 | lo
 
-    def asl_accumulator(self):
-        if self.register_a & 0x80:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
+    def shift(self, table, value):
+        status = int(self.status)
+        entry = table[(status & 1) << 8 | value]
+        self.status = STATUS[status & ~alu.SHIFT_FLAGS | entry >> 8]
+        return entry & 0xff
 
-        self.register_a = (self.register_a << 1) & 0xff
-        self.update_zero_and_negative_flags(self.register_a)
-
-    def asl(self, mode):
+    def shift_memory(self, table, mode):
         addr = self.get_operand_address(mode)
-        data = self.mem_read(addr)
-        if data & 0x80:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
-
-        data = (data << 1) & 0xff
+        data = self.shift(table, self.mem_read(addr))
         self.mem_write(addr, data)
-        self.update_zero_and_negative_flags(data)
         return data
 
-    def lsr_accumulator(self):
-        if self.register_a & 0x01:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
+    def asl_accumulator(self):
+        self.register_a = self.shift(alu.ASL, self.register_a)
 
-        self.register_a = self.register_a << 1
-        self.update_zero_and_negative_flags(self.register_a)
+    def asl(self, mode):
+        return self.shift_memory(alu.ASL, mode)
 
-    def lsr(self, mode):
-        addr = self.get_operand_address(mode)
-        data = self.mem_read(addr)
-        if data & 0x01:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
+    def lsr_accumulator(self):
+        self.register_a = self.shift(alu.LSR, self.register_a)
 
-        data = data >> 1
-        self.mem_write(addr, data)
-        self.update_zero_and_negative_flags(data)
-        return data
+    def lsr(self, mode):
+        return self.shift_memory(alu.LSR, mode)
 
     def rol(self, mode):
-        addr = self.get_operand_address(mode)
-        data = self.mem_read(addr)
-        old_carry = self.status & CpuFlags.CARRY
-
-        if data & 0x80:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
-
-        data = (data << 1) & 0xff
-        if old_carry:
-            data |= 0x01
-
-        self.mem_write(addr, data)
-        self.update_negative_flags(data)
-        return data
+        return self.shift_memory(alu.ROL, mode)
 
     def rol_accumulator(self):
-        old_carry = self.status & CpuFlags.CARRY
+        self.register_a = self.shift(alu.ROL, self.register_a)
 
-        if self.register_a & 0x80:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
-
-        self.register_a = (self.register_a << 1) & 0xff
-        if old_carry:
-            self.register_a |= 0x01
-        self.update_zero_and_negative_flags(self.register_a)
-    
     def ror(self, mode):
-        addr = self.get_operand_address(mode)
-        data = self.mem_read(addr)
-        old_carry = self.status & CpuFlags.CARRY
-
-        if data & 1:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
-
-        data = (data >> 1) & 0xff
-        if old_carry:
-            data |= 0x80
-        self.mem_write(addr, data)
-        self.update_negative_flags(data)
-        return data
+        return self.shift_memory(alu.ROR, mode)
 
     def ror_accumulator(self):
-        data = self.register_a
-        old_carry = self.status & CpuFlags.CARRY
-
-        if data & 1:
-            self.status |= CpuFlags.CARRY
-        else:
-            self.status &= ~CpuFlags.CARRY
-
-        data = (data >> 1) & 0xff
-        if old_carry:
-            data |= 0x80
-        self.set_register_a(data)
+        self.register_a = self.shift(alu.ROR, self.register_a)
 
     def inc(self,mode):
         addr = self.get_operand_address(mode)
@@ -410,30 +354,74 @@ class CPU:
     def compare(self, mode, compare_with):
        addr = self.get_operand_address(mode)
        data = self.mem_read(addr)
-
-       if data <= compare_with:
-           self.status |= CpuFlags.CARRY
-       else:
-           self.status &= ~CpuFlags.CARRY
-
-       self.update_zero_and_negative_flags(compare_with - data)
+       self.status = STATUS[int(self.status) & ~alu.CMP_FLAGS | alu.CMP[compare_with << 8 | data]]
 
     def branch(self, condition):
        if condition:
            jump = self.mem_read(self.program_counter)
+           if jump & 0x80:
+               jump -= 0x100
            jump_addr = (self.program_counter + 1 + jump) & 0xFFFF
            self.program_counter = jump_addr
+       else:
+           self.program_counter = (self.program_counter + 1) & 0xFFFF
+
+    def interrupt(self, vector, flags=CpuFlags.BREAK2):
+        self.stack_push_u16(self.program_counter)
+        self.stack_push((int(self.status) & ~CpuFlags.BREAK) | flags)
+        self.status |= CpuFlags.INTERRUPT_DISABLE
+        self.program_counter = self.mem_read_u16(vector)
+
+    def brk(self):
+        # Pushes the address after BRK's padding byte; the caller counts cycles.
+        self.program_counter = (self.program_counter + 1) & 0xFFFF
+        self.interrupt(events_module.IRQ_VECTOR, CpuFlags.BREAK | CpuFlags.BREAK2)
+
+    def service_events(self):
+        # Called once cycles reaches events.deadline, between instructions.
+        events = self.events
+        for kind, data in events.pop_due(self.cycles):
+            if kind == events_module.NMI:
+                self.interrupt(events_module.NMI_VECTOR)
+                self.cycles += 7
+            elif kind == events_module.IRQ:
+                events.irq_lines.add(data)
+            elif kind == events_module.OAM_DMA:
+                self.bus.oam_dma(data)
+                self.cycles += 513 + (self.cycles & 1)
+        if events.irq_lines:
+            if not self.status & CpuFlags.INTERRUPT_DISABLE:
+                self.interrupt(events_module.IRQ_VECTOR)
+                self.cycles += 7
+            # IRQ is level triggered: keep checking after every instruction
+            # until the source acknowledges it.
+            events.deadline = min(events.deadline, self.cycles)
 
     def run(self):
        self.run_with_callback(lambda _: None)
+
+    def run_until(self, cycle, callback=None):
+        # Returns False if BRK ended the program before cycles reached cycle.
+        def check(cpu):
+            if callback is not None:
+                callback(cpu)
+            if cpu.cycles >= cycle:
+                raise StopRun
+
+        try:
+            self.run_with_callback(check)
+        except StopRun:
+            return True
+        return False
     
     def run_with_callback(self, callback):
         opcodes_map = opcodes.OPCODES_MAP
+        control_flow_codes = opcodes.CONTROL_FLOW_CODES
+        events = self.events
 
         while True:
             code = self.mem_read(self.program_counter)
             self.program_counter += 1
-            program_counter_state = self.program_counter
 
             opcode = opcodes_map.get(code)
             if opcode is None:
@@ -447,7 +435,11 @@ class CPU:
                 case 0xe8:
                     self.inx()
                 case 0x00:
-                    return
+                    if self.halt_on_brk:
+                        return
+                    self.brk()
+                case 0xea:
+                    pass
                 case 0xd8:
                     self.status &= ~CpuFlags.DECIMAL_MODE
                 case 0x58:
@@ -517,7 +509,13 @@ class CPU:
                     self.program_counter = mem_address
                 case 0x6c:
                     mem_address = self.mem_read_u16(self.program_counter)
-                    indirect_ref = self.mem_read_u16(mem_address)
+                    # 6502 bug: the vector is fetched without crossing the page
+                    if mem_address & 0x00ff == 0x00ff:
+                        lo = self.mem_read(mem_address)
+                        hi = self.mem_read(mem_address & 0xff00)
+                        indirect_ref = (hi << 8) | lo
+                    else:
+                        indirect_ref = self.mem_read_u16(mem_address)
                     self.program_counter = indirect_ref
                 case 0x20:
                     self.stack_push_u16(self.program_counter + 2 - 1)
@@ -577,8 +575,732 @@ class CPU:
                 case _:
                     raise ValueError(f"OpCode {hex(code)} is not recognized")
 
-            if program_counter_state == self.program_counter:
-                self.program_counter += (opcode.len - 1)
+            if code not in control_flow_codes:
+                self.program_counter = (self.program_counter + opcode.len - 1) & 0xFFFF
+
+            self.cycles += opcode.cycles
+            if self.cycles >= events.deadline:
+                self.service_events()
+            callback(self)
+
+
+
+class LazyFlagsCPU(CPU):
+    # Same instruction set as CPU, but Z/N, C and V are not computed when an
+    # instruction runs. The helpers below only remember the value each flag
+    # derives from, and status folds them into CpuFlags when something reads
+    # it: a branch, PHP, BRK, trace.trace or a save state.
+    #
+    #   _zn: last result byte        Z = _zn == 0, N = _zn & 0x80
+    #   _c:  unmasked 9-bit result   C = _c >> 8 & 1
+    #   _v:  (data ^ r) & (r ^ a)    V = _v & 0x80
+    #
+    # None means the flag lives in _p, the plain int holding everything else.
+    __slots__ = ("_p", "_zn", "_c", "_v")
+
+    def __init__(self, bus):
+        self._p = 0
+        self._zn = self._c = self._v = None
+        super().__init__(bus)
+
+    @property
+    def status(self):
+        p = self._p
+        zn = self._zn
+        if zn is not None:
+            p = (p & 0x7d) | (zn & 0x80) | (0x02 if zn == 0 else 0)
+        if self._c is not None:
+            p = (p & 0xfe) | (self._c >> 8 & 1)
+        if self._v is not None:
+            p = (p & 0xbf) | ((self._v & 0x80) >> 1)
+        return STATUS[p]
+
+    @status.setter
+    def status(self, value):
+        self._p = int(value)
+        self._zn = self._c = self._v = None
+
+    def carry(self):
+        if self._c is not None:
+            return self._c >> 8 & 1
+        return self._p & 0x01
+
+    def update_zero_and_negative_flags(self, result):
+        self._zn = result
+
+    def set_carry_flag(self):
+        self._c = 0x100
+
+    def clear_carry_flag(self):
+        self._c = 0
+
+    def add_to_register_a(self, data):
+        a = self.register_a
+        sum_ = a + data + self.carry()
+        result = sum_ & 0xff
+        self._c = sum_
+        self._v = (data ^ result) & (result ^ a)
+        self.register_a = self._zn = result
+
+    def subtract_from_register_a(self, data):
+        self.add_to_register_a(data ^ 0xff)
+
+    def compare(self, mode, compare_with):
+        addr = self.get_operand_address(mode)
+        diff = compare_with - self.mem_read(addr)
+        self._c = diff + 0x100
+        self._zn = diff & 0xff
+
+    def asl_accumulator(self):
+        self._c = self.register_a << 1
+        self.register_a = self._zn = self._c & 0xff
+
+    def asl(self, mode):
+        addr = self.get_operand_address(mode)
+        self._c = self.mem_read(addr) << 1
+        data = self._zn = self._c & 0xff
+        self.mem_write(addr, data)
+        return data
+
+    def lsr_accumulator(self):
+        a = self.register_a
+        self._c = (a & 0x01) << 8
+        self.register_a = self._zn = a >> 1
+
+    def lsr(self, mode):
+        addr = self.get_operand_address(mode)
+        data = self.mem_read(addr)
+        self._c = (data & 0x01) << 8
+        data = self._zn = data >> 1
+        self.mem_write(addr, data)
+        return data
+
+    def rol_accumulator(self):
+        self._c = (self.register_a << 1) | self.carry()
+        self.register_a = self._zn = self._c & 0xff
+
+    def rol(self, mode):
+        addr = self.get_operand_address(mode)
+        self._c = (self.mem_read(addr) << 1) | self.carry()
+        data = self._zn = self._c & 0xff
+        self.mem_write(addr, data)
+        return data
+
+    def ror_accumulator(self):
+        a = self.register_a
+        data = (a >> 1) | (self.carry() << 7)
+        self._c = (a & 0x01) << 8
+        self.register_a = self._zn = data
+
+    def ror(self, mode):
+        addr = self.get_operand_address(mode)
+        data = self.mem_read(addr)
+        result = (data >> 1) | (self.carry() << 7)
+        self._c = (data & 0x01) << 8
+        self._zn = result
+        self.mem_write(addr, result)
+        return result
+
+
+# Loops made only of these can be skipped once they stop changing any state:
+# without stores or stack traffic, only an external write can end them.
+IDLE_POLL_MNEMONICS = frozenset({"LDA", "LDX", "LDY", "CMP", "CPX", "CPY", "BIT", "AND", "ORA", "NOP"})
+IDLE_POLL_MODES = frozenset({AddressingMode.Immediate, AddressingMode.ZeroPage,
+                             AddressingMode.Absolute, AddressingMode.NoneAddressing})
+# Delay loops: NOPs around a single INX/INY/DEX/DEY closed by BNE.
+IDLE_COUNTERS = {0xe8: ("register_x", 1), 0xc8: ("register_y", 1),
+                 0xca: ("register_x", -1), 0x88: ("register_y", -1)}
+
+
+class IdleLoopMixin:
+    # Fast-forwards spin loops in PRG ROM when their backward branch is taken.
+    #
+    # Delay loops are advanced arithmetically to their last iteration. Polling
+    # loops are skipped once an iteration ends in the state it started from;
+    # they then jump straight to the next deadline: events.deadline, or
+    # idle_deadline for external events the host delivers between runs
+    # (PPU status change, input); run_until sets it to its cycle. Neither kind
+    # runs past the deadline.
+    #
+    # Skipped iterations would never reach a per-instruction callback, so
+    # loops are only skipped by run() and run_until() without a callback,
+    # and not while a debugger, coverage or access counting is hooked in.
+    __slots__ = ()
+
+    def __init__(self, bus):
+        super().__init__(bus)
+        self.idle_deadline = None
+        self.idle_skipped_cycles = 0
+        self._idle_loops = {}
+        self._idle_state = None
+        self._idle_skip = False
+
+    def run(self):
+        # No deadline of our own; a stale one from run_until would stop all skipping.
+        self.idle_deadline = None
+        self._idle_skip = not self.observed()
+        try:
+            super().run()
+        finally:
+            self._idle_skip = False
+
+    def run_until(self, cycle, callback=None):
+        self.idle_deadline = cycle
+        self._idle_skip = callback is None and not self.observed()
+        try:
+            return super().run_until(cycle, callback)
+        finally:
+            self._idle_skip = False
+
+    def invalidate_idle_state(self):
+        # Call after changing registers or memory from outside (savestate.load):
+        # the next poll iteration must not be compared with one before it.
+        self._idle_state = None
+
+    def observed(self):
+        # debugger.shadow moves hooked instances to a class with _shadowed,
+        # and a counting bus (Bus(stats=True)) has to see every access.
+        return (hasattr(type(self), "_shadowed") or hasattr(type(self.bus), "_shadowed")
+                or self.bus.stats is not None)
+
+    def branch(self, condition):
+        operand = self.program_counter
+        super().branch(condition)
+        head = self.program_counter
+        if self._idle_skip and 0x8000 <= head < operand:
+            self.skip_idle_loop(head, operand - 1)
+
+    def classify_loop(self, head, branch_addr):
+        # Decoded straight from PRG ROM: reading the loop body is not a
+        # memory access of the program.
+        read = self.bus.read_prg_rom
+        ops = []
+        addr = head
+        while addr < branch_addr:
+            op = opcodes.OPCODES_MAP.get(read(addr))
+            if op is None:
+                return None
+            ops.append(op)
+            addr += op.len
+        if addr != branch_addr:
+            return None
+        branch_op = opcodes.OPCODES_MAP[read(branch_addr)]
+        body_cycles = sum(op.cycles for op in ops) + branch_op.cycles
+
+        counters = [op for op in ops if op.code in IDLE_COUNTERS]
+        if (branch_op.mnemonic == "BNE" and len(counters) == 1
+                and all(op.code == 0xea for op in ops if op is not counters[0])):
+            return "countdown", body_cycles, branch_op.cycles, IDLE_COUNTERS[counters[0].code]
+        if all(op.mnemonic in IDLE_POLL_MNEMONICS and op.mode in IDLE_POLL_MODES for op in ops):
+            return "poll", body_cycles, branch_op.cycles, None
+        return None
+
+    def skip_idle_loop(self, head, branch_addr):
+        key = (head, branch_addr)
+        if key not in self._idle_loops:
+            self._idle_loops[key] = self.classify_loop(head, branch_addr)
+        loop = self._idle_loops[key]
+        if loop is None:
+            return
+        kind, body_cycles, branch_cycles, counter = loop
+
+        # Cycle count once the branch itself has been accounted for.
+        now = self.cycles + branch_cycles
+        deadline = self.events.deadline
+        if self.idle_deadline is not None:
+            deadline = min(deadline, self.idle_deadline)
+        budget = None
+        if deadline != events_module.NEVER:
+            budget = max(0, (deadline - now) // body_cycles)
+
+        if kind == "countdown":
+            register, delta = counter
+            value = getattr(self, register)
+            # Leave the final iteration to run normally so it exits the loop.
+            skip = (value if delta < 0 else 0x100 - value) - 1
+            if budget is not None:
+                skip = min(skip, budget)
+            if skip <= 0:
+                return
+            value = (value + delta * skip) & 0xff
+            setattr(self, register, value)
+            self.update_zero_and_negative_flags(value)
+        else:
+            state = (head, self.register_a, self.register_x, self.register_y, int(self.status))
+            last, self._idle_state = self._idle_state, (state, now)
+            if last != (state, now - body_cycles) or not budget:
+                return
+            skip = budget
+
+        self.cycles += skip * body_cycles
+        self.idle_skipped_cycles += skip * body_cycles
+
+
+class IdleLoopCPU(IdleLoopMixin, CPU):
+    __slots__ = ("idle_deadline", "idle_skipped_cycles", "_idle_loops", "_idle_state", "_idle_skip")
+
+
+class FastCPU(IdleLoopMixin, LazyFlagsCPU):
+    # The quickest pure-Python combination: lazy flags and idle-loop skipping.
+    # profiles.py uses it for the fast and headless profiles.
+    __slots__ = IdleLoopCPU.__slots__
+
+
+# Addressing modes and instruction numbers of the InlineCPU loop. Branches
+# and shifts share one number each and take their flag test or ALU table
+# from per-opcode entries of InlineCPU.tables().
+MODE_IMMEDIATE = AddressingMode.Immediate.value
+MODE_ZERO_PAGE = AddressingMode.ZeroPage.value
+MODE_ZERO_PAGE_X = AddressingMode.ZeroPage_X.value
+MODE_ZERO_PAGE_Y = AddressingMode.ZeroPage_Y.value
+MODE_ABSOLUTE = AddressingMode.Absolute.value
+MODE_ABSOLUTE_X = AddressingMode.Absolute_X.value
+MODE_ABSOLUTE_Y = AddressingMode.Absolute_Y.value
+MODE_INDIRECT_X = AddressingMode.Indirect_X.value
+MODE_INDIRECT_Y = AddressingMode.Indirect_Y.value
+MODE_NONE = AddressingMode.NoneAddressing.value
+
+INLINE_INSTRUCTIONS = (
+    "LDA", "STA", "BRANCH", "LDX", "LDY", "CMP", "CPX", "CPY", "INX", "DEX", "INY", "DEY",
+    "INC", "DEC", "ADC", "SBC", "AND", "ORA", "EOR", "SHIFT", "JMP", "JSR", "RTS", "STX", "STY",
+    "BIT", "TAX", "TXA", "TAY", "TYA", "TSX", "TXS", "PHA", "PHP", "PLA", "PLP", "RTI",
+    "CLC", "SEC", "CLI", "SEI", "CLD", "SED", "CLV", "NOP", "BRK",
+)
+(OP_LDA, OP_STA, OP_BRANCH, OP_LDX, OP_LDY, OP_CMP, OP_CPX, OP_CPY, OP_INX, OP_DEX, OP_INY, OP_DEY,
+ OP_INC, OP_DEC, OP_ADC, OP_SBC, OP_AND, OP_ORA, OP_EOR, OP_SHIFT, OP_JMP, OP_JSR, OP_RTS, OP_STX, OP_STY,
+ OP_BIT, OP_TAX, OP_TXA, OP_TAY, OP_TYA, OP_TSX, OP_TXS, OP_PHA, OP_PHP, OP_PLA, OP_PLP, OP_RTI,
+ OP_CLC, OP_SEC, OP_CLI, OP_SEI, OP_CLD, OP_SED, OP_CLV, OP_NOP, OP_BRK) = range(len(INLINE_INSTRUCTIONS))
+
+# Branch mnemonic -> (status bit tested, value of the bit when taken).
+BRANCH_CONDITIONS = {
+    "BNE": (0x02, 0), "BEQ": (0x02, 0x02), "BPL": (0x80, 0), "BMI": (0x80, 0x80),
+    "BCC": (0x01, 0), "BCS": (0x01, 0x01), "BVC": (0x40, 0), "BVS": (0x40, 0x40),
+}
+
+
+class InlineCPU(CPU):
+    # Same instruction set as CPU, but run_with_callback is one function:
+    # registers live in locals, addressing modes and instructions are
+    # inlined, and bus.mem_read/mem_write are bound once per run. Registers
+    # are written back to the object before events are serviced, before the
+    # callback (and re-read after it) and when the run ends. Since the loop
+    # does not call the per-instruction helpers, subclasses overriding them
+    # (LazyFlagsCPU, IdleLoopMixin) do not compose with it.
+    __slots__ = ()
+
+    _tables = None
+
+    @classmethod
+    def tables(cls):
+        # Per-opcode (instruction, mode, pc advance, cycles, extra) decoded
+        # once; extra is a branch condition or a shift table. Built on the
+        # first run so importing cpu does not load the ALU tables.
+        if InlineCPU._tables is None:
+            shift_tables = {"ASL": alu.ASL, "LSR": alu.LSR, "ROL": alu.ROL, "ROR": alu.ROR}
+            decoded = [None] * 256
+            for code, op in opcodes.OPCODES_MAP.items():
+                if op.mnemonic in BRANCH_CONDITIONS:
+                    number, extra = OP_BRANCH, BRANCH_CONDITIONS[op.mnemonic]
+                elif op.mnemonic in shift_tables:
+                    number, extra = OP_SHIFT, shift_tables[op.mnemonic]
+                else:
+                    number, extra = INLINE_INSTRUCTIONS.index(op.mnemonic), None
+                advance = 0 if code in opcodes.CONTROL_FLOW_CODES else op.len - 1
+                decoded[code] = (number, op.mode.value, advance, op.cycles, extra)
+            InlineCPU._tables = decoded
+        return InlineCPU._tables
+
+    def run_with_callback(self, callback):
+        decoded = self.tables()
+        adc_table, sbc_table, cmp_table, zn = alu.ADC, alu.SBC, alu.CMP, alu.ZN
+        not_adc, not_cmp, not_zn = ~alu.ADC_FLAGS, ~alu.CMP_FLAGS, ~(alu.ZERO | alu.NEGATIVE)
+        events = self.events
+        read = self.bus.mem_read
+        write = self.bus.mem_write
+
+        a, x, y, sp = self.register_a, self.register_x, self.register_y, self.stack_pointer
+        p, pc, cycles = int(self.status), self.program_counter, self.cycles
+        try:
+            while True:
+                code = read(pc)
+                pc += 1
+                entry = decoded[code]
+                if entry is None:
+                    raise ValueError(f"OpCode {hex(code)} is not recognized")
+                op, mode, advance, op_cycles, extra = entry
+
+                if mode == MODE_NONE:
+                    addr = None
+                elif mode == MODE_IMMEDIATE:
+                    addr = pc
+                elif mode == MODE_ZERO_PAGE:
+                    addr = read(pc)
+                elif mode == MODE_ABSOLUTE:
+                    addr = read(pc) | read(pc + 1) << 8
+                elif mode == MODE_ZERO_PAGE_X:
+                    addr = (read(pc) + x) & 0xff
+                elif mode == MODE_ABSOLUTE_X:
+                    addr = ((read(pc) | read(pc + 1) << 8) + x) & 0xFFFF
+                elif mode == MODE_ABSOLUTE_Y:
+                    addr = ((read(pc) | read(pc + 1) << 8) + y) & 0xFFFF
+                elif mode == MODE_INDIRECT_Y:
+                    base = read(pc)
+                    addr = ((read(base) | read((base + 1) & 0xff) << 8) + y) & 0xFFFF
+                elif mode == MODE_ZERO_PAGE_Y:
+                    addr = (read(pc) + y) & 0xff
+                else:  # MODE_INDIRECT_X
+                    ptr = (read(pc) + x) & 0xff
+                    addr = read(ptr) | read((ptr + 1) & 0xff) << 8
+
+                if op == OP_LDA:
+                    a = read(addr)
+                    p = p & not_zn | zn[a]
+                elif op == OP_STA:
+                    write(addr, a)
+                elif op == OP_BRANCH:
+                    flag, taken = extra
+                    if p & flag == taken:
+                        jump = read(pc)
+                        if jump & 0x80:
+                            jump -= 0x100
+                        pc = (pc + 1 + jump) & 0xFFFF
+                    else:
+                        pc = (pc + 1) & 0xFFFF
+                elif op == OP_LDX:
+                    x = read(addr)
+                    p = p & not_zn | zn[x]
+                elif op == OP_LDY:
+                    y = read(addr)
+                    p = p & not_zn | zn[y]
+                elif op == OP_CMP:
+                    p = p & not_cmp | cmp_table[a << 8 | read(addr)]
+                elif op == OP_CPX:
+                    p = p & not_cmp | cmp_table[x << 8 | read(addr)]
+                elif op == OP_CPY:
+                    p = p & not_cmp | cmp_table[y << 8 | read(addr)]
+                elif op == OP_INX:
+                    x = (x + 1) & 0xff
+                    p = p & not_zn | zn[x]
+                elif op == OP_DEX:
+                    x = (x - 1) & 0xff
+                    p = p & not_zn | zn[x]
+                elif op == OP_INY:
+                    y = (y + 1) & 0xff
+                    p = p & not_zn | zn[y]
+                elif op == OP_DEY:
+                    y = (y - 1) & 0xff
+                    p = p & not_zn | zn[y]
+                elif op == OP_INC:
+                    data = (read(addr) + 1) & 0xff
+                    write(addr, data)
+                    p = p & not_zn | zn[data]
+                elif op == OP_DEC:
+                    data = (read(addr) - 1) & 0xff
+                    write(addr, data)
+                    p = p & not_zn | zn[data]
+                elif op == OP_ADC:
+                    result = adc_table[(p & 1) << 16 | a << 8 | read(addr)]
+                    a = result & 0xff
+                    p = p & not_adc | result >> 8
+                elif op == OP_SBC:
+                    result = sbc_table[(p & 1) << 16 | a << 8 | read(addr)]
+                    a = result & 0xff
+                    p = p & not_adc | result >> 8
+                elif op == OP_AND:
+                    a &= read(addr)
+                    p = p & not_zn | zn[a]
+                elif op == OP_ORA:
+                    a |= read(addr)
+                    p = p & not_zn | zn[a]
+                elif op == OP_EOR:
+                    a ^= read(addr)
+                    p = p & not_zn | zn[a]
+                elif op == OP_SHIFT:
+                    if addr is None:
+                        result = extra[(p & 1) << 8 | a]
+                        a = result & 0xff
+                    else:
+                        result = extra[(p & 1) << 8 | read(addr)]
+                        write(addr, result & 0xff)
+                    p = p & not_cmp | result >> 8
+                elif op == OP_JMP:
+                    target = read(pc) | read(pc + 1) << 8
+                    if code == 0x6c:
+                        # 6502 bug: the vector is fetched without crossing the page
+                        if target & 0x00ff == 0x00ff:
+                            target = read(target) | read(target & 0xff00) << 8
+                        else:
+                            target = read(target) | read(target + 1) << 8
+                    pc = target
+                elif op == OP_JSR:
+                    ret = pc + 1
+                    write(STACK + sp, (ret >> 8) & 0xff)
+                    sp = (sp - 1) & 0xff
+                    write(STACK + sp, ret & 0xff)
+                    sp = (sp - 1) & 0xff
+                    pc = read(pc) | read(pc + 1) << 8
+                elif op == OP_RTS:
+                    sp = (sp + 1) & 0xff
+                    lo = read(STACK + sp)
+                    sp = (sp + 1) & 0xff
+                    pc = (read(STACK + sp) << 8 | lo) + 1
+                elif op == OP_STX:
+                    write(addr, x)
+                elif op == OP_STY:
+                    write(addr, y)
+                elif op == OP_BIT:
+                    data = read(addr)
+                    p = p & ~0xc2 | (0 if a & data else 0x02) | data & 0xc0
+                elif op == OP_TAX:
+                    x = a
+                    p = p & not_zn | zn[x]
+                elif op == OP_TXA:
+                    a = x
+                    p = p & not_zn | zn[a]
+                elif op == OP_TAY:
+                    y = a
+                    p = p & not_zn | zn[y]
+                elif op == OP_TYA:
+                    a = y
+                    p = p & not_zn | zn[a]
+                elif op == OP_TSX:
+                    x = sp
+                    p = p & not_zn | zn[x]
+                elif op == OP_TXS:
+                    sp = x
+                elif op == OP_PHA:
+                    write(STACK + sp, a)
+                    sp = (sp - 1) & 0xff
+                elif op == OP_PHP:
+                    write(STACK + sp, p | 0x30)
+                    sp = (sp - 1) & 0xff
+                elif op == OP_PLA:
+                    sp = (sp + 1) & 0xff
+                    a = read(STACK + sp)
+                    p = p & not_zn | zn[a]
+                elif op == OP_PLP:
+                    sp = (sp + 1) & 0xff
+                    p = read(STACK + sp) & ~0x10 | 0x20
+                elif op == OP_RTI:
+                    sp = (sp + 1) & 0xff
+                    p = read(STACK + sp) & ~0x10 | 0x20
+                    sp = (sp + 1) & 0xff
+                    lo = read(STACK + sp)
+                    sp = (sp + 1) & 0xff
+                    pc = read(STACK + sp) << 8 | lo
+                elif op == OP_CLC:
+                    p &= ~0x01
+                elif op == OP_SEC:
+                    p |= 0x01
+                elif op == OP_CLI:
+                    p &= ~0x04
+                elif op == OP_SEI:
+                    p |= 0x04
+                elif op == OP_CLD:
+                    p &= ~0x08
+                elif op == OP_SED:
+                    p |= 0x08
+                elif op == OP_CLV:
+                    p &= ~0x40
+                elif op == OP_BRK:
+                    if self.halt_on_brk:
+                        return
+                    self.register_a, self.register_x, self.register_y = a, x, y
+                    self.stack_pointer, self.status, self.program_counter = sp, STATUS[p], pc
+                    self.brk()
+                    sp, p, pc = self.stack_pointer, int(self.status), self.program_counter
+
+                pc = (pc + advance) & 0xFFFF
+                cycles += op_cycles
+
+                if cycles >= events.deadline or callback is not None:
+                    self.register_a, self.register_x, self.register_y = a, x, y
+                    self.stack_pointer, self.status = sp, STATUS[p]
+                    self.program_counter, self.cycles = pc, cycles
+                    if cycles >= events.deadline:
+                        self.service_events()
+                    if callback is not None:
+                        callback(self)
+                    a, x, y = self.register_a, self.register_x, self.register_y
+                    sp, p = self.stack_pointer, int(self.status)
+                    pc, cycles = self.program_counter, self.cycles
+        finally:
+            self.register_a, self.register_x, self.register_y = a, x, y
+            self.stack_pointer, self.status = sp, STATUS[p]
+            self.program_counter, self.cycles = pc, cycles
+
+    def run(self):
+        self.run_with_callback(None)
+
+
+try:
+    from _cpu_native import ffi as _native_ffi, lib as _native_lib
+except ImportError:
+    _native_ffi = _native_lib = None
+
+NATIVE_AVAILABLE = _native_lib is not None
+NATIVE_RUN_BRK = 0
+NATIVE_RUN_STEP_LIMIT = 1
+NATIVE_RUN_ERROR = -1
+NATIVE_RUN_UNKNOWN_OPCODE = -2
+NATIVE_RUN_DEADLINE = 2
+
+if _native_lib is not None:
+    @_native_ffi.def_extern()
+    def py_mem_read(handle, addr):
+        cpu = _native_ffi.from_handle(handle)
+        try:
+            return cpu.bus.mem_read(addr)
+        except Exception as e:
+            cpu.native_fail(e)
+            return 0
+
+    @_native_ffi.def_extern()
+    def py_mem_write(handle, addr, data):
+        cpu = _native_ffi.from_handle(handle)
+        try:
+            cpu.bus.mem_write(addr, data)
+        except Exception as e:
+            cpu.native_fail(e)
+        # The write may have scheduled an event ($4014 DMA, mapper IRQ).
+        cpu._state.deadline = min(cpu.events.deadline, cpu.run_limit)
+
+
+class NativeCPU(CPU):
+    # Same interface as CPU, but run_with_callback executes instructions in
+    # the compiled core built by build_native.py. Both sides index the same
+    # RAM buffer; a list (older callers) is switched to a bytearray first.
+
+    __slots__ = ("run_limit", "_handle", "_error", "_state", "_ram", "_prg",
+                 "_watch", "_watch_buf", "_coverage_buf")
+
+    def __init__(self, bus):
+        if _native_lib is None:
+            raise RuntimeError("Native CPU core is not built, run build_native.py")
+        super().__init__(bus)
+        # Cycle at which run_until stops the compiled loop; handled like an
+        # event deadline that has nothing to service.
+        self.run_limit = events_module.NEVER
+        if isinstance(bus.cpu_vram, list):
+            bus.cpu_vram = bytearray(bus.cpu_vram)
+        self._handle = _native_ffi.new_handle(self)
+        self._error = None
+        self._state = _native_ffi.new("cpu_state *")
+        self._ram = _native_ffi.from_buffer(bus.cpu_vram)
+        self._prg = _native_ffi.from_buffer(bytes(bus.rom.prg_rom))
+        self._state.ram = self._ram
+        self._state.prg = self._prg
+        self._state.prg_len = len(bus.rom.prg_rom)
+        self._state.handle = self._handle
+        self._watch = self._watch_buf = None
+        self._coverage_buf = None
+        self.set_watch_pages(())
+
+    def set_watch_pages(self, pages):
+        # Accesses to these pages skip the RAM/PRG fast paths and reach
+        # bus.mem_read/mem_write, where debugger watchpoints live.
+        if getattr(self.bus, "stats", None) is not None:
+            pages = range(256)  # every access has to be counted
+        if pages:
+            self._watch = bytearray(256)
+            for page in pages:
+                self._watch[page & 0xff] = 1
+            self._watch_buf = _native_ffi.from_buffer(self._watch)
+            self._state.watch = self._watch_buf
+        else:
+            self._watch = self._watch_buf = None
+            self._state.watch = _native_ffi.NULL
+
+    def set_coverage(self, bitmap):
+        # The C loop marks executed PRG bytes in bitmap (romcov.Coverage).
+        if bitmap is None:
+            self._coverage_buf = None
+            self._state.coverage = _native_ffi.NULL
+        else:
+            self._coverage_buf = _native_ffi.from_buffer(bitmap)
+            self._state.coverage = self._coverage_buf
+
+    def release_buffers(self):
+        # Give up the C views of RAM/PRG/watch pages now instead of when the
+        # cycle through _handle is collected, so shared memory under
+        # bus.cpu_vram can be closed. The core cannot run afterwards.
+        for buffer in (self._ram, self._prg, self._watch_buf, self._coverage_buf):
+            if buffer is not None:
+                _native_ffi.release(buffer)
+        self._ram = self._prg = self._watch_buf = self._coverage_buf = None
+
+    def native_fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._state.error = 1
+
+    def _push_state(self):
+        s = self._state
+        s.a = self.register_a
+        s.x = self.register_x
+        s.y = self.register_y
+        s.sp = self.stack_pointer
+        s.status = self.status
+        s.pc = self.program_counter
+        s.cycles = self.cycles
+        s.deadline = min(self.events.deadline, self.run_limit)
+
+    def _pull_state(self):
+        s = self._state
+        self.register_a = s.a
+        self.register_x = s.x
+        self.register_y = s.y
+        self.stack_pointer = s.sp
+        self.status = CpuFlags(s.status)
+        self.program_counter = s.pc
+        self.cycles = s.cycles
+
+    def _native_run(self, max_steps):
+        self._push_state()
+        rc = _native_lib.cpu_run(self._state, max_steps)
+        self._pull_state()
+        if rc == NATIVE_RUN_ERROR:
+            error, self._error = self._error, None
+            self._state.error = 0
+            raise error
+        if rc == NATIVE_RUN_UNKNOWN_OPCODE:
+            raise ValueError(f"OpCode {hex(self._state.opcode)} is not recognized")
+        return rc
+
+    def _after_run(self, rc):
+        # Returns False when BRK should end the run.
+        if rc == NATIVE_RUN_BRK:
+            if self.halt_on_brk:
+                return False
+            self.brk()
+            self.cycles += 7
+        if self.cycles >= self.events.deadline:
+            self.service_events()
+        return True
+
+    def run(self):
+        while self._after_run(self._native_run(-1)):
+            pass
 
+    def run_with_callback(self, callback):
+        while self._after_run(self._native_run(1)):
             callback(self)
 
+    def run_until(self, cycle, callback=None):
+        # Without a callback the whole slice runs in C. A shadowed
+        # run_with_callback (debugger) still has to see every instruction.
+        if callback is not None or type(self).run_with_callback is not NativeCPU.run_with_callback:
+            return super().run_until(cycle, callback)
+        self.run_limit = cycle
+        try:
+            while self.cycles < cycle:
+                if not self._after_run(self._native_run(-1)):
+                    return False
+        finally:
+            self.run_limit = events_module.NEVER
+        return True
+
+
+PyCPU = CPU
+if NATIVE_AVAILABLE:
+    CPU = NativeCPU
@@ -0,0 +1,523 @@
+/*
+ * Native interpreter core for cpu.CPU.
+ *
+ * This file is compiled by build_native.py, which prepends the opcode
+ * tables (OP_KNOWN, OP_LEN, OP_CYCLES, OP_MODE, OP_FLOW) and the MODE_* constants
+ * generated from opcodes.py. The Python CPU in cpu.py is the reference: every
+ * instruction here mirrors the matching CPU method, quirks included, and
+ * test.py runs both cores side by side to keep it that way.
+ *
+ * RAM ($0000-$1FFF) and PRG ROM ($8000-$FFFF) reads are served straight
+ * from the buffers owned by bus.Bus; every other access is handed back to
+ * Python through py_mem_read/py_mem_write.
+ *
+ * cpu_run stops with RUN_DEADLINE once cycles reaches s->deadline, the next
+ * event in the Python EventQueue; interrupts and DMA are serviced there.
+ *
+ * When s->coverage is set, every executed instruction ORs COVERAGE_OPCODE
+ * into the byte for its opcode and COVERAGE_OPERAND into its operand bytes
+ * (one byte per PRG ROM offset, see romcov.py).
+ */
+
+#define FLAG_CARRY 0x01
+#define FLAG_ZERO 0x02
+#define FLAG_INTERRUPT_DISABLE 0x04
+#define FLAG_DECIMAL_MODE 0x08
+#define FLAG_BREAK 0x10
+#define FLAG_BREAK2 0x20
+#define FLAG_OVERFLOW 0x40
+#define FLAG_NEGATIVE 0x80
+
+#define STACK 0x0100
+
+#define RUN_BRK 0
+#define RUN_STEP_LIMIT 1
+#define RUN_ERROR -1
+#define RUN_UNKNOWN_OPCODE -2
+#define RUN_DEADLINE 2
+
+#define COVERAGE_OPCODE 0x01
+#define COVERAGE_OPERAND 0x02
+
+/* Pages with a debugger watchpoint always go through Python. */
+#define WATCHED(s, addr) ((s)->watch != NULL && (s)->watch[((addr) >> 8) & 0xff])
+
+/* Offset of addr in PRG ROM (16 KB images are mirrored), or -1. */
+static int prg_offset(cpu_state *s, int addr)
+{
+    int off;
+
+    if (addr < 0x8000 || addr > 0xffff)
+        return -1;
+    off = addr - 0x8000;
+    if (s->prg_len == 0x4000 && off >= 0x4000)
+        off %= 0x4000;
+    return off < s->prg_len ? off : -1;
+}
+
+static int rd(cpu_state *s, int addr)
+{
+    int off;
+
+    if (WATCHED(s, addr))
+        goto slow;
+    if (addr >= 0 && addr <= 0x1fff)
+        return s->ram[addr & 0x7ff];
+    off = prg_offset(s, addr);
+    if (off >= 0)
+        return s->prg[off];
+slow:
+    if (s->error)
+        return 0;
+    return py_mem_read(s->handle, addr);
+}
+
+static void wr(cpu_state *s, int addr, int data)
+{
+    if (s->error)
+        return;
+    if (addr >= 0 && addr <= 0x1fff && data >= 0 && data <= 0xff && !WATCHED(s, addr)) {
+        s->ram[addr & 0x7ff] = (uint8_t)data;
+        return;
+    }
+    py_mem_write(s->handle, addr, data);
+}
+
+static int rd16(cpu_state *s, int pos)
+{
+    int lo = rd(s, pos);
+    int hi = rd(s, pos + 1);
+    return (hi << 8) | lo;
+}
+
+static int operand_address(cpu_state *s, int mode)
+{
+    int addr = s->pc;
+    int base, ptr, lo, hi;
+
+    switch (mode) {
+    case MODE_IMMEDIATE:
+        return addr;
+    case MODE_ZEROPAGE:
+        return rd(s, addr);
+    case MODE_ABSOLUTE:
+        return rd16(s, addr);
+    case MODE_ZEROPAGE_X:
+        return (rd(s, addr) + s->x) & 0xff;
+    case MODE_ZEROPAGE_Y:
+        return (rd(s, addr) + s->y) & 0xff;
+    case MODE_ABSOLUTE_X:
+        return (rd16(s, addr) + s->x) & 0xffff;
+    case MODE_ABSOLUTE_Y:
+        return (rd16(s, addr) + s->y) & 0xffff;
+    case MODE_INDIRECT_X:
+        base = rd(s, addr);
+        ptr = (base + s->x) & 0xff;
+        lo = rd(s, ptr);
+        hi = rd(s, (ptr + 1) & 0xff);
+        return (hi << 8) | lo;
+    case MODE_INDIRECT_Y:
+        base = rd(s, addr);
+        lo = rd(s, base);
+        hi = rd(s, (base + 1) & 0xff);
+        return (((hi << 8) | lo) + s->y) & 0xffff;
+    }
+    return 0;
+}
+
+static void update_zero_and_negative_flags(cpu_state *s, int result)
+{
+    if (result == 0)
+        s->status |= FLAG_ZERO;
+    else
+        s->status &= ~FLAG_ZERO & 0xff;
+
+    if (result >= 0 && (result >> 7) == 1)
+        s->status |= FLAG_NEGATIVE;
+    else
+        s->status &= ~FLAG_NEGATIVE & 0xff;
+}
+
+static void set_flag(cpu_state *s, int flag, int on)
+{
+    if (on)
+        s->status |= flag;
+    else
+        s->status &= ~flag & 0xff;
+}
+
+static void set_register_a(cpu_state *s, int value)
+{
+    s->a = value;
+    update_zero_and_negative_flags(s, s->a);
+}
+
+static void add_to_register_a(cpu_state *s, int data)
+{
+    int sum = s->a + data + ((s->status & FLAG_CARRY) ? 1 : 0);
+    int result;
+
+    set_flag(s, FLAG_CARRY, sum > 0xff);
+    result = sum & 0xff;
+    set_flag(s, FLAG_OVERFLOW, ((data ^ result) & (result ^ s->a) & 0x80) != 0);
+    set_register_a(s, result);
+}
+
+static void stack_push(cpu_state *s, int data)
+{
+    wr(s, STACK + s->sp, data);
+    s->sp = (s->sp - 1) & 0xff;
+}
+
+static int stack_pop(cpu_state *s)
+{
+    s->sp = (s->sp + 1) & 0xff;
+    return rd(s, STACK + s->sp);
+}
+
+static void stack_push_u16(cpu_state *s, int data)
+{
+    stack_push(s, (data >> 8) & 0xff);
+    stack_push(s, data & 0xff);
+}
+
+static int stack_pop_u16(cpu_state *s)
+{
+    int lo = stack_pop(s);
+    int hi = stack_pop(s);
+    return (hi << 8) | lo;
+}
+
+static void compare(cpu_state *s, int mode, int compare_with)
+{
+    int data = rd(s, operand_address(s, mode));
+
+    set_flag(s, FLAG_CARRY, data <= compare_with);
+    update_zero_and_negative_flags(s, (compare_with - data) & 0xff);
+}
+
+static void branch(cpu_state *s, int condition)
+{
+    if (condition) {
+        int jump = rd(s, s->pc);
+        if (jump & 0x80)
+            jump -= 0x100;
+        s->pc = (s->pc + 1 + jump) & 0xffff;
+    } else {
+        s->pc = (s->pc + 1) & 0xffff;
+    }
+}
+
+static void pull_status(cpu_state *s)
+{
+    s->status = stack_pop(s);
+    s->status &= ~FLAG_BREAK & 0xff;
+    s->status |= FLAG_BREAK2;
+}
+
+static void mark_coverage(cpu_state *s, int addr, int len)
+{
+    int i, off;
+
+    for (i = 0; i < len; i++) {
+        off = prg_offset(s, addr + i);
+        if (off >= 0)
+            s->coverage[off] |= i == 0 ? COVERAGE_OPCODE : COVERAGE_OPERAND;
+    }
+}
+
+static int step(cpu_state *s)
+{
+    int code = rd(s, s->pc);
+    int mode, addr, data, old_carry;
+
+    s->pc += 1;
+    s->opcode = code;
+    if (s->error)
+        return RUN_ERROR;
+    if (!OP_KNOWN[code])
+        return RUN_UNKNOWN_OPCODE;
+    if (s->coverage != NULL)
+        mark_coverage(s, s->pc - 1, OP_LEN[code]);
+    mode = OP_MODE[code];
+
+    switch (code) {
+    /* LDA */
+    case 0xa9: case 0xa5: case 0xb5: case 0xad: case 0xbd: case 0xb9: case 0xa1: case 0xb1:
+        set_register_a(s, rd(s, operand_address(s, mode)));
+        break;
+    case 0xaa:
+        s->x = s->a;
+        update_zero_and_negative_flags(s, s->x);
+        break;
+    case 0xe8:
+        s->x = (s->x + 1) & 0xff;
+        update_zero_and_negative_flags(s, s->x);
+        break;
+    case 0x00:
+        return RUN_BRK;
+    case 0xea:
+        break;
+    case 0xd8:
+        s->status &= ~FLAG_DECIMAL_MODE & 0xff;
+        break;
+    case 0x58:
+        s->status &= ~FLAG_INTERRUPT_DISABLE & 0xff;
+        break;
+    case 0xb8:
+        s->status &= ~FLAG_OVERFLOW & 0xff;
+        break;
+    case 0x18:
+        s->status &= ~FLAG_CARRY & 0xff;
+        break;
+    case 0x38:
+        s->status |= FLAG_CARRY;
+        break;
+    case 0x78:
+        s->status |= FLAG_INTERRUPT_DISABLE;
+        break;
+    case 0xf8:
+        s->status |= FLAG_DECIMAL_MODE;
+        break;
+    case 0x48:
+        stack_push(s, s->a);
+        break;
+    case 0x68:
+        set_register_a(s, stack_pop(s));
+        break;
+    case 0x08:
+        stack_push(s, s->status | FLAG_BREAK | FLAG_BREAK2);
+        break;
+    case 0x28:
+        pull_status(s);
+        break;
+    /* ADC */
+    case 0x69: case 0x65: case 0x75: case 0x6d: case 0x7d: case 0x79: case 0x61: case 0x71:
+        add_to_register_a(s, rd(s, operand_address(s, mode)));
+        break;
+    /* SBC */
+    case 0xe9: case 0xe5: case 0xf5: case 0xed: case 0xfd: case 0xf9: case 0xe1: case 0xf1:
+        add_to_register_a(s, rd(s, operand_address(s, mode)) ^ 0xff);
+        break;
+    /* AND */
+    case 0x29: case 0x25: case 0x35: case 0x2d: case 0x3d: case 0x39: case 0x21: case 0x31:
+        set_register_a(s, rd(s, operand_address(s, mode)) & s->a);
+        break;
+    /* EOR */
+    case 0x49: case 0x45: case 0x55: case 0x4d: case 0x5d: case 0x59: case 0x41: case 0x51:
+        set_register_a(s, rd(s, operand_address(s, mode)) ^ s->a);
+        break;
+    /* ORA */
+    case 0x09: case 0x05: case 0x15: case 0x0d: case 0x1d: case 0x19: case 0x01: case 0x11:
+        set_register_a(s, rd(s, operand_address(s, mode)) | s->a);
+        break;
+    case 0x4a:
+        set_flag(s, FLAG_CARRY, s->a & 0x01);
+        s->a = s->a >> 1;
+        update_zero_and_negative_flags(s, s->a);
+        break;
+    case 0x46: case 0x56: case 0x4e: case 0x5e:
+        addr = operand_address(s, mode);
+        data = rd(s, addr);
+        set_flag(s, FLAG_CARRY, data & 0x01);
+        data = data >> 1;
+        wr(s, addr, data);
+        update_zero_and_negative_flags(s, data);
+        break;
+    case 0x0a:
+        set_flag(s, FLAG_CARRY, s->a & 0x80);
+        s->a = (s->a << 1) & 0xff;
+        update_zero_and_negative_flags(s, s->a);
+        break;
+    case 0x06: case 0x16: case 0x0e: case 0x1e:
+        addr = operand_address(s, mode);
+        data = rd(s, addr);
+        set_flag(s, FLAG_CARRY, data & 0x80);
+        data = (data << 1) & 0xff;
+        wr(s, addr, data);
+        update_zero_and_negative_flags(s, data);
+        break;
+    case 0x2a:
+        old_carry = s->status & FLAG_CARRY;
+        set_flag(s, FLAG_CARRY, s->a & 0x80);
+        s->a = (s->a << 1) & 0xff;
+        if (old_carry)
+            s->a |= 0x01;
+        update_zero_and_negative_flags(s, s->a);
+        break;
+    case 0x26: case 0x36: case 0x2e: case 0x3e:
+        addr = operand_address(s, mode);
+        data = rd(s, addr);
+        old_carry = s->status & FLAG_CARRY;
+        set_flag(s, FLAG_CARRY, data & 0x80);
+        data = (data << 1) & 0xff;
+        if (old_carry)
+            data |= 0x01;
+        wr(s, addr, data);
+        update_zero_and_negative_flags(s, data);
+        break;
+    case 0x6a:
+        data = s->a;
+        old_carry = s->status & FLAG_CARRY;
+        set_flag(s, FLAG_CARRY, data & 1);
+        data = (data >> 1) & 0xff;
+        if (old_carry)
+            data |= 0x80;
+        set_register_a(s, data);
+        break;
+    case 0x66: case 0x76: case 0x6e: case 0x7e:
+        addr = operand_address(s, mode);
+        data = rd(s, addr);
+        old_carry = s->status & FLAG_CARRY;
+        set_flag(s, FLAG_CARRY, data & 1);
+        data = (data >> 1) & 0xff;
+        if (old_carry)
+            data |= 0x80;
+        wr(s, addr, data);
+        update_zero_and_negative_flags(s, data);
+        break;
+    case 0xe6: case 0xf6: case 0xee: case 0xfe:
+        addr = operand_address(s, mode);
+        data = (rd(s, addr) + 1) & 0xff;
+        wr(s, addr, data);
+        update_zero_and_negative_flags(s, data);
+        break;
+    case 0xc8:
+        s->y = (s->y + 1) & 0xff;
+        update_zero_and_negative_flags(s, s->y);
+        break;
+    case 0xc6: case 0xd6: case 0xce: case 0xde:
+        addr = operand_address(s, mode);
+        data = (rd(s, addr) - 1) & 0xff;
+        wr(s, addr, data);
+        update_zero_and_negative_flags(s, data);
+        break;
+    case 0xca:
+        s->x = (s->x - 1) & 0xff;
+        update_zero_and_negative_flags(s, s->x);
+        break;
+    case 0x88:
+        s->y = (s->y - 1) & 0xff;
+        update_zero_and_negative_flags(s, s->y);
+        break;
+    case 0xc9: case 0xc5: case 0xd5: case 0xcd: case 0xdd: case 0xd9: case 0xc1: case 0xd1:
+        compare(s, mode, s->a);
+        break;
+    case 0xc0: case 0xc4: case 0xcc:
+        compare(s, mode, s->y);
+        break;
+    case 0xe0: case 0xe4: case 0xec:
+        compare(s, mode, s->x);
+        break;
+    case 0x4c:
+        s->pc = rd16(s, s->pc);
+        break;
+    case 0x6c:
+        addr = rd16(s, s->pc);
+        /* 6502 bug: the vector is fetched without crossing the page */
+        if ((addr & 0x00ff) == 0x00ff)
+            s->pc = (rd(s, addr & 0xff00) << 8) | rd(s, addr);
+        else
+            s->pc = rd16(s, addr);
+        break;
+    case 0x20:
+        stack_push_u16(s, s->pc + 2 - 1);
+        s->pc = rd16(s, s->pc);
+        break;
+    case 0x60:
+        s->pc = stack_pop_u16(s) + 1;
+        break;
+    case 0x40:
+        pull_status(s);
+        s->pc = stack_pop_u16(s);
+        break;
+    case 0xd0:
+        branch(s, !(s->status & FLAG_ZERO));
+        break;
+    case 0x70:
+        branch(s, s->status & FLAG_OVERFLOW);
+        break;
+    case 0x50:
+        branch(s, !(s->status & FLAG_OVERFLOW));
+        break;
+    case 0x10:
+        branch(s, !(s->status & FLAG_NEGATIVE));
+        break;
+    case 0x30:
+        branch(s, s->status & FLAG_NEGATIVE);
+        break;
+    case 0xf0:
+        branch(s, s->status & FLAG_ZERO);
+        break;
+    case 0xb0:
+        branch(s, s->status & FLAG_CARRY);
+        break;
+    case 0x90:
+        branch(s, !(s->status & FLAG_CARRY));
+        break;
+    case 0x24: case 0x2c:
+        data = rd(s, operand_address(s, mode));
+        set_flag(s, FLAG_ZERO, (s->a & data) == 0);
+        set_flag(s, FLAG_NEGATIVE, data & 0x80);
+        set_flag(s, FLAG_OVERFLOW, data & 0x40);
+        break;
+    case 0x85: case 0x95: case 0x8d: case 0x9d: case 0x99: case 0x81: case 0x91:
+        wr(s, operand_address(s, mode), s->a);
+        break;
+    case 0x86: case 0x96: case 0x8e:
+        wr(s, operand_address(s, mode), s->x);
+        break;
+    case 0x84: case 0x94: case 0x8c:
+        wr(s, operand_address(s, mode), s->y);
+        break;
+    case 0xa2: case 0xa6: case 0xb6: case 0xae: case 0xbe:
+        s->x = rd(s, operand_address(s, mode));
+        update_zero_and_negative_flags(s, s->x);
+        break;
+    case 0xa0: case 0xa4: case 0xb4: case 0xac: case 0xbc:
+        s->y = rd(s, operand_address(s, mode));
+        update_zero_and_negative_flags(s, s->y);
+        break;
+    case 0xa8:
+        s->y = s->a;
+        update_zero_and_negative_flags(s, s->y);
+        break;
+    case 0xba:
+        s->x = s->sp;
+        update_zero_and_negative_flags(s, s->x);
+        break;
+    case 0x8a:
+        s->a = s->x;
+        update_zero_and_negative_flags(s, s->a);
+        break;
+    case 0x9a:
+        s->sp = s->x;
+        break;
+    case 0x98:
+        s->a = s->y;
+        update_zero_and_negative_flags(s, s->a);
+        break;
+    default:
+        return RUN_UNKNOWN_OPCODE;
+    }
+
+    if (!OP_FLOW[code])
+        s->pc = (s->pc + OP_LEN[code] - 1) & 0xffff;
+    s->cycles += OP_CYCLES[code];
+    return s->error ? RUN_ERROR : RUN_STEP_LIMIT;
+}
+
+int cpu_run(cpu_state *s, long max_steps)
+{
+    long n;
+    int rc;
+
+    for (n = 0; max_steps < 0 || n < max_steps; n++) {
+        rc = step(s);
+        if (rc != RUN_STEP_LIMIT)
+            return rc;
+        if (s->cycles >= s->deadline)
+            return RUN_DEADLINE;
+    }
+    return RUN_STEP_LIMIT;
+}
@@ -0,0 +1,199 @@
+"""PC breakpoints, memory watchpoints and register conditions.
+
+    dbg = Debugger(cpu)
+    dbg.break_at(0x8735, "a == 0 and x > 3")
+    dbg.watch(0x0200, 0x05ff, on="w")
+    try:
+        cpu.run_with_callback(callback)
+    except BreakpointHit as hit:
+        print(hit.hits)   # resume by calling run_with_callback again
+
+Nothing is instrumented until a breakpoint or watchpoint exists. Then the
+debugger shadows run/run_with_callback on that one CPU instance, and
+mem_read/mem_write on the bus only for the access kinds being watched;
+unwatched pages return right after the page check, and NativeCPU keeps its
+fast paths for every page without a watchpoint. Removing the last one puts
+the class methods back, so a run without breakpoints is the plain run.
+"""
+from collections import namedtuple
+
+from bus import RAM_MIRRORS_END, PPU_REGISTERS, PPU_REGISTERS_MIRRORS_END
+
+Hit = namedtuple("Hit", ["kind", "addr", "value", "pc", "cycles"])
+Watchpoint = namedtuple("Watchpoint", ["start", "end", "on", "addresses", "condition"])
+
+
+class BreakpointHit(Exception):
+    def __init__(self, hits):
+        super().__init__(", ".join(f"{h.kind} ${h.addr:04X} at ${h.pc:04X}" for h in hits))
+        self.hits = hits
+
+
+def canonical(addr):
+    if addr <= RAM_MIRRORS_END:
+        return addr & 0x07ff
+    if PPU_REGISTERS <= addr <= PPU_REGISTERS_MIRRORS_END:
+        return PPU_REGISTERS | (addr & 0x0007)
+    return addr
+
+
+def mirror_pages(addresses):
+    pages = set()
+    for page in {addr >> 8 for addr in addresses}:
+        if page < 0x08:
+            pages.update(range(page, 0x20, 0x08))
+        elif page == PPU_REGISTERS >> 8:
+            pages.update(range(PPU_REGISTERS >> 8, (PPU_REGISTERS_MIRRORS_END >> 8) + 1))
+        else:
+            pages.add(page)
+    return pages
+
+
+def compile_condition(condition):
+    if condition is None:
+        return None
+    return compile(condition, "<condition>", "eval")
+
+
+class Debugger:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.bus = cpu.bus
+        self.breakpoints = {}  # pc -> compiled condition or None
+        self.watchpoints = []
+        self._read_pages = frozenset()
+        self._write_pages = frozenset()
+        self._hits = []
+        self._instruction_pc = None
+        self._resume_pc = None
+        # Whatever mem_read/mem_write the bus has now (e.g. counting ones).
+        self._bus_read = self.bus.mem_read
+        self._bus_write = self.bus.mem_write
+
+    def break_at(self, pc, condition=None):
+        self.breakpoints[pc] = compile_condition(condition)
+        self._install()
+
+    def remove_breakpoint(self, pc):
+        del self.breakpoints[pc]
+        self._install()
+
+    def watch(self, start, end=None, on="rw", condition=None):
+        if not on or set(on) - {"r", "w"}:
+            raise ValueError(f"Watchpoint access must be 'r', 'w' or 'rw', not {on!r}")
+        end = start if end is None else end
+        addresses = frozenset(canonical(addr) for addr in range(start, end + 1))
+        watchpoint = Watchpoint(start, end, on, addresses, compile_condition(condition))
+        self.watchpoints.append(watchpoint)
+        self._install()
+        return watchpoint
+
+    def unwatch(self, watchpoint):
+        self.watchpoints.remove(watchpoint)
+        self._install()
+
+    def clear(self):
+        self.breakpoints.clear()
+        self.watchpoints.clear()
+        self._install()
+
+    def registers(self):
+        cpu = self.cpu
+        return {"a": cpu.register_a, "x": cpu.register_x, "y": cpu.register_y,
+                "sp": cpu.stack_pointer, "p": int(cpu.status), "pc": cpu.program_counter,
+                "cycles": cpu.cycles}
+
+    def _install(self):
+        cpu, bus = self.cpu, self.bus
+        read_addresses = set()
+        write_addresses = set()
+        for watchpoint in self.watchpoints:
+            if "r" in watchpoint.on:
+                read_addresses |= watchpoint.addresses
+            if "w" in watchpoint.on:
+                write_addresses |= watchpoint.addresses
+        self._read_pages = frozenset(mirror_pages(read_addresses))
+        self._write_pages = frozenset(mirror_pages(write_addresses))
+
+        shadow(bus, "mem_read", self._watched_read if self._read_pages else None)
+        shadow(bus, "mem_write", self._watched_write if self._write_pages else None)
+        active = bool(self.breakpoints or self.watchpoints)
+        shadow(cpu, "run_with_callback", self._run_with_callback if active else None)
+        shadow(cpu, "run", self._run if active else None)
+        if hasattr(cpu, "set_watch_pages"):
+            cpu.set_watch_pages(self._read_pages | self._write_pages)
+
+    def _run(self):
+        self._run_with_callback(lambda _: None)
+
+    def _run_with_callback(self, callback):
+        def check(cpu):
+            callback(cpu)
+            self._check()
+
+        # Resuming from a breakpoint must execute that instruction first.
+        self._instruction_pc = self.cpu.program_counter
+        if self.cpu.program_counter != self._resume_pc:
+            self._check()
+        self._resume_pc = None
+        unshadowed(self.cpu).run_with_callback(self.cpu, check)
+
+    def _check(self):
+        pc = self.cpu.program_counter
+        if pc in self.breakpoints:
+            condition = self.breakpoints[pc]
+            if condition is None or eval(condition, {}, self.registers()):
+                self._hits.append(Hit("break", pc, None, pc, self.cpu.cycles))
+        self._instruction_pc = pc
+        if self._hits:
+            hits, self._hits = self._hits, []
+            self._resume_pc = pc
+            raise BreakpointHit(hits)
+
+    def _watched_read(self, addr):
+        value = self._bus_read(addr)
+        if addr >> 8 in self._read_pages:
+            self._access("read", "r", addr, value)
+        return value
+
+    def _watched_write(self, addr, data):
+        if addr >> 8 in self._write_pages:
+            self._access("write", "w", addr, data)
+        self._bus_write(addr, data)
+
+    def _access(self, kind, on, addr, value):
+        addr = canonical(addr)
+        for watchpoint in self.watchpoints:
+            if on not in watchpoint.on or addr not in watchpoint.addresses:
+                continue
+            if watchpoint.condition is not None:
+                env = self.registers()
+                env.update(addr=addr, value=value)
+                if not eval(watchpoint.condition, {}, env):
+                    continue
+            # Reported once the instruction doing the access has finished.
+            self._hits.append(Hit(kind, addr, value, self._instruction_pc, self.cpu.cycles))
+            return
+
+
+def shadow(obj, name, method):
+    # Replace one method on obj alone, or restore it with None. CPUs and
+    # buses have __slots__ and no __dict__, so obj moves to a subclass of
+    # its class that holds the replacements, and back once none are left.
+    base = unshadowed(obj)
+    methods = dict(getattr(type(obj), "_shadowed", {}))
+    if method is not None:
+        methods[name] = method
+    else:
+        methods.pop(name, None)
+    if not methods:
+        obj.__class__ = base
+        return
+    namespace = {name: staticmethod(method) for name, method in methods.items()}
+    namespace.update(__slots__=(), _shadowed=methods, _unshadowed=base)
+    obj.__class__ = type(base.__name__, (base,), namespace)
+
+
+def unshadowed(obj):
+    # The class of obj without shadowed methods.
+    return getattr(type(obj), "_unshadowed", type(obj))
@@ -0,0 +1,272 @@
+"""Static disassembler and control-flow graph for PRG ROM.
+
+    python disasm.py snake.nes
+
+Code is found by following every reachable path from the NMI, reset and
+IRQ vectors, so data between routines is never decoded as instructions.
+The resulting graph is cached on disk keyed by the PRG ROM hash.
+"""
+import sys
+from collections import namedtuple
+
+import cache
+from cartridge import Rom
+from opcodes import OPCODES_MAP, AddressingMode
+
+CFG_CACHE_VERSION = 1
+
+VECTORS = (("nmi", 0xFFFA), ("reset", 0xFFFC), ("irq", 0xFFFE))
+
+
+class Instruction(namedtuple("Instruction", ["addr", "code", "operand"])):
+    __slots__ = ()
+
+    @property
+    def op(self):
+        return OPCODES_MAP[self.code]
+
+
+class BasicBlock:
+    def __init__(self, start):
+        self.start = start
+        self.instructions = []
+        self.successors = []  # addresses of blocks control can fall or jump to
+        self.calls = []       # JSR targets called from the end of this block
+
+    @property
+    def end(self):
+        last = self.instructions[-1]
+        return last.addr + last.op.len
+
+    @property
+    def last(self):
+        return self.instructions[-1]
+
+    def __repr__(self):
+        return f"BasicBlock(${self.start:04X}-${self.end - 1:04X})"
+
+
+class ControlFlowGraph:
+    def __init__(self, rom_hash):
+        self.rom_hash = rom_hash
+        self.entry_points = {}  # vector name -> address
+        self.blocks = {}        # start address -> BasicBlock
+        self.functions = {}     # entry address -> set of block starts
+        self.call_edges = []    # (calling block start, callee entry)
+        self.return_edges = []  # (RTS block start, return site)
+        self.external = set()   # targets outside PRG ROM, not followed
+        self.invalid = set()    # targets in PRG ROM without a valid opcode
+        self.block_of = {}      # instruction address -> block start
+
+    def block_at(self, addr):
+        start = self.block_of.get(addr)
+        return None if start is None else self.blocks[start]
+
+    def instructions(self):
+        for start in sorted(self.blocks):
+            yield from self.blocks[start].instructions
+
+
+def prg_offset(rom, addr):
+    offset = addr - 0x8000
+    if len(rom.prg_rom) == 0x4000 and offset >= 0x4000:
+        offset %= 0x4000
+    return offset
+
+
+def read_prg(rom, addr):
+    return rom.prg_rom[prg_offset(rom, addr)]
+
+
+def read_prg_u16(rom, addr):
+    return read_prg(rom, addr) | (read_prg(rom, addr + 1) << 8)
+
+
+def is_branch(op):
+    return op.len == 2 and op.mode == AddressingMode.NoneAddressing
+
+
+def branch_target(ins):
+    offset = ins.operand[0]
+    if offset & 0x80:
+        offset -= 0x100
+    return (ins.addr + 2 + offset) & 0xFFFF
+
+
+def jump_target(ins):
+    return ins.operand[0] | (ins.operand[1] << 8)
+
+
+def decode(rom, addr):
+    if not 0x8000 <= addr <= 0xFFFF:
+        return None
+    op = OPCODES_MAP.get(read_prg(rom, addr))
+    if op is None or addr + op.len - 1 > 0xFFFF:
+        return None
+    return Instruction(addr, op.code, bytes(read_prg(rom, addr + i) for i in range(1, op.len)))
+
+
+def exits(ins):
+    """Addresses reachable from ins inside the same function, and a JSR target if any."""
+    op = ins.op
+    fallthrough = ins.addr + op.len
+    if op.mnemonic in ("RTS", "RTI", "BRK"):
+        return [], None
+    if op.mnemonic == "JMP":
+        # JMP ($xxxx) has no statically known target.
+        return ([jump_target(ins)] if op.code == 0x4c else []), None
+    if op.mnemonic == "JSR":
+        return [fallthrough], jump_target(ins)
+    if is_branch(op):
+        return [fallthrough, branch_target(ins)], None
+    return [fallthrough], None
+
+
+def ends_block(ins):
+    return ins.op.mnemonic in ("RTS", "RTI", "BRK", "JMP", "JSR") or is_branch(ins.op)
+
+
+def build_cfg(rom):
+    cfg = ControlFlowGraph(cache.content_hash(rom.prg_rom))
+    decoded = {}
+    leaders = set()
+    function_entries = set()
+
+    for name, vector in VECTORS:
+        addr = read_prg_u16(rom, vector)
+        cfg.entry_points[name] = addr
+        function_entries.add(addr)
+
+    # Pass 1: recursive descent over every reachable instruction.
+    work = list(function_entries)
+    leaders.update(work)
+    while work:
+        addr = work.pop()
+        while addr not in decoded:
+            ins = decode(rom, addr)
+            if ins is None:
+                (cfg.invalid if 0x8000 <= addr <= 0xFFFF else cfg.external).add(addr)
+                break
+            decoded[addr] = ins
+            targets, callee = exits(ins)
+            if callee is not None:
+                function_entries.add(callee)
+                leaders.add(callee)
+                work.append(callee)
+            if ends_block(ins):
+                leaders.update(targets)
+                work.extend(targets)
+                break
+            addr = targets[0]
+
+    # Pass 2: cut the decoded instructions into basic blocks at leaders.
+    for start in sorted(leaders):
+        if start not in decoded:
+            continue
+        block = BasicBlock(start)
+        addr = start
+        while True:
+            ins = decoded[addr]
+            block.instructions.append(ins)
+            cfg.block_of[addr] = start
+            targets, callee = exits(ins)
+            addr = ins.addr + ins.op.len
+            if ends_block(ins) or addr in leaders or addr not in decoded:
+                block.successors = [t for t in targets if t in decoded]
+                if callee is not None:
+                    block.calls.append(callee)
+                    cfg.call_edges.append((start, callee))
+                break
+        cfg.blocks[start] = block
+
+    # Group blocks into functions and connect each RTS to the return sites.
+    return_sites = {}
+    for caller, callee in cfg.call_edges:
+        return_sites.setdefault(callee, []).append(cfg.blocks[caller].end)
+    for entry in sorted(function_entries):
+        if entry not in cfg.blocks:
+            continue
+        body = set()
+        work = [entry]
+        while work:
+            start = work.pop()
+            if start in body or start not in cfg.blocks:
+                continue
+            body.add(start)
+            work.extend(cfg.blocks[start].successors)
+        cfg.functions[entry] = body
+        for start in sorted(body):
+            if cfg.blocks[start].last.op.mnemonic == "RTS":
+                for site in return_sites.get(entry, []):
+                    cfg.return_edges.append((start, site))
+    return cfg
+
+
+def load_cfg(rom, use_cache=True):
+    """Return the CFG for rom, reusing the on-disk copy for the same PRG ROM."""
+    path = cache.cache_path("cfg", f"{cache.content_hash(rom.prg_rom)}-v{CFG_CACHE_VERSION}")
+    if use_cache:
+        cfg = cache.load(path)
+        if cfg is not None:
+            return cfg
+    cfg = build_cfg(rom)
+    if use_cache:
+        cache.store(path, cfg)
+    return cfg
+
+
+def format_operand(ins):
+    op, operand = ins.op, ins.operand
+    if op.len == 1:
+        return "A" if op.code in (0x0a, 0x4a, 0x2a, 0x6a) else ""
+    if is_branch(op):
+        return f"${branch_target(ins):04X}"
+    if op.len == 2:
+        value = operand[0]
+        return {
+            AddressingMode.Immediate: f"#${value:02X}",
+            AddressingMode.ZeroPage: f"${value:02X}",
+            AddressingMode.ZeroPage_X: f"${value:02X},X",
+            AddressingMode.ZeroPage_Y: f"${value:02X},Y",
+            AddressingMode.Indirect_X: f"(${value:02X},X)",
+            AddressingMode.Indirect_Y: f"(${value:02X}),Y",
+        }[op.mode]
+    value = jump_target(ins)
+    if op.code == 0x6c:
+        return f"(${value:04X})"
+    return {
+        AddressingMode.Absolute_X: f"${value:04X},X",
+        AddressingMode.Absolute_Y: f"${value:04X},Y",
+    }.get(op.mode, f"${value:04X}")
+
+
+def format_instruction(ins):
+    hex_str = " ".join(f"{b:02X}" for b in (ins.code, *ins.operand))
+    return f"{ins.addr:04X}  {hex_str:8}  {ins.op.mnemonic} {format_operand(ins)}".rstrip()
+
+
+def listing(cfg, annotate=None):
+    # annotate(ins), if given, returns a one-character column for each
+    # instruction line (romcov marks hit/unhit code with it).
+    labels = {addr: name for name, addr in cfg.entry_points.items()}
+    lines = []
+    for start in sorted(cfg.blocks):
+        block = cfg.blocks[start]
+        if start in cfg.functions:
+            lines.append("")
+            lines.append(f"{labels.get(start, f'sub_{start:04X}')}:")
+        exits_str = ", ".join(f"${s:04X}" for s in block.successors) or "exit"
+        calls = "".join(f" (calls ${c:04X})" for c in block.calls)
+        lines.append(f"  ; block ${start:04X} -> {exits_str}{calls}")
+        for ins in block.instructions:
+            lines.append(f"{annotate(ins) if annotate else ' '} " + format_instruction(ins))
+    for label, targets in (("targets outside PRG ROM", cfg.external), ("bad decodes", cfg.invalid)):
+        if targets:
+            lines.append("")
+            lines.append(f"; {label}: " + ", ".join(f"${t:04X}" for t in sorted(targets)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], "rb") as f:
+        print(listing(load_cfg(Rom.new(f.read()))))
@@ -0,0 +1,241 @@
+"""Batched reinforcement-learning environment for snake.nes (needs NumPy).
+
+    env = VecEnv(rom, num_envs=16, frame_skip=1)
+    obs = env.reset()
+    obs, rewards, dones, infos = env.step(actions)
+
+Gym-style reset()/step() over a vector of emulators whose RAM lives in one
+(num_envs, 2048) NumPy block, so observations are views of the screen
+bytes ($0200-$05ff, 32x32 color indices) with no copying. The views change
+with every step; copy them to keep an observation around.
+
+A "frame" here is one tick of the snake game loop (SNAKE_TICK_CYCLES): the
+game is not synced to vblank and makes about a dozen moves per video
+frame. Episodes end on game over (reward -1) or after max_steps (info
+"truncated"); finished emulators are reloaded from a save state taken right
+after reset, and the last observation of the episode is in info
+"terminal_observation".
+
+SharedVecEnv runs VecEnvs in worker processes with their RAM, actions,
+rewards and dones in one multiprocessing.shared_memory block, so the
+parent reads every worker's observations in place.
+
+    python env.py snake.nes --envs 64 --workers 4 --steps 2000
+"""
+import argparse
+import gc
+import multiprocessing
+import random
+import time
+from multiprocessing import shared_memory
+
+import numpy
+
+import cpu as cpu_module
+import savestate
+from bus import Bus, RAM_SIZE
+from cartridge import Rom
+from screen import SNAKE_SCREEN, SNAKE_WIDTH, SNAKE_HEIGHT
+
+# Cycles of one pass through the snake main loop (readKeys ... spinWheels).
+SNAKE_TICK_CYCLES = 2351
+
+INPUT_ADDR = 0xff
+RANDOM_ADDR = 0xfe
+LENGTH_ADDR = 0x03  # two bytes per body segment
+
+# Action index -> key written to $ff; 0 leaves the last key in place.
+ACTIONS = (0, ord("w"), ord("a"), ord("s"), ord("d"))
+
+SCREEN_SIZE = SNAKE_WIDTH * SNAKE_HEIGHT
+
+
+class VecEnv:
+    def __init__(self, rom, num_envs=8, frame_skip=1, max_steps=1000, seed=0, cpu_class=None, ram=None):
+        self.num_envs = num_envs
+        self.frame_skip = frame_skip
+        self.max_steps = max_steps
+        self.ram = numpy.zeros((num_envs, RAM_SIZE), dtype=numpy.uint8) if ram is None else ram
+        self.observations = self.ram[:, SNAKE_SCREEN:SNAKE_SCREEN + SCREEN_SIZE].reshape(
+            num_envs, SNAKE_HEIGHT, SNAKE_WIDTH)
+        cpu_class = cpu_class or cpu_module.CPU
+        self.cpus = [cpu_class(Bus(rom, ram=memoryview(self.ram[i]))) for i in range(num_envs)]
+        self.cpus[0].reset()
+        self.start_state = savestate.save(self.cpus[0])
+        self.rngs = [random.Random(seed * num_envs + i) for i in range(num_envs)]
+        self.steps = numpy.zeros(num_envs, dtype=numpy.int64)
+        self.rewards = numpy.zeros(num_envs, dtype=numpy.float32)
+        self.dones = numpy.zeros(num_envs, dtype=bool)
+
+    def reset_one(self, index):
+        cpu = self.cpus[index]
+        savestate.load(cpu, self.start_state)
+        cpu.mem_write(RANDOM_ADDR, self.rngs[index].randint(1, 15))
+        self.steps[index] = 0
+
+    def reset(self):
+        for index in range(self.num_envs):
+            self.reset_one(index)
+        return self.observations
+
+    def step(self, actions):
+        rewards, dones = self.rewards, self.dones
+        infos = [{} for _ in range(self.num_envs)]
+        tick = SNAKE_TICK_CYCLES
+        for index, cpu in enumerate(self.cpus):
+            key = ACTIONS[actions[index]]
+            if key:
+                cpu.mem_write(INPUT_ADDR, key)
+            ram = cpu.bus.cpu_vram
+            length = ram[LENGTH_ADDR]
+            rng = self.rngs[index]
+            alive = True
+            for _ in range(self.frame_skip):
+                cpu.mem_write(RANDOM_ADDR, rng.randint(1, 15))
+                if not cpu.run_until(cpu.cycles + tick):
+                    alive = False
+                    break
+            self.steps[index] += 1
+            rewards[index] = (ram[LENGTH_ADDR] - length) // 2 if alive else -1.0
+            dones[index] = not alive or self.steps[index] >= self.max_steps
+            if dones[index]:
+                infos[index]["terminal_observation"] = self.observations[index].copy()
+                if alive:
+                    infos[index]["truncated"] = True
+                self.reset_one(index)
+        return self.observations, rewards, dones, infos
+
+    def close(self):
+        # Drop the emulators and the native core's views of the RAM block,
+        # so shared memory under it can be released.
+        for cpu in self.cpus:
+            if isinstance(cpu, cpu_module.NativeCPU):
+                cpu.release_buffers()
+        self.cpus = []
+        gc.collect()
+
+
+def shared_arrays(buffer, num_envs):
+    # Layout of a SharedVecEnv block: RAM, then actions, rewards and dones.
+    arrays = {}
+    offset = 0
+    for name, dtype, shape in (("ram", numpy.uint8, (num_envs, RAM_SIZE)),
+                               ("actions", numpy.int64, (num_envs,)),
+                               ("rewards", numpy.float32, (num_envs,)),
+                               ("dones", numpy.bool_, (num_envs,))):
+        array = numpy.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        arrays[name] = array
+        offset += array.nbytes
+    return arrays
+
+
+def shared_size(num_envs):
+    return num_envs * (RAM_SIZE + 8 + 4 + 1)
+
+
+def _worker(conn, name, rom, start, stop, kwargs):
+    block = shared_memory.SharedMemory(name=name)
+    arrays = shared_arrays(block.buf, kwargs.pop("total"))
+    env = VecEnv(rom, stop - start, ram=arrays["ram"][start:stop], **kwargs)
+    actions, rewards, dones = (arrays[name][start:stop] for name in ("actions", "rewards", "dones"))
+    try:
+        while True:
+            command = conn.recv()
+            if command == "step":
+                _, rewards[:], dones[:], infos = env.step(actions)
+                conn.send(infos)
+            elif command == "reset":
+                env.reset()
+                conn.send(None)
+            else:
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        env.close()
+        del env, arrays, actions, rewards, dones
+        block.close()
+
+
+class SharedVecEnv:
+    def __init__(self, rom, num_envs=64, num_workers=4, frame_skip=1, max_steps=1000, seed=0):
+        self.num_envs = num_envs
+        self.block = shared_memory.SharedMemory(create=True, size=shared_size(num_envs))
+        arrays = shared_arrays(self.block.buf, num_envs)
+        self.ram = arrays["ram"]
+        self.actions, self.rewards, self.dones = arrays["actions"], arrays["rewards"], arrays["dones"]
+        self.observations = self.ram[:, SNAKE_SCREEN:SNAKE_SCREEN + SCREEN_SIZE].reshape(
+            num_envs, SNAKE_HEIGHT, SNAKE_WIDTH)
+        bounds = [num_envs * i // num_workers for i in range(num_workers + 1)]
+        self.workers = []
+        for index, (start, stop) in enumerate(zip(bounds, bounds[1:])):
+            parent, child = multiprocessing.Pipe()
+            kwargs = {"total": num_envs, "frame_skip": frame_skip, "max_steps": max_steps,
+                      "seed": seed * num_workers + index}
+            process = multiprocessing.Process(
+                target=_worker, args=(child, self.block.name, rom, start, stop, kwargs), daemon=True)
+            process.start()
+            child.close()
+            self.workers.append((process, parent, start, stop))
+
+    def reset(self):
+        for _, conn, _, _ in self.workers:
+            conn.send("reset")
+        for _, conn, _, _ in self.workers:
+            conn.recv()
+        return self.observations
+
+    def step(self, actions):
+        self.actions[:] = actions
+        for _, conn, _, _ in self.workers:
+            conn.send("step")
+        infos = []
+        for _, conn, _, _ in self.workers:
+            infos.extend(conn.recv())
+        return self.observations, self.rewards, self.dones, infos
+
+    def close(self):
+        for process, conn, _, _ in self.workers:
+            conn.send("close")
+            process.join()
+            conn.close()
+        self.workers = []
+        del self.ram, self.actions, self.rewards, self.dones, self.observations
+        self.block.close()
+        self.block.unlink()
+
+
+def measure(env, steps, seed=0):
+    # Random policy; returns steps/sec summed over all environments.
+    rng = numpy.random.default_rng(seed)
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(steps):
+        env.step(rng.integers(0, len(ACTIONS), env.num_envs))
+    return steps * env.num_envs / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("rom")
+    parser.add_argument("--envs", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=0, help="0 runs everything in this process")
+    parser.add_argument("--frame-skip", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=1000)
+    args = parser.parse_args()
+
+    with open(args.rom, "rb") as f:
+        rom = Rom.new(f.read())
+    if args.workers:
+        env = SharedVecEnv(rom, args.envs, args.workers, args.frame_skip)
+    else:
+        env = VecEnv(rom, args.envs, args.frame_skip)
+    try:
+        rate = measure(env, args.steps)
+    finally:
+        env.close()
+    print(f"{args.envs} envs, {args.workers or 1} process(es): {rate:.0f} steps/s")
+
+
+if __name__ == "__main__":
+    main()
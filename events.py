@@ -0,0 +1,68 @@
+import heapq
+from itertools import count
+
+# Cycle used as the deadline when nothing is scheduled; fits the native
+# core's long long cycle counter.
+NEVER = (1 << 63) - 1
+
+NMI = "nmi"
+IRQ = "irq"          # data: name of the source asserting the IRQ line
+OAM_DMA = "oam_dma"  # data: page copied to OAM
+
+NMI_VECTOR = 0xFFFA
+IRQ_VECTOR = 0xFFFE
+
+
+class EventQueue:
+    # Cycle-keyed events for the CPU: NMIs, IRQ sources (mapper counters,
+    # APU frame IRQ) and DMA stalls. deadline is the cycle of the earliest
+    # event, so the run loop only compares it against cpu.cycles and leaves
+    # the queue alone until it is crossed.
+    def __init__(self):
+        self._heap = []
+        self._seq = count()
+        self.deadline = NEVER
+        self.irq_lines = set()  # sources currently holding IRQ low
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, cycle, kind, data=None):
+        heapq.heappush(self._heap, (cycle, next(self._seq), kind, data))
+        if cycle < self.deadline:
+            self.deadline = cycle
+
+    def trigger(self, kind, data=None):
+        # Due at the end of the instruction being executed.
+        self.schedule(0, kind, data)
+
+    def cancel(self, kind, data=None):
+        self._heap = [e for e in self._heap if (e[2], e[3]) != (kind, data)]
+        heapq.heapify(self._heap)
+        self._update_deadline()
+
+    def acknowledge_irq(self, source):
+        self.irq_lines.discard(source)
+
+    def pop_due(self, cycle):
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= cycle:
+            _, _, kind, data = heapq.heappop(heap)
+            due.append((kind, data))
+        self._update_deadline()
+        return due
+
+    def snapshot(self):
+        return tuple(self._heap), frozenset(self.irq_lines)
+
+    def restore(self, snapshot):
+        heap, irq_lines = snapshot
+        self._heap = list(heap)
+        self.irq_lines = set(irq_lines)
+        self._update_deadline()
+        if self.irq_lines:
+            self.deadline = 0  # re-check the asserted line after the next instruction
+
+    def _update_deadline(self):
+        self.deadline = self._heap[0][0] if self._heap else NEVER
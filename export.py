@@ -0,0 +1,196 @@
+"""Headless frame export: raw RGB, PNG sequences or a pipe to an encoder.
+
+    python export.py snake.nes --frames 600 --png frames/%05d.png
+    python export.py snake.nes --frames 600 --raw snake.rgb
+    python export.py snake.nes --frames 600 --scale 10 \\
+        --pipe "ffmpeg -f rawvideo -pix_fmt rgb24 -s 320x320 -r 60 -i - snake.mp4"
+
+Nothing here touches pygame, so it runs on servers without a display (or
+next to main.py under SDL_VIDEODRIVER=dummy). Frames are encoded by a worker
+thread behind a bounded queue; when the encoder falls behind, the emulation
+waits for it, so every frame is written. A live preview that would rather
+lose frames than lag passes drop=True (--drop): frames that find the queue
+full are then dropped and counted.
+"""
+import argparse
+import os
+import queue
+import random
+import shlex
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+from collections import namedtuple
+
+import profiles
+from cartridge import Rom
+from cpu import CYCLES_PER_FRAME
+from screen import SNAKE_WIDTH, SNAKE_HEIGHT, snake_frame
+
+Frame = namedtuple("Frame", ["index", "width", "height", "rgb"])
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def png_bytes(width, height, rgb):
+    stride = width * 3
+    # Filter type 0 (None) in front of every scanline.
+    raw = b"".join(b"\x00" + rgb[y * stride:(y + 1) * stride] for y in range(height))
+    return (PNG_SIGNATURE
+            + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + png_chunk(b"IDAT", zlib.compress(raw, 6))
+            + png_chunk(b"IEND", b""))
+
+
+def scale_frame(frame, factor):
+    if factor == 1:
+        return frame
+    stride = frame.width * 3
+    rows = []
+    for y in range(frame.height):
+        row = frame.rgb[y * stride:(y + 1) * stride]
+        wide = b"".join(row[x:x + 3] * factor for x in range(0, stride, 3))
+        rows.append(wide * factor)
+    return Frame(frame.index, frame.width * factor, frame.height * factor, b"".join(rows))
+
+
+class RawSink:
+    def __init__(self, path):
+        self.file = open(path, "wb")
+
+    def write(self, frame):
+        self.file.write(frame.rgb)
+
+    def close(self):
+        self.file.close()
+
+
+class PngSequenceSink:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        directory = os.path.dirname(pattern)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, frame):
+        with open(self.pattern % frame.index, "wb") as f:
+            f.write(png_bytes(frame.width, frame.height, frame.rgb))
+
+    def close(self):
+        pass
+
+
+class PipeSink:
+    # Raw RGB frames on the stdin of an encoder such as ffmpeg.
+    def __init__(self, command):
+        self.process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.rgb)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"Encoder exited with status {self.process.returncode}")
+
+
+class FrameExporter:
+    def __init__(self, sink, maxsize=120, scale=1, drop=False):
+        self.sink = sink
+        self.scale = scale
+        self.drop = drop
+        self.queue = queue.Queue(maxsize)
+        self.written = 0
+        self.dropped = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._work, name="frame-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, frame):
+        """Queue a frame, waiting for room; returns False if it was dropped (drop=True only)."""
+        if not self.drop:
+            self.queue.put(frame)
+            return True
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+        self.sink.close()
+        if self._error is not None:
+            raise self._error
+
+    def _work(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self._error is not None:
+                continue  # keep draining so submit() never blocks
+            try:
+                self.sink.write(scale_frame(frame, self.scale))
+                self.written += 1
+            except Exception as e:
+                self._error = e
+
+
+def export_frames(cpu, exporter, frames, seed=0):
+    # The per-frame host work main.main does: a new random byte at $fe.
+    rng = random.Random(seed)
+    frame_end = cpu.cycles
+    for index in range(frames):
+        cpu.mem_write(0xfe, rng.randint(1, 15))
+        frame_end += CYCLES_PER_FRAME
+        running = cpu.run_until(frame_end)
+        exporter.submit(Frame(index, SNAKE_WIDTH, SNAKE_HEIGHT, snake_frame(cpu.bus)))
+        if not running:
+            return index + 1
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("rom")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--queue", type=int, default=120, help="frames buffered for the encoder")
+    parser.add_argument("--drop", action="store_true",
+                        help="drop frames when the encoder falls behind instead of waiting (live preview)")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--raw", help="file of concatenated RGB24 frames")
+    output.add_argument("--png", help="file name pattern, e.g. frames/%%05d.png")
+    output.add_argument("--pipe", help="encoder command reading RGB24 frames on stdin")
+    args = parser.parse_args()
+
+    with open(args.rom, "rb") as f:
+        rom = Rom.new(f.read())
+    if args.raw:
+        sink = RawSink(args.raw)
+    elif args.png:
+        sink = PngSequenceSink(args.png)
+    else:
+        sink = PipeSink(args.pipe)
+
+    cpu = profiles.create(rom, "headless")
+    cpu.reset()
+    exporter = FrameExporter(sink, args.queue, args.scale, args.drop)
+    try:
+        frames = export_frames(cpu, exporter, args.frames)
+    finally:
+        exporter.close()
+    print(f"{frames} frames, {exporter.written} written, {exporter.dropped} dropped", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
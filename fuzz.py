@@ -0,0 +1,504 @@
+"""Differential fuzzing of the CPU cores against ReferenceCPU.
+
+ReferenceCPU is a second 6502 model written independently in this file;
+vectors/ holds single-step vectors recorded from it, not from hardware or
+an external test suite. A core that disagrees with them disagrees with
+ReferenceCPU, and either model may be the wrong one.
+
+The vectors use the JSON "single-step tests" layout: each file holds a list of
+{"name", "initial", "final"} records where a state is
+{"pc", "s", "a", "x", "y", "p", "ram": [[addr, value], ...]}.
+
+    python fuzz.py record            # regenerate vectors/ from ReferenceCPU
+    python fuzz.py replay [a9 ...]   # run the recorded vectors on a core (--cpu)
+    python fuzz.py random -n 20000   # random instruction streams vs ReferenceCPU
+
+replay and random spread the work over all cores (-j to override).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from multiprocessing import Pool
+from types import SimpleNamespace
+
+import cpu as cpu_module
+from cpu import CpuFlags
+from events import EventQueue
+from opcodes import CPU_OPS_CODES, OPCODES_MAP, AddressingMode
+
+VECTORS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vectors")
+
+# BRK ends CPU.run_with_callback instead of taking the IRQ vector, so its
+# vectors only run when asked for explicitly and random streams stop there.
+HALT_CODES = frozenset({0x00})
+
+CARRY = 0x01
+ZERO = 0x02
+INTERRUPT_DISABLE = 0x04
+DECIMAL_MODE = 0x08
+BREAK = 0x10
+BREAK2 = 0x20
+OVERFLOW = 0x40
+NEGATIVE = 0x80
+
+
+class FlatBus:
+    # 64K of plain RAM, the memory model the single-step vectors assume.
+    def __init__(self, memory=None):
+        self.memory = bytearray(0x10000) if memory is None else memory
+        self.events = EventQueue()
+        # What NativeCPU maps for its RAM/PRG fast paths; make_cpu routes
+        # every page through mem_read/mem_write instead.
+        self.cpu_vram = bytearray(0x800)
+        self.rom = SimpleNamespace(prg_rom=b"")
+
+    def mem_read(self, addr):
+        return self.memory[addr & 0xffff]
+
+    def mem_write(self, addr, data):
+        self.memory[addr & 0xffff] = data
+
+
+class ReferenceCPU:
+    # Straightforward NMOS 6502 model (binary arithmetic only, as on the
+    # 2A03) written independently of cpu.CPU. It is what the bundled vectors
+    # were recorded from.
+    def __init__(self, memory, a=0, x=0, y=0, s=0xfd, p=0x24, pc=0):
+        self.memory = memory
+        self.a, self.x, self.y, self.s, self.p, self.pc = a, x, y, s, p, pc
+
+    def read(self, addr):
+        return self.memory[addr & 0xffff]
+
+    def write(self, addr, data):
+        self.memory[addr & 0xffff] = data
+
+    def read16(self, addr):
+        return self.read(addr) | (self.read(addr + 1) << 8)
+
+    def read16_zp(self, addr):
+        return self.read(addr & 0xff) | (self.read((addr + 1) & 0xff) << 8)
+
+    def push(self, data):
+        self.write(0x100 + self.s, data)
+        self.s = (self.s - 1) & 0xff
+
+    def pull(self):
+        self.s = (self.s + 1) & 0xff
+        return self.read(0x100 + self.s)
+
+    def set_flag(self, flag, on):
+        self.p = (self.p | flag) if on else (self.p & ~flag & 0xff)
+
+    def set_zn(self, value):
+        self.set_flag(ZERO, value == 0)
+        self.set_flag(NEGATIVE, value & 0x80)
+        return value
+
+    def address(self, mode):
+        operand = (self.pc + 1) & 0xffff
+        if mode == AddressingMode.Immediate:
+            return operand
+        if mode == AddressingMode.ZeroPage:
+            return self.read(operand)
+        if mode == AddressingMode.ZeroPage_X:
+            return (self.read(operand) + self.x) & 0xff
+        if mode == AddressingMode.ZeroPage_Y:
+            return (self.read(operand) + self.y) & 0xff
+        if mode == AddressingMode.Absolute:
+            return self.read16(operand)
+        if mode == AddressingMode.Absolute_X:
+            return (self.read16(operand) + self.x) & 0xffff
+        if mode == AddressingMode.Absolute_Y:
+            return (self.read16(operand) + self.y) & 0xffff
+        if mode == AddressingMode.Indirect_X:
+            return self.read16_zp(self.read(operand) + self.x)
+        if mode == AddressingMode.Indirect_Y:
+            return (self.read16_zp(self.read(operand)) + self.y) & 0xffff
+        raise ValueError(f"Mode {mode} has no operand address")
+
+    def add(self, value):
+        total = self.a + value + (self.p & CARRY)
+        result = total & 0xff
+        self.set_flag(CARRY, total > 0xff)
+        self.set_flag(OVERFLOW, (self.a ^ result) & (value ^ result) & 0x80)
+        self.a = self.set_zn(result)
+
+    def compare(self, register, value):
+        self.set_flag(CARRY, register >= value)
+        self.set_zn((register - value) & 0xff)
+
+    def modify(self, op, fn):
+        # Read-modify-write on the accumulator or on memory.
+        if op.mode == AddressingMode.NoneAddressing:
+            self.a = self.set_zn(fn(self.a))
+        else:
+            addr = self.address(op.mode)
+            self.write(addr, self.set_zn(fn(self.read(addr))))
+
+    def shift_left(self, value, carry_in):
+        self.set_flag(CARRY, value & 0x80)
+        return ((value << 1) | carry_in) & 0xff
+
+    def shift_right(self, value, carry_in):
+        self.set_flag(CARRY, value & 0x01)
+        return (value >> 1) | (carry_in << 7)
+
+    def step(self):
+        op = OPCODES_MAP[self.read(self.pc)]
+        name = op.mnemonic
+        next_pc = (self.pc + op.len) & 0xffff
+        carry = self.p & CARRY
+
+        if name in ("LDA", "LDX", "LDY"):
+            value = self.set_zn(self.read(self.address(op.mode)))
+            setattr(self, name[2].lower(), value)
+        elif name in ("STA", "STX", "STY"):
+            self.write(self.address(op.mode), getattr(self, name[2].lower()))
+        elif name in ("AND", "ORA", "EOR"):
+            value = self.read(self.address(op.mode))
+            if name == "AND":
+                self.a = self.set_zn(self.a & value)
+            elif name == "ORA":
+                self.a = self.set_zn(self.a | value)
+            else:
+                self.a = self.set_zn(self.a ^ value)
+        elif name == "ADC":
+            self.add(self.read(self.address(op.mode)))
+        elif name == "SBC":
+            self.add(self.read(self.address(op.mode)) ^ 0xff)
+        elif name in ("CMP", "CPX", "CPY"):
+            register = {"CMP": self.a, "CPX": self.x, "CPY": self.y}[name]
+            self.compare(register, self.read(self.address(op.mode)))
+        elif name == "BIT":
+            value = self.read(self.address(op.mode))
+            self.set_flag(ZERO, (self.a & value) == 0)
+            self.set_flag(NEGATIVE, value & 0x80)
+            self.set_flag(OVERFLOW, value & 0x40)
+        elif name == "ASL":
+            self.modify(op, lambda v: self.shift_left(v, 0))
+        elif name == "ROL":
+            self.modify(op, lambda v: self.shift_left(v, carry))
+        elif name == "LSR":
+            self.modify(op, lambda v: self.shift_right(v, 0))
+        elif name == "ROR":
+            self.modify(op, lambda v: self.shift_right(v, carry))
+        elif name == "INC":
+            self.modify(op, lambda v: (v + 1) & 0xff)
+        elif name == "DEC":
+            self.modify(op, lambda v: (v - 1) & 0xff)
+        elif name in ("INX", "INY", "DEX", "DEY"):
+            register = name[2].lower()
+            delta = 1 if name[0] == "I" else -1
+            setattr(self, register, self.set_zn((getattr(self, register) + delta) & 0xff))
+        elif name in ("TAX", "TAY", "TXA", "TYA", "TSX"):
+            source = "s" if name[1] == "S" else name[1].lower()
+            setattr(self, name[2].lower(), self.set_zn(getattr(self, source)))
+        elif name == "TXS":
+            self.s = self.x
+        elif name in ("CLC", "SEC", "CLI", "SEI", "CLV", "CLD", "SED"):
+            flag = {"C": CARRY, "I": INTERRUPT_DISABLE, "V": OVERFLOW, "D": DECIMAL_MODE}[name[2]]
+            self.set_flag(flag, name[0] == "S")
+        elif name == "PHA":
+            self.push(self.a)
+        elif name == "PHP":
+            self.push(self.p | BREAK | BREAK2)
+        elif name == "PLA":
+            self.a = self.set_zn(self.pull())
+        elif name == "PLP":
+            self.p = (self.pull() & ~BREAK & 0xff) | BREAK2
+        elif name == "JMP":
+            ptr = self.read16(self.pc + 1)
+            if op.code == 0x6c:
+                # The indirect vector never crosses a page.
+                ptr = self.read(ptr) | (self.read((ptr & 0xff00) | ((ptr + 1) & 0xff)) << 8)
+            next_pc = ptr
+        elif name == "JSR":
+            target = self.read16(self.pc + 1)
+            return_addr = (self.pc + 2) & 0xffff
+            self.push(return_addr >> 8)
+            self.push(return_addr & 0xff)
+            next_pc = target
+        elif name == "RTS":
+            lo = self.pull()
+            next_pc = ((self.pull() << 8) | lo) + 1 & 0xffff
+        elif name == "RTI":
+            self.p = (self.pull() & ~BREAK & 0xff) | BREAK2
+            lo = self.pull()
+            next_pc = (self.pull() << 8) | lo
+        elif name == "BRK":
+            return_addr = (self.pc + 2) & 0xffff
+            self.push(return_addr >> 8)
+            self.push(return_addr & 0xff)
+            self.push(self.p | BREAK | BREAK2)
+            self.p |= INTERRUPT_DISABLE
+            next_pc = self.read16(0xfffe)
+        elif op.len == 2 and op.mode == AddressingMode.NoneAddressing:
+            flag, expected = {
+                "BPL": (NEGATIVE, 0), "BMI": (NEGATIVE, 1),
+                "BVC": (OVERFLOW, 0), "BVS": (OVERFLOW, 1),
+                "BCC": (CARRY, 0), "BCS": (CARRY, 1),
+                "BNE": (ZERO, 0), "BEQ": (ZERO, 1),
+            }[name]
+            if bool(self.p & flag) == bool(expected):
+                offset = self.read(self.pc + 1)
+                next_pc = (next_pc + offset - (0x100 if offset & 0x80 else 0)) & 0xffff
+        elif name != "NOP":
+            raise ValueError(f"Reference model has no {name}")
+
+        self.pc = next_pc
+
+
+class RecordingMemory:
+    # Sparse memory that invents a random byte the first time an address is
+    # touched and remembers it, so a vector only lists the RAM it uses.
+    def __init__(self, rng):
+        self.rng = rng
+        self.initial = {}
+        self.current = {}
+
+    def __getitem__(self, addr):
+        if addr not in self.current:
+            self.current[addr] = self.initial[addr] = self.rng.randrange(0x100)
+        return self.current[addr]
+
+    def __setitem__(self, addr, data):
+        if addr not in self.current:
+            self.initial[addr] = self.rng.randrange(0x100)
+        self.current[addr] = data
+
+    def seed(self, addr, data):
+        self.initial[addr] = self.current[addr] = data
+
+
+def record_vector(rng, opcode):
+    memory = RecordingMemory(rng)
+    pc = rng.randrange(0x10000)
+    state = {
+        "pc": pc,
+        "s": rng.randrange(0x100),
+        "a": rng.randrange(0x100),
+        "x": rng.randrange(0x100),
+        "y": rng.randrange(0x100),
+        "p": (rng.randrange(0x100) & ~BREAK) | BREAK2,
+    }
+    memory.seed(pc, opcode)
+    ref = ReferenceCPU(memory, **state)
+    ref.step()
+
+    initial = dict(state, ram=sorted([a, v] for a, v in memory.initial.items()))
+    final = {"pc": ref.pc, "s": ref.s, "a": ref.a, "x": ref.x, "y": ref.y, "p": ref.p,
+             "ram": sorted([a, v] for a, v in memory.current.items())}
+    operands = " ".join(f"{memory.initial.get((pc + i) & 0xffff, 0):02x}"
+                        for i in range(OPCODES_MAP[opcode].len))
+    return {"name": operands, "initial": initial, "final": final}
+
+
+def load_vectors(code):
+    with open(os.path.join(VECTORS_DIR, f"{code:02x}.json")) as f:
+        return json.load(f)
+
+
+def bundled_opcodes():
+    if not os.path.isdir(VECTORS_DIR):
+        return []
+    codes = (int(name[:2], 16) for name in os.listdir(VECTORS_DIR) if name.endswith(".json"))
+    return sorted(code for code in codes if code not in HALT_CODES)
+
+
+class _Stop(Exception):
+    pass
+
+
+def _stop(_cpu):
+    raise _Stop
+
+
+CPU_CLASSES = {
+    "python": cpu_module.PyCPU,
+    "lazy": cpu_module.LazyFlagsCPU,
+    "inline": cpu_module.InlineCPU,
+    "fast": cpu_module.FastCPU,
+}
+if cpu_module.NATIVE_AVAILABLE:
+    CPU_CLASSES["native"] = cpu_module.NativeCPU
+
+
+def make_cpu(memory, state, cpu_class=None):
+    cpu = (cpu_class or cpu_module.PyCPU)(FlatBus(memory))
+    if isinstance(cpu, cpu_module.NativeCPU):
+        cpu.set_watch_pages(range(256))
+    cpu.program_counter = state["pc"]
+    cpu.stack_pointer = state["s"]
+    cpu.register_a = state["a"]
+    cpu.register_x = state["x"]
+    cpu.register_y = state["y"]
+    cpu.status = CpuFlags(state["p"])
+    return cpu
+
+
+def cpu_state(cpu):
+    return {"pc": cpu.program_counter, "s": cpu.stack_pointer, "a": cpu.register_a,
+            "x": cpu.register_x, "y": cpu.register_y, "p": int(cpu.status)}
+
+
+def step_cpu(cpu):
+    # Run exactly one instruction; BRK makes run_with_callback return
+    # without calling back, any other opcode stops at the callback.
+    try:
+        cpu.run_with_callback(_stop)
+    except _Stop:
+        pass
+
+
+def run_vector(vector, cpu_class=None):
+    """Return a list of differences between cpu.CPU and the vector's final state."""
+    memory = bytearray(0x10000)
+    for addr, value in vector["initial"]["ram"]:
+        memory[addr] = value
+    cpu = make_cpu(memory, vector["initial"], cpu_class)
+    try:
+        step_cpu(cpu)
+    except Exception as e:
+        return [f"raised {type(e).__name__}: {e}"]
+
+    got = cpu_state(cpu)
+    want = vector["final"]
+    diffs = [f"{reg}: got {got[reg]:02X} want {want[reg]:02X}"
+             for reg in ("pc", "s", "a", "x", "y", "p") if got[reg] != want[reg]]
+    diffs += [f"ram[{addr:04X}]: got {memory[addr]:02X} want {value:02X}"
+              for addr, value in want["ram"] if memory[addr] != value]
+    return diffs
+
+
+def replay_opcode(code, limit=None, cpu_name="python"):
+    vectors = load_vectors(code)[:limit]
+    failures = []
+    for vector in vectors:
+        diffs = run_vector(vector, CPU_CLASSES[cpu_name])
+        if diffs:
+            failures.append((vector["name"], diffs))
+    return code, len(vectors), failures
+
+
+def random_streams(args):
+    """Run random instruction streams on cpu.CPU and ReferenceCPU in lock step."""
+    seed, streams, length, cpu_name = args
+    rng = random.Random(seed)
+    codes = [op.code for op in CPU_OPS_CODES if op.code not in HALT_CODES]
+    checked = 0
+    failures = []
+    for _ in range(streams):
+        memory = bytearray(rng.getrandbits(8 * 0x10000).to_bytes(0x10000, "little"))
+        pc = rng.randrange(0x10000)
+        for i in range(length * 3):
+            memory[(pc + i) & 0xffff] = rng.choice(codes)
+        state = {"pc": pc, "s": rng.randrange(0x100), "a": rng.randrange(0x100),
+                 "x": rng.randrange(0x100), "y": rng.randrange(0x100),
+                 "p": (rng.randrange(0x100) & ~BREAK) | BREAK2}
+        ref = ReferenceCPU(bytearray(memory), **state)
+        cpu = make_cpu(memory, state, CPU_CLASSES[cpu_name])
+        for _ in range(length):
+            code = ref.read(ref.pc)
+            if code not in OPCODES_MAP or code in HALT_CODES:
+                break
+            ref.step()
+            checked += 1
+            try:
+                step_cpu(cpu)
+                got = cpu_state(cpu)
+            except Exception as e:
+                got = f"raised {type(e).__name__}: {e}"
+            want = {"pc": ref.pc, "s": ref.s, "a": ref.a, "x": ref.x, "y": ref.y, "p": ref.p}
+            if got != want or memory != ref.memory:
+                failures.append((code, got, want))
+                break
+    return checked, failures
+
+
+def record(count, seed):
+    os.makedirs(VECTORS_DIR, exist_ok=True)
+    rng = random.Random(seed)
+    for op in CPU_OPS_CODES:
+        vectors = [record_vector(rng, op.code) for _ in range(count)]
+        with open(os.path.join(VECTORS_DIR, f"{op.code:02x}.json"), "w") as f:
+            json.dump(vectors, f, separators=(",", ":"))
+    print(f"Recorded {count} vectors for {len(CPU_OPS_CODES)} opcodes in {VECTORS_DIR}")
+
+
+def replay(codes, jobs, limit, cpu_name="python"):
+    start = time.perf_counter()
+    total = failed_ops = 0
+    with Pool(jobs) as pool:
+        for code, count, failures in pool.imap_unordered(
+                _replay_worker, [(code, limit, cpu_name) for code in codes]):
+            total += count
+            if failures:
+                failed_ops += 1
+                name, diffs = failures[0]
+                mnemonic = OPCODES_MAP[code].mnemonic
+                print(f"{code:02x} {mnemonic}: {len(failures)}/{count} failed, "
+                      f"first [{name}] {'; '.join(diffs)}")
+    elapsed = time.perf_counter() - start
+    print(f"{total} vectors, {failed_ops}/{len(codes)} opcodes failing, "
+          f"{total / elapsed * 60:.0f} vectors/min")
+    return failed_ops == 0
+
+
+def _replay_worker(args):
+    return replay_opcode(*args)
+
+
+def fuzz(streams, length, jobs, seed, cpu_name="python"):
+    jobs = jobs or os.cpu_count()
+    per_job = -(-streams // jobs)
+    start = time.perf_counter()
+    with Pool(jobs) as pool:
+        results = pool.map(random_streams,
+                           [(seed + i, per_job, length, cpu_name) for i in range(jobs)])
+    elapsed = time.perf_counter() - start
+    checked = sum(c for c, _ in results)
+    failures = [f for _, fs in results for f in fs]
+    by_opcode = {}
+    for code, got, want in failures:
+        by_opcode.setdefault(code, (got, want))
+    for code, (got, want) in sorted(by_opcode.items()):
+        print(f"{code:02x} {OPCODES_MAP[code].mnemonic}: got {got} want {want}")
+    print(f"{checked} instructions in {len(failures)} failing streams, "
+          f"{checked / elapsed * 60:.0f} instructions/min")
+    return not failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record")
+    rec.add_argument("-n", "--count", type=int, default=32)
+    rec.add_argument("--seed", type=int, default=0x6502)
+    rep = sub.add_parser("replay")
+    rep.add_argument("opcodes", nargs="*")
+    rep.add_argument("-j", "--jobs", type=int)
+    rep.add_argument("--limit", type=int)
+    rep.add_argument("--cpu", choices=sorted(CPU_CLASSES), default="python")
+    rnd = sub.add_parser("random")
+    rnd.add_argument("-n", "--streams", type=int, default=10000)
+    rnd.add_argument("-l", "--length", type=int, default=16)
+    rnd.add_argument("-j", "--jobs", type=int)
+    rnd.add_argument("--seed", type=int, default=0)
+    rnd.add_argument("--cpu", choices=sorted(CPU_CLASSES), default="python")
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        record(args.count, args.seed)
+        return True
+    if args.command == "replay":
+        codes = [int(c, 16) for c in args.opcodes] or bundled_opcodes()
+        return replay(codes, args.jobs, args.limit, args.cpu)
+    return fuzz(args.streams, args.length, args.jobs, args.seed, args.cpu)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -1,42 +1,16 @@
-import pygame
 import sys
 import random
-from bus import Bus
+import profiles
 from cartridge import Rom
-from cpu import CPU
-
-# Colors in 8bit
-BLACK = (0, 0, 0)
-WHITE = (255, 255, 255)
-GREY = (128, 128, 128)
-RED = (255, 0, 0)
-GREEN = (0, 255, 0)
-BLUE = (0, 0, 255)
-MAGENTA = (255, 0, 255)
-YELLOW = (255, 255, 0)
-CYAN = (0, 255, 255)
-
-# Color mapping function
-def color(byte):
-    return {
-        0: BLACK,
-        1: WHITE,
-        2: GREY,
-        9: GREY,
-        3: RED,
-        10: RED,
-        4: GREEN,
-        11: GREEN,
-        5: BLUE,
-        12: BLUE,
-        6: MAGENTA,
-        13: MAGENTA,
-        7: YELLOW,
-        14: YELLOW,
-    }.get(byte, CYAN)
+from cpu import CYCLES_PER_FRAME
+from screen import color
+
+# pygame is imported by the window functions only, so the headless
+# profile runs without pygame or SDL installed.
 
 # Function to read the screen state from the CPU memory
 def read_screen_state(cpu, screen_surface):
+    import pygame
     update = False
     frame_idx = 0
     pixel_array = pygame.surfarray.pixels3d(screen_surface)
@@ -57,6 +31,7 @@ def read_screen_state(cpu, screen_surface):
 
 # Function to handle user input
 def handle_user_input(cpu, events):
+    import pygame
     for event in events:
         if event.type == pygame.QUIT:
             pygame.quit()
@@ -74,11 +49,24 @@ def handle_user_input(cpu, events):
             elif event.key == pygame.K_d:
                 cpu.mem_write(0xff, ord('d'))
 
-def main():
-    pygame.init()
-    window = pygame.display.set_mode((320, 320))
-    pygame.display.set_caption("NES Emulator Test")
-    clock = pygame.time.Clock()
+# Game loop without a window or keyboard: a new random byte every frame until game over
+def run_headless(cpu):
+    frames = 0
+    running = True
+    while running:
+        cpu.mem_write(0xfe, random.randint(1, 15))
+        running = cpu.run_until(cpu.cycles + CYCLES_PER_FRAME)
+        frames += 1
+    print(f"Game over after {frames} frames")
+
+def main(profile=profiles.DEFAULT_PROFILE):
+    profile = profiles.get(profile)
+    if profile.render:
+        import pygame
+        pygame.init()
+        window = pygame.display.set_mode((320, 320))
+        pygame.display.set_caption("NES Emulator Test")
+        clock = pygame.time.Clock()
 
     # Load the game ROM
     try:
@@ -92,9 +80,11 @@ def main():
         print(f"Failed to load ROM: {e}")
         return
     
-    bus = Bus(rom)
-    cpu = CPU(bus)
+    cpu = profiles.create(rom, profile)
     cpu.reset()
+    if not profile.render:
+        run_headless(cpu)
+        return
 
     screen_surface = pygame.Surface((32, 32))
 
@@ -128,5 +118,6 @@ def main():
     pygame.quit()
 
 if __name__ == "__main__":
-    main()
+    # python main.py [accurate|fast|headless|native]
+    main(sys.argv[1] if len(sys.argv) > 1 else profiles.DEFAULT_PROFILE)
 
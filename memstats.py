@@ -0,0 +1,108 @@
+"""Per-address read/write counters for bus.Bus (needs NumPy).
+
+    python memstats.py snake.nes --frames 60 --heatmap heatmap.png
+
+Enabled with Bus(rom, stats=True); a plain Bus is not instrumented at all.
+The heatmap has one pixel per address, one row per 256-byte page: reads in
+green, writes in red, log-scaled.
+"""
+import argparse
+
+REGIONS = (
+    ("ram", 0x0000, 0x07ff),
+    ("ram mirrors", 0x0800, 0x1fff),
+    ("ppu registers", 0x2000, 0x3fff),
+    ("oam dma", 0x4014, 0x4014),
+    ("prg rom", 0x8000, 0xffff),
+)
+
+
+class AccessStats:
+    def __init__(self):
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError("Bus(stats=True) needs NumPy: pip install numpy") from None
+        self.np = numpy
+        self.reads = numpy.zeros(0x10000, dtype=numpy.uint64)
+        self.writes = numpy.zeros(0x10000, dtype=numpy.uint64)
+        # Incrementing through a memoryview is cheaper than numpy item
+        # assignment and updates the same buffer.
+        self.read_counts = memoryview(self.reads)
+        self.write_counts = memoryview(self.writes)
+
+    def reset(self):
+        self.reads[:] = 0
+        self.writes[:] = 0
+
+    def page_reads(self):
+        return self.reads.reshape(256, 256).sum(axis=1)
+
+    def page_writes(self):
+        return self.writes.reshape(256, 256).sum(axis=1)
+
+    def regions(self):
+        """{region: (reads, writes)}, with everything else as "unmapped"."""
+        mapped = self.np.zeros(0x10000, dtype=bool)
+        counts = {}
+        for name, start, end in REGIONS:
+            counts[name] = (int(self.reads[start:end + 1].sum()), int(self.writes[start:end + 1].sum()))
+            mapped[start:end + 1] = True
+        counts["unmapped"] = (int(self.reads[~mapped].sum()), int(self.writes[~mapped].sum()))
+        return counts
+
+    def report(self):
+        lines = [f"{'region':14} {'reads':>12} {'writes':>12}"]
+        for name, (reads, writes) in self.regions().items():
+            lines.append(f"{name:14} {reads:12} {writes:12}")
+        np = self.np
+        for label, pages in (("reads", self.page_reads()), ("writes", self.page_writes())):
+            top = np.argsort(pages)[::-1][:8]
+            lines.append(f"top pages by {label}: "
+                         + ", ".join(f"${page:02X}xx {int(pages[page])}" for page in top if pages[page]))
+        return "\n".join(lines)
+
+    def heatmap_rgb(self):
+        np = self.np
+
+        def scale(counts):
+            log = np.log1p(counts.astype(np.float64))
+            peak = log.max()
+            return (log / peak * 255 if peak else log).astype(np.uint8)
+
+        rgb = np.zeros((256, 256, 3), dtype=np.uint8)
+        rgb[..., 0] = scale(self.writes).reshape(256, 256)
+        rgb[..., 1] = scale(self.reads).reshape(256, 256)
+        return rgb
+
+    def save_heatmap(self, path):
+        from export import png_bytes
+        with open(path, "wb") as f:
+            f.write(png_bytes(256, 256, self.heatmap_rgb().tobytes()))
+
+
+def main():
+    from bus import Bus
+    from cartridge import Rom
+    from cpu import CPU, CYCLES_PER_FRAME
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("rom")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--heatmap", help="write a PNG heatmap here")
+    args = parser.parse_args()
+
+    with open(args.rom, "rb") as f:
+        bus = Bus(Rom.new(f.read()), stats=True)
+    cpu = CPU(bus)
+    cpu.reset()
+    for _ in range(args.frames):
+        if not cpu.run_until(cpu.cycles + CYCLES_PER_FRAME):
+            break
+    print(bus.stats.report())
+    if args.heatmap:
+        bus.stats.save_heatmap(args.heatmap)
+
+
+if __name__ == "__main__":
+    main()
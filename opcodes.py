@@ -207,3 +207,10 @@ CPU_OPS_CODES = [
 
 OPCODES_MAP = {op.code: op for op in CPU_OPS_CODES}
 
+# Opcodes that set the program counter themselves, so the CPU loop must not
+# step over their operands afterwards.
+CONTROL_FLOW_CODES = frozenset(
+    op.code for op in CPU_OPS_CODES
+    if op.mnemonic in ("JMP", "JSR", "RTS", "RTI", "BRK")
+    or (op.mnemonic.startswith("B") and op.len == 2 and op.mode == AddressingMode.NoneAddressing)
+)
@@ -0,0 +1,75 @@
+"""Accuracy/speed profiles: one factory wires a CPU to its Bus.
+
+    cpu = profiles.create(rom, "fast")
+    cpu.reset()
+
+accurate  cpu.PyCPU, the reference core: every instruction computes its
+          flags, every cycle is executed and events are serviced at the
+          instruction boundary that reaches them.
+fast      cpu.FastCPU: lazy flags plus idle-loop skipping.
+headless  the fast core for runs without a display: frontends check
+          profile.render and skip drawing the screen.
+native    cpu.NativeCPU, only when it is built (python build_native.py).
+          It dispatches in C, about 30 times FastCPU on snake.nes, but
+          computes flags eagerly and runs idle loops instead of skipping
+          them.
+
+A profile name selects the same core on every build; profile.features
+names its fast paths ("native", "lazy_flags", "idle_loop_skip").
+
+There is no PPU or APU yet, so there is no catch-up or audio to switch;
+events.py already delivers the interrupts and DMA a PPU would raise. A new
+fast path joins a profile by changing its entry in PROFILES.
+"""
+from collections import namedtuple
+
+import cpu as cpu_module
+from bus import Bus
+
+
+def features(cpu_class):
+    enabled = set()
+    if issubclass(cpu_class, cpu_module.NativeCPU):
+        enabled.add("native")
+    if issubclass(cpu_class, cpu_module.LazyFlagsCPU):
+        enabled.add("lazy_flags")
+    if issubclass(cpu_class, cpu_module.IdleLoopMixin):
+        enabled.add("idle_loop_skip")
+    return frozenset(enabled)
+
+
+class Profile(namedtuple("Profile", ["name", "cpu_class", "render"])):
+    __slots__ = ()
+
+    @property
+    def features(self):
+        return features(self.cpu_class)
+
+
+PROFILES = {
+    "accurate": Profile("accurate", cpu_module.PyCPU, render=True),
+    "fast": Profile("fast", cpu_module.FastCPU, render=True),
+    "headless": Profile("headless", cpu_module.FastCPU, render=False),
+}
+if cpu_module.NATIVE_AVAILABLE:
+    PROFILES["native"] = Profile("native", cpu_module.NativeCPU, render=True)
+
+DEFAULT_PROFILE = "fast"
+
+
+def get(profile):
+    if isinstance(profile, Profile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"Unknown profile {profile!r} (expected one of {', '.join(PROFILES)})") from None
+
+
+def create(rom, profile=DEFAULT_PROFILE, cpu_class=None, **bus_options):
+    """A CPU of the profile's class on a new Bus(rom, **bus_options); the Bus is cpu.bus.
+
+    cpu_class overrides the profile's core, for running one program on
+    several cores.
+    """
+    return (cpu_class or get(profile).cpu_class)(Bus(rom, **bus_options))
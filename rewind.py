@@ -0,0 +1,108 @@
+"""Rewind buffer for the last few seconds of emulation.
+
+Call capture() once per frame and step_back(n) to return n captured frames.
+Every frame stores the XOR of its memory with the frame before, run-length
+encoded as (offset, length, bytes) runs of non-zero bytes; every
+keyframe_interval frames the full RAM/OAM block is kept as well. A delta
+applies in either direction, so step_back rebuilds memory from whichever
+known block is nearest, the newest frame or a keyframe, and applies at most
+about keyframe_interval / 2 deltas however far it goes.
+
+Since only a handful of bytes change per frame, a minute of snake.nes fits
+in well under a megabyte (python bench.py rewind).
+"""
+import re
+import struct
+import sys
+from collections import deque, namedtuple
+
+import savestate
+from savestate import SaveState
+
+NONZERO_RUN = re.compile(rb"[^\x00]+")
+RUN_HEADER = struct.Struct("<HH")
+
+# delta: memory XOR the previous frame's memory, RLE encoded (b"" for the first frame).
+# keyframe: the full memory block, or None.
+Frame = namedtuple("Frame", ["registers", "events", "delta", "keyframe"])
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+def encode_delta(old, new):
+    out = bytearray()
+    for run in NONZERO_RUN.finditer(xor_bytes(old, new)):
+        out += RUN_HEADER.pack(run.start(), run.end() - run.start())
+        out += run.group()
+    return bytes(out)
+
+
+def apply_delta(memory, delta):
+    mask = bytearray(len(memory))
+    pos = 0
+    while pos < len(delta):
+        offset, length = RUN_HEADER.unpack_from(delta, pos)
+        pos += RUN_HEADER.size
+        mask[offset:offset + length] = delta[pos:pos + length]
+        pos += length
+    return xor_bytes(memory, mask)
+
+
+class RewindBuffer:
+    def __init__(self, cpu, seconds=60, fps=60, keyframe_interval=60):
+        self.cpu = cpu
+        self.keyframe_interval = keyframe_interval
+        self.frames = deque(maxlen=seconds * fps)
+        self._memory = None  # memory of frames[-1]
+        self._captured = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def capture(self):
+        state = savestate.save(self.cpu)
+        memory = state.memory
+        delta = b"" if self._memory is None else encode_delta(self._memory, memory)
+        keyframe = memory if self._captured % self.keyframe_interval == 0 else None
+        self.frames.append(Frame(state.registers, state.events, delta, keyframe))
+        self._memory = memory
+        self._captured += 1
+
+    def step_back(self, frames=1):
+        """Drop the newest frames and restore the one before them. False if there are not that many."""
+        if frames < 1 or len(self.frames) <= frames:
+            return False
+        target = len(self.frames) - 1 - frames
+        self._memory = self.memory_at(target)
+        for _ in range(frames):
+            self.frames.pop()
+        self._captured -= frames
+        frame = self.frames[-1]
+        savestate.load(self.cpu, SaveState(self._memory, frame.registers, frame.events))
+        return True
+
+    def memory_at(self, index):
+        # Start from the known block nearest to index, then walk the deltas.
+        # frames[i].delta turns frame i - 1's memory into frame i's and back.
+        newest = len(self.frames) - 1
+        start, memory = newest, self._memory
+        for i in range(max(0, index - self.keyframe_interval), min(newest, index + self.keyframe_interval)):
+            keyframe = self.frames[i].keyframe
+            if keyframe is not None and abs(i - index) < abs(start - index):
+                start, memory = i, keyframe
+        for i in range(start, index, -1):
+            memory = apply_delta(memory, self.frames[i].delta)
+        for i in range(start + 1, index + 1):
+            memory = apply_delta(memory, self.frames[i].delta)
+        return memory
+
+    def nbytes(self):
+        size = sys.getsizeof(self.frames)
+        for frame in self.frames:
+            size += (sys.getsizeof(frame) + sys.getsizeof(frame.registers)
+                     + sys.getsizeof(frame.events) + sys.getsizeof(frame.delta))
+            if frame.keyframe is not None:
+                size += sys.getsizeof(frame.keyframe)
+        return size
@@ -0,0 +1,186 @@
+"""Instruction-level coverage of PRG ROM, merged across runs.
+
+    python romcov.py snake.nes --runs 16 -o snake.cov
+    python romcov.py snake.nes --merge a.cov b.cov > listing.txt
+
+Coverage keeps one byte per PRG ROM offset: OPCODE is set when an
+instruction was fetched there, OPERAND when the byte was read as part of an
+executed instruction. NativeCPU updates the bitmap from its C loop; the
+Python cores mark the instruction about to run after every callback.
+
+The report is the disasm.py listing with a column for each instruction:
+"+" executed, "-" never executed. Executed code the static CFG did not find
+(jump tables, self-modified vectors) is listed after it.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from multiprocessing import Pool
+
+import cpu as cpu_module
+import disasm
+from bus import Bus
+from cartridge import Rom
+from debugger import shadow, unshadowed
+
+OPCODE = 0x01
+OPERAND = 0x02
+
+# Snake locations poked between ticks by collect() (see env.py).
+INPUT_ADDR = 0xff
+RANDOM_ADDR = 0xfe
+TICK_CYCLES = 2351
+
+
+class Coverage:
+    def __init__(self, rom):
+        self.size = len(rom.prg_rom)
+        self.bitmap = bytearray(self.size)
+        self.read = None  # mem_read of the attached Python core
+
+    def offset(self, addr):
+        # 16 KB PRG ROM is mirrored at $C000, as in disasm.prg_offset.
+        return (addr - 0x8000) % self.size if 0x8000 <= addr <= 0xffff else None
+
+    def mark(self, addr):
+        offset = self.offset(addr)
+        if offset is None:
+            return
+        self.bitmap[offset] |= OPCODE
+        opcode = disasm.OPCODES_MAP.get(self.read(addr))
+        for i in range(1, opcode.len if opcode else 1):
+            operand = self.offset(addr + i)
+            if operand is not None:
+                self.bitmap[operand] |= OPERAND
+
+    def attach(self, cpu):
+        if isinstance(cpu, cpu_module.NativeCPU):
+            cpu.set_coverage(self.bitmap)
+            return
+        self.read = cpu.mem_read
+        run_with_callback = unshadowed(cpu).run_with_callback
+
+        def covered_run_with_callback(callback):
+            self.mark(cpu.program_counter)
+
+            def mark(cpu):
+                callback(cpu)
+                self.mark(cpu.program_counter)
+
+            return run_with_callback(cpu, mark)
+
+        shadow(cpu, "run_with_callback", covered_run_with_callback)
+        shadow(cpu, "run", lambda: covered_run_with_callback(lambda _: None))
+
+    def detach(self, cpu):
+        if isinstance(cpu, cpu_module.NativeCPU):
+            cpu.set_coverage(None)
+            return
+        shadow(cpu, "run_with_callback", None)
+        shadow(cpu, "run", None)
+
+    def merge(self, other):
+        bitmap = other.bitmap if isinstance(other, Coverage) else other
+        if len(bitmap) != self.size:
+            raise ValueError(f"coverage for {len(bitmap)} bytes of PRG ROM, expected {self.size}")
+        merged = int.from_bytes(self.bitmap, "little") | int.from_bytes(bitmap, "little")
+        self.bitmap[:] = merged.to_bytes(self.size, "little")
+        return self
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.bitmap)
+
+    @classmethod
+    def load(cls, rom, path):
+        coverage = cls(rom)
+        with open(path, "rb") as f:
+            coverage.merge(f.read())
+        return coverage
+
+    def hit(self, addr):
+        offset = self.offset(addr)
+        return offset is not None and bool(self.bitmap[offset] & OPCODE)
+
+    def summary(self, cfg):
+        instructions = [ins for block in cfg.blocks.values() for ins in block.instructions]
+        hit = sum(self.hit(ins.addr) for ins in instructions)
+        return hit, len(instructions)
+
+    def outside(self, cfg):
+        # PRG offsets executed as opcodes that the static CFG never decoded.
+        static = {self.offset(ins.addr) for block in cfg.blocks.values() for ins in block.instructions}
+        return [offset for offset, flags in enumerate(self.bitmap) if flags & OPCODE and offset not in static]
+
+
+def report(cfg, coverage):
+    lines = [disasm.listing(cfg, lambda ins: "+" if coverage.hit(ins.addr) else "-")]
+    hit, total = coverage.summary(cfg)
+    lines.append("")
+    lines.append(f"; {hit}/{total} instructions executed ({hit / total:.1%})" if total else "; no code")
+    outside = coverage.outside(cfg)
+    if outside:
+        lines.append(f"; executed outside the static CFG: "
+                     + ", ".join(f"${0x8000 + offset:04X}" for offset in outside))
+    return "\n".join(lines)
+
+
+def run_snake(rom, seed, ticks, cpu_class=None):
+    # One game with random steering; returns its coverage bitmap.
+    rng = random.Random(seed)
+    cpu = (cpu_class or cpu_module.CPU)(Bus(rom))
+    coverage = Coverage(rom)
+    coverage.attach(cpu)
+    cpu.reset()
+    for _ in range(ticks):
+        cpu.mem_write(INPUT_ADDR, ord(rng.choice("wasd")))
+        cpu.mem_write(RANDOM_ADDR, rng.randint(1, 15))
+        if not cpu.run_until(cpu.cycles + TICK_CYCLES):
+            break
+    coverage.detach(cpu)
+    return bytes(coverage.bitmap)
+
+
+def _collect_worker(args):
+    return run_snake(*args)
+
+
+def collect(rom, runs, ticks=500, jobs=None, seed=0):
+    # Runs are spread over a process pool like fuzz.py replay/random.
+    coverage = Coverage(rom)
+    with Pool(jobs or os.cpu_count()) as pool:
+        for bitmap in pool.imap_unordered(_collect_worker, [(rom, seed + i, ticks) for i in range(runs)]):
+            coverage.merge(bitmap)
+    return coverage
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rom")
+    parser.add_argument("--runs", type=int, default=8, help="snake games with random input")
+    parser.add_argument("--ticks", type=int, default=500, help="game loop passes per run")
+    parser.add_argument("-j", "--jobs", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--merge", nargs="+", metavar="COV", help="report saved bitmaps instead of running")
+    parser.add_argument("-o", "--output", help="save the merged bitmap here")
+    args = parser.parse_args(argv)
+
+    with open(args.rom, "rb") as f:
+        rom = Rom.new(f.read())
+    if args.merge:
+        coverage = Coverage(rom)
+        for path in args.merge:
+            coverage.merge(Coverage.load(rom, path))
+    else:
+        start = time.perf_counter()
+        coverage = collect(rom, args.runs, args.ticks, args.jobs, args.seed)
+        print(f"; {args.runs} runs in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+    if args.output:
+        coverage.save(args.output)
+    print(report(disasm.load_cfg(rom), coverage))
+
+
+if __name__ == "__main__":
+    main()
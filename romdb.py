@@ -0,0 +1,133 @@
+"""Catalog of the .nes files under a directory.
+
+    python romdb.py roms/               # scan and list everything
+    python romdb.py roms/ --supported   # only ROMs bus.Bus can run
+
+Every file's header is parsed once and kept, together with the CRC32 and
+SHA1 of its PRG+CHR data, in an on-disk index. Later scans only re-read
+files whose size or mtime changed, so batch jobs can choose ROMs and reject
+unsupported mappers without touching the ROM files at all.
+"""
+import argparse
+import os
+import zlib
+from collections import namedtuple
+
+import cache
+from cartridge import Rom, SUPPORTED_MAPPERS, parse_header
+
+ROMDB_VERSION = 1
+
+RomEntry = namedtuple("RomEntry", ["path", "size", "mtime_ns", "sha1", "crc32", "header"])
+
+
+def index_rom(path, stat):
+    with open(path, "rb") as f:
+        raw = f.read()
+    header = parse_header(raw)
+    start = header.prg_rom_start
+    data = raw[start:start + header.prg_rom_size + header.chr_rom_size]
+    if len(data) != header.prg_rom_size + header.chr_rom_size:
+        raise ValueError("File is shorter than its header says")
+    return RomEntry(
+        path=path,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        sha1=cache.content_hash(data),
+        crc32=zlib.crc32(data),
+        header=header,
+    )
+
+
+def open_rom(entry):
+    """Load the ROM described by entry, slicing it with the indexed header."""
+    stat = os.stat(entry.path)
+    if (stat.st_size, stat.st_mtime_ns) != (entry.size, entry.mtime_ns):
+        raise ValueError(f"{entry.path} changed since it was indexed")
+    with open(entry.path, "rb") as f:
+        return Rom.from_header(entry.header, f.read())
+
+
+class RomCatalog:
+    def __init__(self, directory, index_path=None):
+        self.directory = os.path.abspath(directory)
+        self.index_path = index_path or cache.cache_path(
+            "romdb", f"{cache.content_hash(self.directory.encode())}-v{ROMDB_VERSION}")
+        self.by_path = {}  # path -> RomEntry
+        self.entries = {}  # sha1 -> RomEntry, one per distinct PRG+CHR content; the first path wins
+        self.errors = {}   # path -> (size, mtime_ns, reason it could not be indexed)
+        self.parsed = 0    # files read by the last scan
+
+    def scan(self):
+        index = cache.load(self.index_path) or {}
+        known, known_errors = index.get("entries", {}), index.get("errors", {})
+        self.by_path, self.entries, self.errors, self.parsed = {}, {}, {}, 0
+
+        for root, dirs, files in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.lower().endswith(".nes"):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entry = known.get(path)
+                if entry is not None and (entry.size, entry.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                    self.add(entry)
+                    continue
+                error = known_errors.get(path)
+                if error is not None and error[:2] == (stat.st_size, stat.st_mtime_ns):
+                    self.errors[path] = error
+                    continue
+                self.parsed += 1
+                try:
+                    self.add(index_rom(path, stat))
+                except (OSError, IndexError, ValueError) as e:
+                    self.errors[path] = (stat.st_size, stat.st_mtime_ns, str(e) or type(e).__name__)
+
+        if (self.parsed or known.keys() != self.by_path.keys()
+                or known_errors.keys() != self.errors.keys()):
+            cache.store(self.index_path, {"entries": self.by_path, "errors": self.errors})
+        return self
+
+    def add(self, entry):
+        self.by_path[entry.path] = entry
+        self.entries.setdefault(entry.sha1, entry)
+
+    def get(self, sha1):
+        return self.entries.get(sha1)
+
+    def find(self, **fields):
+        """Entries whose header matches every given field, e.g. find(mapper=0)."""
+        return [entry for entry in self.entries.values()
+                if all(getattr(entry.header, k) == v for k, v in fields.items())]
+
+    def supported(self):
+        return [entry for entry in self.entries.values() if entry.header.mapper in SUPPORTED_MAPPERS]
+
+    def open(self, sha1):
+        return open_rom(self.entries[sha1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory")
+    parser.add_argument("--supported", action="store_true", help="only ROMs bus.Bus can run")
+    parser.add_argument("--mapper", type=int)
+    args = parser.parse_args()
+
+    catalog = RomCatalog(args.directory).scan()
+    entries = catalog.supported() if args.supported else list(catalog.entries.values())
+    if args.mapper is not None:
+        entries = [e for e in entries if e.header.mapper == args.mapper]
+    for entry in sorted(entries, key=lambda e: e.path):
+        h = entry.header
+        print(f"{entry.sha1[:12]} {entry.crc32:08X} mapper {h.mapper:3}.{h.submapper} "
+              f"{'NES2.0' if h.nes2 else 'iNES  '} PRG {h.prg_rom_size // 1024:4}K "
+              f"CHR {h.chr_rom_size // 1024:4}K  {os.path.relpath(entry.path, catalog.directory)}")
+    for path, (_, _, reason) in sorted(catalog.errors.items()):
+        print(f"skipped {os.path.relpath(path, catalog.directory)}: {reason}")
+    print(f"{len(entries)} ROMs, {catalog.parsed} files parsed this scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Rolling hashes of emulator runs, for comparing builds without full traces.
+
+    python runhash.py record snake.nes --movies 1000 -o base.sig
+    (change cpu.py / bus.py)
+    python runhash.py compare base.sig --trace
+
+A movie is the host input of a run: one (key, random byte) pair per frame,
+written to $ff and $fe before the frame runs, as main.py does (key 0 leaves
+$ff alone). At every checkpoint (each frame boundary, or every interval
+cycles) the run's hash is extended with the CRC-32 of the registers, the
+cycle count and the RAM/OAM block. Memory writes enter the hash through the
+memory they leave behind, so the native core needs no per-write hook.
+
+The hashes are chained, so two runs agree up to their first divergent
+checkpoint and differ from there on. compare replays every recorded movie
+on the current build and reports that checkpoint's frame; --trace prints
+trace.trace lines for the first divergent frame, to diff against the same
+output from the other build.
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+from array import array
+from multiprocessing import Pool
+
+import cache
+import cpu as cpu_module
+import trace
+from bus import Bus
+from cartridge import Rom
+from cpu import CYCLES_PER_FRAME
+from fuzz import CPU_CLASSES
+
+SIGNATURE_VERSION = 1
+
+INPUT_ADDR = 0xff
+RANDOM_ADDR = 0xfe
+KEYS = b"\x00wasd"
+
+REGISTERS = struct.Struct("<BBBBBHQ")
+
+_roms = {}  # path -> (Rom, content hash), per worker process
+
+
+def random_movie(seed, frames):
+    rng = random.Random(seed)
+    movie = bytearray()
+    for _ in range(frames):
+        movie.append(rng.choice(KEYS))
+        movie.append(rng.randint(1, 15))
+    return bytes(movie)
+
+
+def state_hash(cpu, value=0):
+    bus = cpu.bus
+    value = zlib.crc32(REGISTERS.pack(cpu.register_a, cpu.register_x, cpu.register_y, cpu.stack_pointer,
+                                      int(cpu.status), cpu.program_counter, cpu.cycles), value)
+    value = zlib.crc32(bus.cpu_vram, value)
+    return zlib.crc32(bus.oam, value)
+
+
+def checkpoints(cpu, movie, interval=None, callbacks=None):
+    """Play movie from the current state, yielding (frame, hash) at every checkpoint.
+
+    callbacks maps a frame to a function called before the frame's first
+    instruction and after each of its instructions. Playback ends at the
+    checkpoint where BRK halted the program.
+    """
+    callbacks = callbacks or {}
+    step = interval or CYCLES_PER_FRAME
+    value = 0
+    checkpoint = frame_end = cpu.cycles
+    for frame in range(len(movie) // 2):
+        key, random_byte = movie[2 * frame], movie[2 * frame + 1]
+        if key:
+            cpu.mem_write(INPUT_ADDR, key)
+        cpu.mem_write(RANDOM_ADDR, random_byte)
+        frame_end += CYCLES_PER_FRAME
+        callback = callbacks.get(frame)
+        if callback is not None:
+            callback(cpu)
+        while checkpoint < frame_end:
+            checkpoint = min(checkpoint + step, frame_end)
+            # run_until runs at least one instruction on the Python cores.
+            running = cpu.cycles >= checkpoint or cpu.run_until(checkpoint, callback)
+            value = state_hash(cpu, value)
+            yield frame, value
+            if not running:
+                return
+
+
+def signatures(cpu, movie, interval=None):
+    return array("I", [value for _, value in checkpoints(cpu, movie, interval)])
+
+
+def checkpoints_per_frame(interval):
+    return -(-CYCLES_PER_FRAME // (interval or CYCLES_PER_FRAME))
+
+
+def first_divergence(a, b):
+    """Index of the first checkpoint where two signature lists differ, or None."""
+    for index, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return index
+    return None if len(a) == len(b) else min(len(a), len(b))
+
+
+def trace_frame(cpu, movie, frame, interval=None, limit=100000):
+    """Play movie up to frame and return trace.trace lines for the instructions it runs."""
+    lines = []
+    frame_end = cpu.cycles + (frame + 1) * CYCLES_PER_FRAME
+
+    def record(cpu):
+        if cpu.cycles < frame_end and len(lines) < limit:
+            lines.append(trace.trace(cpu))
+
+    for _ in checkpoints(cpu, movie[:2 * (frame + 1)], interval, {frame: record}):
+        pass
+    return lines
+
+
+def load_rom(path):
+    if path not in _roms:
+        with open(path, "rb") as f:
+            data = f.read()
+        _roms[path] = Rom.new(data), cache.content_hash(data)
+    return _roms[path]
+
+
+def new_cpu(rom, cpu_name=None):
+    cpu = (CPU_CLASSES[cpu_name] if cpu_name else cpu_module.CPU)(Bus(rom))
+    cpu.reset()
+    return cpu
+
+
+def _run_worker(args):
+    path, movie, interval, cpu_name = args
+    rom, _ = load_rom(path)
+    return signatures(new_cpu(rom, cpu_name), movie, interval).tobytes()
+
+
+def run_all(runs, interval, jobs=None, cpu_name=None):
+    # Signatures for (rom path, movie) pairs, spread over a process pool like fuzz.py.
+    with Pool(jobs or os.cpu_count()) as pool:
+        results = pool.imap(_run_worker, [(path, movie, interval, cpu_name) for path, movie in runs],
+                            chunksize=16)
+        return [array("I", result) for result in results]
+
+
+def record(roms, movies, frames, interval, jobs, seed, cpu_name, output):
+    runs = [(path, random_movie(seed + i, frames)) for path in roms for i in range(movies)]
+    start = time.perf_counter()
+    results = run_all(runs, interval, jobs, cpu_name)
+    cache.store_marshal(os.path.abspath(output), {
+        "version": SIGNATURE_VERSION,
+        "interval": interval or 0,
+        "roms": {path: load_rom(path)[1] for path in roms},
+        "runs": [(path, movie, hashes.tobytes()) for (path, movie), hashes in zip(runs, results)],
+    })
+    checkpoints_total = sum(len(hashes) for hashes in results)
+    print(f"{len(runs)} runs, {checkpoints_total} checkpoints in {time.perf_counter() - start:.2f} s -> {output}")
+
+
+def compare(path, jobs, cpu_name, show_trace):
+    recorded = cache.load_marshal(path)
+    if not isinstance(recorded, dict) or recorded.get("version") != SIGNATURE_VERSION:
+        raise SystemExit(f"{path}: not a signature file")
+    for rom_path, content_hash in recorded["roms"].items():
+        if load_rom(rom_path)[1] != content_hash:
+            raise SystemExit(f"{rom_path} changed since the signatures were recorded")
+    interval = recorded["interval"] or None
+    runs = [(rom_path, movie) for rom_path, movie, _ in recorded["runs"]]
+    start = time.perf_counter()
+    results = run_all(runs, interval, jobs, cpu_name)
+    divergent = []
+    per_frame = checkpoints_per_frame(interval)
+    for index, ((rom_path, movie, hashes), current) in enumerate(zip(recorded["runs"], results)):
+        checkpoint = first_divergence(array("I", hashes), current)
+        if checkpoint is not None:
+            divergent.append((index, rom_path, movie, checkpoint // per_frame))
+            print(f"{rom_path} run {index}: first divergent frame {checkpoint // per_frame} "
+                  f"(checkpoint {checkpoint})")
+    print(f"{len(runs)} runs, {len(divergent)} divergent in {time.perf_counter() - start:.2f} s")
+    if divergent and show_trace:
+        _, rom_path, movie, frame = divergent[0]
+        print(f"; trace of {rom_path} run {divergent[0][0]} frame {frame}")
+        print("\n".join(trace_frame(new_cpu(load_rom(rom_path)[0], cpu_name), movie, frame, interval)))
+    return not divergent
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record")
+    rec.add_argument("roms", nargs="+")
+    rec.add_argument("--movies", type=int, default=100, help="random movies per ROM")
+    rec.add_argument("--frames", type=int, default=600)
+    rec.add_argument("--interval", type=int, help="cycles between checkpoints (default: one per frame)")
+    rec.add_argument("--seed", type=int, default=0)
+    rec.add_argument("-o", "--output", required=True)
+    cmp = sub.add_parser("compare")
+    cmp.add_argument("signatures")
+    cmp.add_argument("--trace", action="store_true", help="trace the first divergent frame")
+    for command in (rec, cmp):
+        command.add_argument("-j", "--jobs", type=int)
+        command.add_argument("--cpu", choices=sorted(CPU_CLASSES), help="default: cpu.CPU")
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        record(args.roms, args.movies, args.frames, args.interval, args.jobs, args.seed, args.cpu, args.output)
+        return True
+    return compare(args.signatures, args.jobs, args.cpu, args.trace)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,27 @@
+from collections import namedtuple
+
+from bus import RAM_SIZE
+from cpu import CpuFlags, IdleLoopMixin
+
+# memory is cpu_vram followed by OAM, so both are saved and diffed as one block.
+SaveState = namedtuple("SaveState", ["memory", "registers", "events"])
+
+
+def save(cpu):
+    bus = cpu.bus
+    registers = (cpu.register_a, cpu.register_x, cpu.register_y, cpu.stack_pointer,
+                 int(cpu.status), cpu.program_counter, cpu.cycles)
+    return SaveState(bytes(bus.cpu_vram) + bytes(bus.oam), registers, cpu.events.snapshot())
+
+
+def load(cpu, state):
+    bus = cpu.bus
+    # Assign in place: NativeCPU shares the cpu_vram buffer with C.
+    bus.cpu_vram[:] = state.memory[:RAM_SIZE]
+    bus.oam[:] = state.memory[RAM_SIZE:]
+    (cpu.register_a, cpu.register_x, cpu.register_y, cpu.stack_pointer,
+     status, cpu.program_counter, cpu.cycles) = state.registers
+    cpu.status = CpuFlags(status)
+    cpu.events.restore(state.events)
+    if isinstance(cpu, IdleLoopMixin):
+        cpu.invalidate_idle_state()
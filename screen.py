@@ -0,0 +1,43 @@
+"""The 32x32 snake screen at $0200-$05FF as RGB frames."""
+
+# Colors in 8bit
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+GREY = (128, 128, 128)
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+BLUE = (0, 0, 255)
+MAGENTA = (255, 0, 255)
+YELLOW = (255, 255, 0)
+CYAN = (0, 255, 255)
+
+# Color mapping function
+def color(byte):
+    return {
+        0: BLACK,
+        1: WHITE,
+        2: GREY,
+        9: GREY,
+        3: RED,
+        10: RED,
+        4: GREEN,
+        11: GREEN,
+        5: BLUE,
+        12: BLUE,
+        6: MAGENTA,
+        13: MAGENTA,
+        7: YELLOW,
+        14: YELLOW,
+    }.get(byte, CYAN)
+
+
+SNAKE_SCREEN = 0x0200
+SNAKE_WIDTH = SNAKE_HEIGHT = 32
+
+RGB = [bytes(color(byte)) for byte in range(256)]
+
+
+def snake_frame(bus):
+    # Rows of 32 RGB pixels; read straight from RAM like the game writes it.
+    ram = bus.cpu_vram[SNAKE_SCREEN:SNAKE_SCREEN + SNAKE_WIDTH * SNAKE_HEIGHT]
+    return b"".join([RGB[byte] for byte in ram])
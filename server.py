@@ -0,0 +1,290 @@
+"""Async emulation server: many sessions in one process, frames sent as deltas.
+
+    python server.py snake.nes --port 8765
+    python server.py snake.nes --unix /tmp/cobra-nes.sock
+    python server.py snake.nes --latency --sessions 200 --frames 120
+
+Every connection gets its own CPU and Bus. A single scheduler task runs each
+session for one frame in turn and yields to the event loop between sessions,
+so reading input and writing frames for all clients happens between slices.
+After a frame the client receives the bytes of the snake screen
+($0200-$05ff) that changed since the last frame it was sent, encoded as
+rewind.encode_delta runs.
+
+Client -> server: MESSAGE (kind, value, seq). KEY writes value to $ff the
+way main.py does for w/a/s/d; RESET restarts the game.
+Server -> client: FRAME_HEADER (frame, ack, flags, delta length) + delta.
+ack is the seq of the last message applied before the frame ran. A session
+whose frame raised (e.g. an unknown opcode) is halted with HALTED | ERROR;
+RESET restarts it like a finished game. The other sessions keep running.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import struct
+import sys
+import time
+from collections import deque, namedtuple
+
+import cpu as cpu_module
+import rewind
+from bus import Bus
+from cartridge import Rom
+from screen import SNAKE_SCREEN, SNAKE_WIDTH, SNAKE_HEIGHT
+
+MESSAGE = struct.Struct("<BBI")
+FRAME_HEADER = struct.Struct("<IIBH")
+
+KEY = 1
+RESET = 2
+
+HALTED = 0x01  # the program hit BRK (snake: game over)
+ERROR = 0x02  # the frame raised; the session is halted
+
+INPUT_ADDR = 0xff
+RANDOM_ADDR = 0xfe
+SCREEN_SIZE = SNAKE_WIDTH * SNAKE_HEIGHT
+
+# Frames are not written to a client whose socket buffer holds more than
+# this; its next delta then covers every frame it missed. The frame that
+# halts a session is always written.
+MAX_BUFFERED = 64 * 1024
+
+FrameUpdate = namedtuple("FrameUpdate", ["frame", "ack", "flags"])
+
+
+class Session:
+    def __init__(self, rom, writer, cpu_class=None, seed=None):
+        self.rom = rom
+        self.writer = writer
+        self.cpu_class = cpu_class or cpu_module.CPU
+        self.rng = random.Random(seed)
+        self.inputs = deque()
+        self.frame = 0
+        self.ack = 0
+        self.skipped = 0
+        self.restart()
+
+    def restart(self):
+        self.cpu = self.cpu_class(Bus(self.rom))
+        self.cpu.reset()
+        self.halted = False
+        self.error = None
+        self.screen = bytes(SCREEN_SIZE)  # last screen sent to the client
+
+    def apply_inputs(self):
+        applied = bool(self.inputs)
+        while self.inputs:
+            kind, value, seq = self.inputs.popleft()
+            if kind == KEY:
+                self.cpu.mem_write(INPUT_ADDR, value)
+            elif kind == RESET:
+                self.restart()
+            self.ack = seq
+        return applied
+
+    def step(self):
+        # One frame slice. Halted sessions only answer input.
+        applied = self.apply_inputs()
+        if self.halted and not applied:
+            return
+        if not self.halted:
+            cpu = self.cpu
+            cpu.mem_write(RANDOM_ADDR, self.rng.randint(1, 15))
+            self.halted = not cpu.run_until(cpu.cycles + cpu_module.CYCLES_PER_FRAME)
+            self.frame += 1
+        self.send()
+
+    def fail(self, error):
+        # Halt after an exception in step(), telling the client once.
+        self.error = error
+        self.halted = True
+        try:
+            self.send()
+        except Exception:
+            self.writer.close()  # ends the connection; _handle drops the session
+
+    def send(self):
+        if self.writer.is_closing():
+            return
+        if not self.halted and self.writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+            self.skipped += 1
+            return
+        screen = bytes(self.cpu.bus.cpu_vram[SNAKE_SCREEN:SNAKE_SCREEN + SCREEN_SIZE])
+        delta = rewind.encode_delta(self.screen, screen)
+        self.screen = screen
+        flags = (HALTED if self.halted else 0) | (ERROR if self.error is not None else 0)
+        self.writer.write(FRAME_HEADER.pack(self.frame, self.ack, flags, len(delta)) + delta)
+
+
+class EmulationServer:
+    def __init__(self, rom, fps=60, cpu_class=None):
+        self.rom = rom
+        self.frame_time = 1 / fps if fps else None
+        self.cpu_class = cpu_class
+        self.sessions = []
+        self.slices = 0
+        self._server = None
+        self._scheduler = None
+        self._handlers = set()
+        self._seeds = iter(range(1 << 32))
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        self._scheduler = asyncio.create_task(self._schedule())
+        return self._server
+
+    async def close(self):
+        self._scheduler.cancel()
+        self._server.close()
+        for session in self.sessions:
+            session.writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        session = Session(self.rom, writer, self.cpu_class, next(self._seeds))
+        self.sessions.append(session)
+        try:
+            while True:
+                session.inputs.append(MESSAGE.unpack(await reader.readexactly(MESSAGE.size)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.remove(session)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def _schedule(self):
+        # Cooperative round robin: one frame per session, then yield, so a
+        # slow frame delays the others by one slice and never starves I/O.
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            for session in list(self.sessions):
+                if session in self.sessions:
+                    try:
+                        session.step()
+                    except Exception as e:
+                        print(f"Session halted: {e!r}", file=sys.stderr)
+                        session.fail(e)
+                await asyncio.sleep(0)
+            self.slices += 1
+            if self.frame_time is None:
+                await asyncio.sleep(0)
+                continue
+            next_tick += self.frame_time
+            delay = next_tick - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_tick = loop.time()  # running behind: don't try to catch up
+
+
+class Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.screen = bytes(SCREEN_SIZE)
+        self.seq = 0
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=None, path=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def send(self, kind, value=0):
+        self.seq += 1
+        self.writer.write(MESSAGE.pack(kind, value, self.seq))
+        return self.seq
+
+    async def read_frame(self):
+        frame, ack, flags, length = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+        self.screen = rewind.apply_delta(self.screen, await self.reader.readexactly(length))
+        return FrameUpdate(frame, ack, flags)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def measure_latency(rom, sessions=100, frames=120, fps=60, cpu_class=None):
+    """Seconds from sending a message to receiving the first frame that applied it.
+
+    Each client waits for its first frame before timing starts, then sends a
+    random key every frame, or RESET once the game is over.
+    """
+    server = EmulationServer(rom, fps, cpu_class)
+    listener = await server.start()
+    port = listener.sockets[0].getsockname()[1]
+    clients = [await Client.connect(port=port) for _ in range(sessions)]
+    latencies = []
+
+    async def drive(client, seed):
+        rng = random.Random(seed)
+        update = await client.read_frame()
+        for _ in range(frames):
+            sent = time.perf_counter()
+            if update.flags & HALTED:
+                seq = client.send(RESET)
+            else:
+                seq = client.send(KEY, ord(rng.choice("wasd")))
+            update = await client.read_frame()
+            while update.ack < seq:
+                update = await client.read_frame()
+            latencies.append(time.perf_counter() - sent)
+
+    try:
+        await asyncio.gather(*(drive(client, seed) for seed, client in enumerate(clients)))
+    finally:
+        for client in clients:
+            await client.close()
+        await server.close()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("rom")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--fps", type=float, default=60, help="0 runs slices back to back")
+    parser.add_argument("--latency", action="store_true", help="measure with loopback clients and exit")
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--frames", type=int, default=120)
+    args = parser.parse_args()
+
+    with open(args.rom, "rb") as f:
+        rom = Rom.new(f.read())
+
+    if args.latency:
+        start = time.perf_counter()
+        latencies = asyncio.run(measure_latency(rom, args.sessions, args.frames, args.fps))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print(f"{args.sessions} sessions, {len(latencies)} messages in {elapsed:.2f} s "
+              f"({len(latencies) / elapsed:.0f} frames/s)")
+        print(f"latency median {statistics.median(latencies) * 1e3:.2f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.2f} ms, max {latencies[-1] * 1e3:.2f} ms")
+        return
+
+    async def serve():
+        server = EmulationServer(rom, args.fps)
+        listener = await server.start(args.host, args.port, args.unix)
+        async with listener:
+            await listener.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Guest memory in multiprocessing.shared_memory, readable from other processes.
+
+    bus = Bus(rom, shared=True)               # emulator process
+    name = bus.shared.name
+
+    view = SharedRam.attach(name)             # monitor, renderer, trainer
+    screen = numpy.frombuffer(view.ram, numpy.uint8)[0x200:0x600]
+    view.close()
+
+The block holds RAM followed by OAM; bus.cpu_vram and bus.oam are
+memoryviews into it, so the emulation loop indexes them like bytearrays and
+readers see every write without copying. Readers get no synchronization:
+a frame may be half written when they look.
+"""
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+from bus import RAM_SIZE, OAM_SIZE
+
+SIZE = RAM_SIZE + OAM_SIZE
+
+_created = set()  # names of blocks created by this process
+
+
+def attach_block(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        pass
+    block = shared_memory.SharedMemory(name=name)
+    if (os.name == "posix" and multiprocessing.parent_process() is None
+            and block.name not in _created):
+        # Before 3.13 every attach registers the block with this process's
+        # resource tracker, which unlinks it when the process exits, under
+        # the emulator's feet. The creator and its children share one
+        # tracker and must leave the creator's registration alone.
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+
+class SharedRam:
+    def __init__(self, block, owner):
+        self.block = block
+        self.owner = owner
+        self.ram = block.buf[:RAM_SIZE]
+        self.oam = block.buf[RAM_SIZE:SIZE]
+
+    @classmethod
+    def create(cls, name=None):
+        block = shared_memory.SharedMemory(name=name, create=True, size=SIZE)
+        block.buf[:SIZE] = bytes(SIZE)
+        _created.add(block.name)
+        return cls(block, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(attach_block(name), owner=False)
+
+    @property
+    def name(self):
+        return self.block.name
+
+    def close(self):
+        # Everything viewing ram/oam (NumPy arrays, NativeCPU.release_buffers)
+        # has to be gone first. The owner also removes the block.
+        self.ram.release()
+        self.oam.release()
+        self.block.close()
+        if self.owner:
+            self.block.unlink()
+            _created.discard(self.block.name)
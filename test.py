@@ -1,42 +1,1260 @@
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-from cpu import CPU, CpuFlags
+import zlib
+from unittest import mock
+import alu
+import cache
+import cpu as cpu_module
+import debugger
+import disasm
+import events
+import export
+import fuzz
+import profiles
+import rewind
+import romcov
+import romdb
+import runhash
+import savestate
+import server
+import sharedram
+from bus import Bus, CountingBus
+from cartridge import Rom, Mirroring, parse_header
+from cpu import CpuFlags
+from opcodes import CPU_OPS_CODES, AddressingMode
+from screen import color as screen_color
+
+try:
+    import numpy
+    import env
+except ImportError:
+    numpy = env = None
+
+
+def make_test_rom(program=()):
+    prg = bytearray(0x8000)
+    prg[0x0600:0x0600 + len(program)] = bytes(program)
+    prg[0x7ffc] = 0x00
+    prg[0x7ffd] = 0x86
+    return Rom(bytes(prg), bytes(0x2000), 0, Mirroring.HORIZONTAL)
 
 class TestCPU(unittest.TestCase):
 
+   def run_program(self, program, check, memory=(), **registers):
+       # Once per profile, so the reference core runs them too. Registers and
+       # memory are set up after reset, like a caller of reset() and run().
+       for name in profiles.PROFILES:
+           with self.subTest(profile=name):
+               cpu = profiles.create(make_test_rom(program), name)
+               cpu.reset()
+               for register, value in registers.items():
+                   setattr(cpu, register, value)
+               for addr, value in memory:
+                   cpu.mem_write(addr, value)
+               cpu.run()
+               check(cpu)
+
    def test_0xa9_lda_immidiate_load_data(self):
-       bus = Bus(test_rom())
-       cpu = CPU(bus)
-       cpu.load_and_run([0xa9, 0x05, 0x00])
-       self.assertEqual(cpu.register_a, 5)
-       self.assertEqual((cpu.status.bits() & 0b0000_0010), 0b00)
-       self.assertEqual((cpu.status.bits() & 0b1000_0000), 0)
+       def check(cpu):
+           self.assertEqual(cpu.register_a, 5)
+           self.assertEqual((int(cpu.status) & 0b0000_0010), 0b00)
+           self.assertEqual((int(cpu.status) & 0b1000_0000), 0)
+       self.run_program([0xa9, 0x05, 0x00], check)
 
    def test_0xaa_tax_move_a_to_x(self):
-       bus = Bus(test_rom())
-       cpu = CPU(bus)
-       cpu.register_a = 10
-       cpu.load_and_run([0xaa, 0x00])
-       self.assertEqual(cpu.register_x, 10)
+       self.run_program([0xaa, 0x00], lambda cpu: self.assertEqual(cpu.register_x, 10), register_a=10)
 
    def test_5_ops_working_together(self):
-       bus = Bus(test_rom())
-       cpu = CPU(bus)
-       cpu.load_and_run([0xa9, 0xc0, 0xaa, 0xe8, 0x00])
-       self.assertEqual(cpu.register_x, 0xc1)
+       self.run_program([0xa9, 0xc0, 0xaa, 0xe8, 0x00], lambda cpu: self.assertEqual(cpu.register_x, 0xc1))
 
    def test_inx_overflow(self):
-       bus = Bus(test_rom())
-       cpu = CPU(bus)
-       cpu.register_x = 0xff
-       cpu.load_and_run([0xe8, 0xe8, 0x00])
-       self.assertEqual(cpu.register_x, 1)
+       self.run_program([0xe8, 0xe8, 0x00], lambda cpu: self.assertEqual(cpu.register_x, 1), register_x=0xff)
 
    def test_lda_from_memory(self):
-       bus = Bus(test_rom())
-       cpu = CPU(bus)
-       cpu.mem_write(0x10, 0x55)
-       cpu.load_and_run([0xa5, 0x10, 0x00])
-       self.assertEqual(cpu.register_a, 0x55)
+       self.run_program([0xa5, 0x10, 0x00], lambda cpu: self.assertEqual(cpu.register_a, 0x55),
+                        memory=[(0x10, 0x55)])
+
+
+def random_program(rng, length):
+    # Straight-line code over the implemented opcodes, with operands kept
+    # inside RAM so both cores get through most of the program.
+    skip = {"BRK", "JMP", "JSR", "RTS", "RTI"}
+    ops = [op for op in CPU_OPS_CODES if op.mnemonic not in skip]
+    program = []
+    for _ in range(length):
+        op = rng.choice(ops)
+        program.append(op.code)
+        if op.len == 2 and op.mode == AddressingMode.NoneAddressing:
+            program.append(0x00)  # branch to the next instruction either way
+        elif op.len == 2:
+            program.append(rng.randrange(0x100))
+        elif op.len == 3:
+            program.extend([rng.randrange(0x100), rng.randrange(0x08)])
+    program.append(0x00)
+    return program
+
+
+def run_recorded(cpu_class, rom, ram=None):
+    cpu = profiles.create(rom, cpu_class=cpu_class)
+    if ram is not None:
+        cpu.bus.cpu_vram[:] = ram
+    cpu.reset()
+    states = []
+
+    def record(cpu):
+        states.append((cpu.program_counter, cpu.register_a, cpu.register_x,
+                       cpu.register_y, cpu.stack_pointer, int(cpu.status),
+                       cpu.cycles, tuple(cpu.bus.cpu_vram)))
+        if len(states) >= 5000:
+            raise StopIteration
+
+    try:
+        cpu.run_with_callback(record)
+        outcome = None
+    except Exception as e:
+        outcome = (type(e), str(e))
+    return states, outcome
+
+
+@unittest.skipUnless(cpu_module.NATIVE_AVAILABLE, "native core not built")
+class TestNativeCPU(unittest.TestCase):
+
+   def assert_same_run(self, rom, ram=None):
+       expected = run_recorded(cpu_module.PyCPU, rom, ram)
+       actual = run_recorded(cpu_module.NativeCPU, rom, ram)
+       for i, (want, got) in enumerate(zip(expected[0], actual[0])):
+           self.assertEqual(want, got, f"state differs after instruction {i}")
+       self.assertEqual(len(expected[0]), len(actual[0]))
+       self.assertEqual(expected[1], actual[1])
+
+   def test_random_programs_match_python_core(self):
+       rng = random.Random(0x6502)
+       for _ in range(200):
+           ram = [rng.randrange(0x100) for _ in range(2048)]
+           self.assert_same_run(make_test_rom(random_program(rng, 40)), ram)
+
+   def test_run_until_slices_match_python_core(self):
+       with open("snake.nes", "rb") as f:
+           rom = Rom.new(f.read())
+       runs = []
+       for cpu_class in (cpu_module.PyCPU, cpu_module.NativeCPU):
+           cpu = profiles.create(rom, cpu_class=cpu_class)
+           cpu.reset()
+           rng = random.Random(3)
+           states = []
+           running = True
+           while running:
+               cpu.mem_write(0xff, ord(rng.choice("wasd")))
+               running = cpu.run_until(cpu.cycles + 5000)
+               states.append((running, savestate.save(cpu)))
+           runs.append(states)
+       self.assertEqual(runs[0], runs[1])
+       self.assertEqual(cpu.run_limit, events.NEVER)
+
+   def test_subroutines_and_branches_match_python_core(self):
+       program = [
+           0xa2, 0x05,        # LDX #$05
+           0x20, 0x0c, 0x86,  # JSR $860C
+           0xca,              # DEX
+           0xd0, 0x01,        # BNE +1
+           0x00,              # BRK
+           0x4c, 0x02, 0x86,  # JMP $8602
+           0xe6, 0x10,        # INC $10
+           0x08, 0x28,        # PHP / PLP
+           0x60,              # RTS
+       ]
+       self.assert_same_run(make_test_rom(program))
+
+   def test_snake_rom_matches_python_core(self):
+       with open("snake.nes", "rb") as f:
+           self.assert_same_run(Rom.new(f.read()))
+
+class TestLazyFlagsCPU(unittest.TestCase):
+
+   def assert_same_run(self, rom, ram=None):
+       self.assertEqual(run_recorded(cpu_module.PyCPU, rom, ram),
+                        run_recorded(cpu_module.LazyFlagsCPU, rom, ram))
+
+   def test_random_programs_match_eager_flags(self):
+       rng = random.Random(0x28)
+       for _ in range(100):
+           ram = [rng.randrange(0x100) for _ in range(2048)]
+           self.assert_same_run(make_test_rom(random_program(rng, 40)), ram)
+
+   def test_snake_rom_matches_eager_flags(self):
+       with open("snake.nes", "rb") as f:
+           self.assert_same_run(Rom.new(f.read()))
+
+   def test_bundled_vectors(self):
+       for code in fuzz.bundled_opcodes():
+           for vector in fuzz.load_vectors(code):
+               with self.subTest(opcode=f"{code:02x}", vector=vector["name"]):
+                   self.assertEqual(fuzz.run_vector(vector, cpu_module.LazyFlagsCPU), [])
+
+   def test_status_write_drops_pending_flags(self):
+       cpu = profiles.create(make_test_rom(), cpu_class=cpu_module.LazyFlagsCPU)
+       cpu.update_zero_and_negative_flags(0)
+       self.assertTrue(cpu.status & CpuFlags.ZERO)
+       cpu.status = CpuFlags.NEGATIVE
+       self.assertEqual(cpu.status, CpuFlags.NEGATIVE)
+
+
+class TestInlineCPU(unittest.TestCase):
+
+   def assert_same_run(self, rom, ram=None):
+       self.assertEqual(run_recorded(cpu_module.PyCPU, rom, ram),
+                        run_recorded(cpu_module.InlineCPU, rom, ram))
+
+   def test_random_programs_match_python_core(self):
+       rng = random.Random(0x38)
+       for _ in range(100):
+           ram = [rng.randrange(0x100) for _ in range(2048)]
+           self.assert_same_run(make_test_rom(random_program(rng, 40)), ram)
+
+   def test_snake_rom_matches_python_core(self):
+       with open("snake.nes", "rb") as f:
+           rom = Rom.new(f.read())
+       self.assert_same_run(rom)
+       self.assertEqual(savestate.save(run_final(cpu_module.PyCPU, rom)),
+                        savestate.save(run_final(cpu_module.InlineCPU, rom)))
+
+   def test_bundled_vectors(self):
+       for code in fuzz.bundled_opcodes():
+           for vector in fuzz.load_vectors(code):
+               with self.subTest(opcode=f"{code:02x}", vector=vector["name"]):
+                   self.assertEqual(fuzz.run_vector(vector, cpu_module.InlineCPU), [])
+
+   def test_callback_changes_are_picked_up(self):
+       cpu = profiles.create(make_test_rom([0xe8, 0xe8, 0x00]), cpu_class=cpu_module.InlineCPU)  # INX; INX; BRK
+       cpu.reset()
+
+       def callback(cpu):
+           cpu.register_x = 0x40
+
+       cpu.run_with_callback(callback)
+       self.assertEqual(cpu.register_x, 0x40)
+       cpu.reset()
+       cpu.run()
+       self.assertEqual((cpu.register_x, cpu.program_counter), (2, 0x8603))
+
+   def test_slots_keep_instances_small(self):
+       cpu = profiles.create(make_test_rom(), cpu_class=cpu_module.InlineCPU)
+       self.assertFalse(hasattr(cpu.bus, "__dict__"))
+       self.assertFalse(hasattr(cpu, "__dict__"))
+
+
+def run_final(cpu_class, rom, callback=None):
+    cpu = profiles.create(rom, cpu_class=cpu_class)
+    cpu.reset()
+    if callback is None:
+        cpu.run()
+    else:
+        cpu.run_with_callback(callback)
+    return cpu
+
+
+class TestIdleLoopCPU(unittest.TestCase):
+
+   def test_delay_loops_finish_in_same_state(self):
+       with open("snake.nes", "rb") as f:
+           rom = Rom.new(f.read())
+       expected = run_final(cpu_module.PyCPU, rom)
+       actual = run_final(cpu_module.IdleLoopCPU, rom)
+       self.assertEqual((actual.program_counter, actual.register_a, actual.register_x,
+                         actual.register_y, int(actual.status), actual.cycles),
+                        (expected.program_counter, expected.register_a, expected.register_x,
+                         expected.register_y, int(expected.status), expected.cycles))
+       self.assertEqual(actual.bus.cpu_vram, expected.bus.cpu_vram)
+       self.assertGreater(actual.idle_skipped_cycles, 0)
+
+   def test_delay_loop_stops_at_deadline(self):
+       rom = make_test_rom([0xa2, 0x00, 0xca, 0xd0, 0xfd, 0x00])  # LDX #0; DEX; BNE; BRK
+       cpu = profiles.create(rom, cpu_class=cpu_module.IdleLoopCPU)
+       cpu.reset()
+       self.assertTrue(cpu.run_until(100))
+       self.assertLessEqual(cpu.cycles - 100, 4)
+       self.assertGreater(cpu.idle_skipped_cycles, 0)
+       self.assertFalse(cpu.run_until(10000))
+       self.assertEqual(cpu.register_x, 0)
+       self.assertEqual(cpu.cycles, 7 + 2 + 256 * 4)
+
+   def test_run_after_run_until_still_skips(self):
+       rom = make_test_rom([0xa2, 0x00, 0xca, 0xd0, 0xfd, 0xa2, 0x00, 0xca, 0xd0, 0xfd, 0x00])  # two delay loops
+       cpu = profiles.create(rom, cpu_class=cpu_module.IdleLoopCPU)
+       cpu.reset()
+       cpu.run_until(20)
+       skipped = cpu.idle_skipped_cycles
+       cpu.run()
+       self.assertGreater(cpu.idle_skipped_cycles, skipped)
+       self.assertEqual(cpu.cycles, run_final(cpu_module.PyCPU, rom).cycles)
+
+   def test_polling_loop_skips_to_deadline(self):
+       program = [0xa5, 0x10, 0xf0, 0xfc, 0x00]  # wait: LDA $10; BEQ wait; BRK
+       for base in (cpu_module.PyCPU, cpu_module.LazyFlagsCPU):
+           cpu_class = type("IdleLoop" + base.__name__, (cpu_module.IdleLoopMixin, base), {})
+           cpu = profiles.create(make_test_rom(program), cpu_class=cpu_class)
+           cpu.reset()
+           self.assertTrue(cpu.run_until(10000))
+           self.assertGreaterEqual(cpu.cycles, 10000)
+           self.assertLess(cpu.cycles, 10000 + 10)
+           self.assertGreater(cpu.idle_skipped_cycles, 9900)
+           cpu.mem_write(0x10, 1)
+           self.assertFalse(cpu.run_until(20000))
+           self.assertEqual(cpu.register_a, 1)
+
+   def test_callbacks_debuggers_and_counters_see_every_iteration(self):
+       program = [0xa5, 0x10, 0xf0, 0xfc, 0x00]  # wait: LDA $10; BEQ wait; BRK
+       rom = make_test_rom(program)
+       cpu = profiles.create(rom, cpu_class=cpu_module.FastCPU)
+       cpu.reset()
+       steps = []
+       cpu.run_until(10000, lambda cpu: steps.append(cpu.cycles))
+       self.assertEqual(cpu.idle_skipped_cycles, 0)
+       self.assertGreater(len(steps), 10000 // 6)
+
+       cpu = profiles.create(rom, cpu_class=cpu_module.FastCPU)
+       cpu.reset()
+       dbg = debugger.Debugger(cpu)
+       dbg.break_at(0x8600, "cycles > 5000")
+       with self.assertRaises(debugger.BreakpointHit):
+           cpu.run_until(10000)
+       self.assertLess(cpu.cycles, 5010)
+       self.assertEqual(cpu.idle_skipped_cycles, 0)
+       dbg.clear()
+       cpu.run_until(20000)
+       self.assertGreater(cpu.idle_skipped_cycles, 0)
+
+       cpu = profiles.create(rom, cpu_class=cpu_module.FastCPU, stats=True)
+       cpu.reset()
+       cpu.run_until(10000)
+       self.assertEqual(cpu.idle_skipped_cycles, 0)
+       self.assertGreater(int(cpu.bus.stats.reads[0x10]), 10000 // 6)
+
+   def test_classifying_loops_is_not_a_memory_access(self):
+       rom = make_test_rom([0xa5, 0x10, 0xf0, 0xfc, 0x00])
+       cpu = profiles.create(rom, cpu_class=cpu_module.FastCPU, stats=True)
+       debugger.Debugger(cpu).watch(0x8600, 0x86ff, on="r")
+       self.assertEqual(cpu.classify_loop(0x8600, 0x8602)[0], "poll")
+       self.assertEqual(int(cpu.bus.stats.reads.sum()), 0)
+
+   def test_loops_with_stores_are_not_skipped(self):
+       program = [0xe6, 0x10, 0xa5, 0x10, 0xd0, 0xfa, 0x00]  # INC $10; LDA $10; BNE; BRK
+       cpu = run_final(cpu_module.IdleLoopCPU, make_test_rom(program))
+       self.assertEqual(cpu.idle_skipped_cycles, 0)
+       self.assertEqual(cpu.mem_read(0x10), 0)
+
+
+def interrupt_rom(program, handler):
+    # program at $8600, handler at $8700 behind both the NMI and IRQ vectors.
+    prg = bytearray(make_test_rom(program).prg_rom)
+    prg[0x0700:0x0700 + len(handler)] = bytes(handler)
+    prg[0x7ffa:0x7ffc] = prg[0x7ffe:0x8000] = b"\x00\x87"
+    return Rom(bytes(prg), bytes(0x2000), 0, Mirroring.HORIZONTAL)
+
+
+# INC $10; JMP $8600 forever, with an INC $11; RTI interrupt handler.
+COUNTING_LOOP = interrupt_rom([0xe6, 0x10, 0x4c, 0x00, 0x86], [0xe6, 0x11, 0x40])
+
+
+def run_until(cpu, cycles, callback=lambda _: None):
+    def stop(cpu):
+        callback(cpu)
+        if cpu.cycles >= cycles:
+            raise StopIteration
+
+    try:
+        cpu.run_with_callback(stop)
+    except StopIteration:
+        pass
+
+
+class TestProfiles(unittest.TestCase):
+
+   def test_profiles_select_cores(self):
+       for name, cpu_class, features in (("accurate", cpu_module.PyCPU, set()),
+                                         ("fast", cpu_module.FastCPU, {"lazy_flags", "idle_loop_skip"}),
+                                         ("headless", cpu_module.FastCPU, {"lazy_flags", "idle_loop_skip"})):
+           self.assertIs(type(profiles.create(make_test_rom(), name)), cpu_class)
+           self.assertEqual(profiles.get(name).features, features)
+       if cpu_module.NATIVE_AVAILABLE:
+           self.assertIs(type(profiles.create(make_test_rom(), "native")), cpu_module.NativeCPU)
+           self.assertEqual(profiles.get("native").features, {"native"})
+       else:
+           self.assertNotIn("native", profiles.PROFILES)
+       self.assertEqual(profiles.DEFAULT_PROFILE, "fast")
+       self.assertTrue(profiles.get("fast").render)
+       self.assertFalse(profiles.get("headless").render)
+       with self.assertRaises(ValueError):
+           profiles.create(make_test_rom(), "turbo")
+
+   def test_headless_main_runs_without_pygame(self):
+       code = "import sys; sys.modules['pygame'] = None; import main; main.main('headless')"
+       output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+       self.assertTrue(output.stdout.startswith("Game over after"))
+
+   def test_bus_options_and_core_override(self):
+       cpu = profiles.create(make_test_rom(), "fast", cpu_class=cpu_module.InlineCPU, stats=True)
+       self.assertIs(type(cpu), cpu_module.InlineCPU)
+       self.assertIsNotNone(cpu.bus.stats)
+
+   def test_profiles_run_snake_identically(self):
+       with open("snake.nes", "rb") as f:
+           rom = Rom.new(f.read())
+       movie = bytes([ord("w"), 3, ord("a"), 7, ord("s"), 1, 0, 9, 0, 5, 0, 5])
+       runs = {}
+       for name in profiles.PROFILES:
+           cpu = profiles.create(rom, name)
+           cpu.reset()
+           runs[name] = runhash.signatures(cpu, movie)
+           if "idle_loop_skip" in profiles.get(name).features:
+               self.assertGreater(cpu.idle_skipped_cycles, 0)
+       self.assertEqual(len(set(map(tuple, runs.values()))), 1)
+
+
+class TestEvents(unittest.TestCase):
+
+   def cpus(self):
+       classes = [cpu_module.PyCPU, cpu_module.LazyFlagsCPU]
+       if cpu_module.NATIVE_AVAILABLE:
+           classes.append(cpu_module.NativeCPU)
+       return classes
+
+   def test_queue_orders_events_by_cycle(self):
+       queue = events.EventQueue()
+       self.assertEqual(queue.deadline, events.NEVER)
+       queue.schedule(300, events.NMI)
+       queue.schedule(100, events.IRQ, "mapper")
+       queue.schedule(100, events.NMI)
+       self.assertEqual(queue.deadline, 100)
+       self.assertEqual(queue.pop_due(99), [])
+       self.assertEqual(queue.pop_due(200), [(events.IRQ, "mapper"), (events.NMI, None)])
+       self.assertEqual(queue.deadline, 300)
+       queue.cancel(events.NMI)
+       self.assertEqual((len(queue), queue.deadline), (0, events.NEVER))
+
+   def test_nmi_is_taken_after_the_instruction_crossing_its_deadline(self):
+       for cpu_class in self.cpus():
+           cpu = profiles.create(COUNTING_LOOP, cpu_class=cpu_class)
+           cpu.reset()
+           cpu.events.schedule(100, events.NMI)
+           cpu.events.schedule(200, events.NMI)
+           entered = []
+           run_until(cpu, 300, lambda cpu: cpu.program_counter == 0x8700 and entered.append(cpu.cycles))
+           self.assertEqual(len(entered), 2, cpu_class.__name__)
+           for deadline, cycle in zip((100, 200), entered):
+               self.assertLessEqual(deadline + 7, cycle)
+               self.assertLess(cycle, deadline + 7 + 5)
+           self.assertEqual(cpu.mem_read(0x11), 2)
+           self.assertEqual(cpu.stack_pointer, 0xfd)
+
+   def test_irq_waits_for_cli_and_acknowledgement(self):
+       program = [0x78, 0xa2, 0x20, 0xca, 0xd0, 0xfd, 0x58, 0xe6, 0x10, 0x4c, 0x07, 0x86]
+       rom = interrupt_rom(program, [0xe6, 0x11, 0x40])  # SEI; delay; CLI; counting loop
+       for cpu_class in self.cpus():
+           cpu = profiles.create(rom, cpu_class=cpu_class)
+           cpu.reset()
+           cpu.events.schedule(20, events.IRQ, "mapper")
+           entered = []
+
+           def handler(cpu):
+               if cpu.program_counter == 0x8700:
+                   entered.append(cpu.cycles)
+                   if len(entered) == 3:
+                       cpu.events.acknowledge_irq("mapper")
+
+           run_until(cpu, 1000, handler)
+           self.assertEqual(len(entered), 3, cpu_class.__name__)
+           self.assertEqual(entered[0], 7 + 2 + 2 + 0x20 * 4 + 2 + 7)  # right after CLI
+           self.assertEqual(cpu.mem_read(0x11), 3)
+
+   def test_oam_dma_copies_page_and_stalls_cpu(self):
+       program = [0xa9, 0x42, 0x8d, 0x05, 0x02,  # LDA #$42; STA $0205
+                  0xa9, 0x02, 0x8d, 0x14, 0x40,  # LDA #$02; STA $4014
+                  0x00]
+       for cpu_class in self.cpus():
+           cpu = profiles.create(make_test_rom(program), cpu_class=cpu_class)
+           bus = cpu.bus
+           cpu.reset()
+           cpu.run()
+           self.assertEqual(bus.oam[5], 0x42)
+           self.assertEqual(bus.oam.count(0), 255)
+           self.assertEqual(cpu.cycles, 7 + 2 + 4 + 2 + 4 + 514)
+
+   def test_brk_enters_irq_vector_when_not_halting(self):
+       rom = interrupt_rom([0x00, 0xff, 0xe6, 0x10, 0x00], [0xe6, 0x11, 0x40])
+       for cpu_class in self.cpus():
+           running_class = type("Running" + cpu_class.__name__, (cpu_class,), {"halt_on_brk": False})
+           cpu = profiles.create(rom, cpu_class=running_class)
+           cpu.reset()
+           pushed = []
+           run_until(cpu, 40, lambda cpu: cpu.program_counter == 0x8700
+                     and pushed.append(cpu.mem_read(0x1fb)))
+           self.assertEqual(pushed[0] & 0b0011_0000, 0b0011_0000, cpu_class.__name__)
+           self.assertEqual(cpu.mem_read(0x10), 1)  # RTI resumed after the padding byte
+
+
+class TestDebugger(unittest.TestCase):
+
+   def cpus(self, rom):
+       classes = [cpu_module.PyCPU, cpu_module.LazyFlagsCPU]
+       if cpu_module.NATIVE_AVAILABLE:
+           classes.append(cpu_module.NativeCPU)
+       for cpu_class in classes:
+           cpu = profiles.create(rom, cpu_class=cpu_class)
+           cpu.reset()
+           yield cpu, debugger.Debugger(cpu)
+
+   def run_hits(self, cpu):
+       hits = []
+       while True:
+           try:
+               cpu.run()
+               return hits
+           except debugger.BreakpointHit as e:
+               hits.extend(e.hits)
+
+   def test_conditional_breakpoint_stops_before_instruction(self):
+       rom = make_test_rom([0xa2, 0x05, 0xca, 0xd0, 0xfd, 0x00])  # LDX #5; DEX; BNE; BRK
+       for cpu, dbg in self.cpus(rom):
+           dbg.break_at(0x8602, "x == 2")
+           with self.assertRaises(debugger.BreakpointHit) as raised:
+               cpu.run()
+           self.assertEqual(raised.exception.hits[0].kind, "break")
+           self.assertEqual((cpu.program_counter, cpu.register_x), (0x8602, 2))
+           self.assertEqual(self.run_hits(cpu), [])
+           self.assertEqual(cpu.register_x, 0)
+
+   def test_watchpoints_see_mirrors_and_conditions(self):
+       program = [0xa9, 0x07, 0x8d, 0x05, 0x08,  # LDA #7; STA $0805
+                  0xad, 0x05, 0x00,              # LDA $0005
+                  0xa9, 0x09, 0x85, 0x05,        # LDA #9; STA $05
+                  0x00]
+       for cpu, dbg in self.cpus(make_test_rom(program)):
+           dbg.watch(0x0005, on="w", condition="value > 8")
+           dbg.watch(0x0000, 0x00ff, on="r")
+           hits = self.run_hits(cpu)
+           self.assertEqual([(h.kind, h.addr, h.value, h.pc) for h in hits],
+                            [("read", 5, 7, 0x8605), ("write", 5, 9, 0x860a)],
+                            type(cpu).__name__)
+
+   def test_clearing_restores_uninstrumented_methods(self):
+       for cpu, dbg in self.cpus(make_test_rom([0xe6, 0x10, 0x00])):
+           cpu_class = type(cpu)
+           dbg.break_at(0x9000)
+           dbg.watch(0x0010)
+           self.assertIsNot(type(cpu), cpu_class)
+           self.assertIsNot(type(cpu.bus), Bus)
+           dbg.clear()
+           self.assertIs(type(cpu), cpu_class)
+           self.assertIs(type(cpu.bus), Bus)
+           cpu.run()
+           self.assertEqual(cpu.mem_read(0x10), 1)
+
+
+class TestRewind(unittest.TestCase):
+
+   def test_delta_round_trip(self):
+       rng = random.Random(34)
+       old = bytes(rng.randrange(0x100) for _ in range(2304))
+       new = bytearray(old)
+       for _ in range(20):
+           new[rng.randrange(len(new))] = rng.randrange(0x100)
+       delta = rewind.encode_delta(old, bytes(new))
+       self.assertLessEqual(len(delta), 20 * 5)  # 4 byte header per changed byte at most
+       self.assertEqual(rewind.apply_delta(bytes(new), delta), old)
+       self.assertEqual(rewind.encode_delta(old, old), b"")
+
+   def test_step_back_restores_each_captured_frame(self):
+       cpu = profiles.create(COUNTING_LOOP, "accurate")
+       cpu.reset()
+       cpu.events.schedule(250, events.NMI)
+       buffer = rewind.RewindBuffer(cpu, seconds=1, fps=10, keyframe_interval=4)
+       states = []
+       for frame in range(15):
+           run_until(cpu, 100 * (frame + 1))
+           cpu.bus.oam[frame] = frame
+           buffer.capture()
+           states.append(savestate.save(cpu))
+       self.assertEqual(len(buffer), 10)
+
+       for expected in reversed(states[5:-1]):
+           self.assertTrue(buffer.step_back())
+           self.assertEqual(savestate.save(cpu), expected)
+       self.assertFalse(buffer.step_back())
+
+       # Emulation continues from the restored frame, NMI still pending.
+       run_until(cpu, 300)
+       self.assertEqual(cpu.mem_read(0x11), 1)
+
+
+   def test_keyframes_bound_long_step_backs(self):
+       cpu = profiles.create(COUNTING_LOOP, "accurate")
+       cpu.reset()
+       buffer = rewind.RewindBuffer(cpu, seconds=10, fps=10, keyframe_interval=8)
+       states = []
+       for frame in range(60):
+           run_until(cpu, 100 * (frame + 1))
+           cpu.bus.oam[frame] = frame
+           buffer.capture()
+           states.append(savestate.save(cpu))
+
+       with mock.patch("rewind.apply_delta", wraps=rewind.apply_delta) as apply_delta:
+           self.assertTrue(buffer.step_back(45))
+       self.assertEqual(savestate.save(cpu), states[14])
+       self.assertLessEqual(apply_delta.call_count, 4)
+       self.assertTrue(buffer.step_back(3))
+       self.assertEqual(savestate.save(cpu), states[11])
+       self.assertFalse(buffer.step_back(12))
+
+   def test_loading_a_state_invalidates_idle_loop_tracking(self):
+       cpu = profiles.create(COUNTING_LOOP, cpu_class=cpu_module.FastCPU)
+       cpu.reset()
+       state = savestate.save(cpu)
+       cpu._idle_state = ("stale", 0)
+       savestate.load(cpu, state)
+       self.assertIsNone(cpu._idle_state)
+
+
+class TestExport(unittest.TestCase):
+
+   def test_png_bytes_structure(self):
+       rgb = bytes(range(4 * 3 * 3))  # 4x3 pixels
+       png = export.png_bytes(4, 3, rgb)
+       self.assertTrue(png.startswith(export.PNG_SIGNATURE))
+       length, tag, width, height = int.from_bytes(png[8:12], "big"), png[12:16], png[16:20], png[20:24]
+       self.assertEqual((length, tag), (13, b"IHDR"))
+       self.assertEqual((int.from_bytes(width, "big"), int.from_bytes(height, "big")), (4, 3))
+       idat = png.index(b"IDAT")
+       size = int.from_bytes(png[idat - 4:idat], "big")
+       raw = zlib.decompress(png[idat + 4:idat + 4 + size])
+       self.assertEqual(raw, b"".join(b"\x00" + rgb[y * 12:(y + 1) * 12] for y in range(3)))
+       self.assertTrue(png.endswith(export.png_chunk(b"IEND", b"")))
+
+   def test_raw_export_of_snake_screen(self):
+       program = [0xe8, 0x8a, 0x9d, 0x00, 0x02, 0x4c, 0x00, 0x86]  # INX; TXA; STA $0200,X; JMP
+       cpu = profiles.create(make_test_rom(program), "accurate")
+       cpu.reset()
+       with tempfile.TemporaryDirectory() as tmp:
+           path = os.path.join(tmp, "out.rgb")
+           exporter = export.FrameExporter(export.RawSink(path), scale=2)
+           self.assertEqual(export.export_frames(cpu, exporter, 3), 3)
+           exporter.close()
+           with open(path, "rb") as f:
+               data = f.read()
+       self.assertEqual((exporter.written, exporter.dropped), (3, 0))
+       frame_size = 64 * 64 * 3
+       self.assertEqual(len(data), 3 * frame_size)
+       last = data[2 * frame_size:]
+       # Pixel (1, 0) holds 1 (white), doubled in both directions.
+       self.assertEqual(last[2 * 3:4 * 3], bytes(screen_color(1)) * 2)
+       self.assertEqual(last[64 * 3 + 2 * 3:64 * 3 + 4 * 3], bytes(screen_color(1)) * 2)
+
+   def slow_sink(self, release):
+       class SlowSink:
+           def __init__(self):
+               self.frames = []
+
+           def write(self, frame):
+               release.wait()
+               self.frames.append(frame.index)
+
+           def close(self):
+               pass
+
+       return SlowSink()
+
+   def test_full_queue_waits_for_the_encoder(self):
+       release = threading.Event()
+       sink = self.slow_sink(release)
+       exporter = export.FrameExporter(sink, maxsize=1)
+       threading.Timer(0.05, release.set).start()
+       results = [exporter.submit(export.Frame(i, 1, 1, b"\0\0\0")) for i in range(5)]
+       exporter.close()
+       self.assertTrue(all(results))
+       self.assertEqual((exporter.written, exporter.dropped), (5, 0))
+       self.assertEqual(sink.frames, list(range(5)))
+
+   def test_full_queue_drops_when_asked(self):
+       release = threading.Event()
+       sink = self.slow_sink(release)
+       exporter = export.FrameExporter(sink, maxsize=1, drop=True)
+       results = [exporter.submit(export.Frame(i, 1, 1, b"\0\0\0")) for i in range(5)]
+       release.set()
+       exporter.close()
+       self.assertFalse(all(results))
+       self.assertEqual(exporter.dropped, results.count(False))
+       self.assertEqual(len(sink.frames), results.count(True))
+
+
+@unittest.skipIf(numpy is None, "NumPy not installed")
+class TestServer(unittest.TestCase):
+
+   def run_session(self, rom, body):
+       async def main():
+           emulation = server.EmulationServer(rom, fps=None)
+           listener = await emulation.start()
+           client = await server.Client.connect(port=listener.sockets[0].getsockname()[1])
+           try:
+               return await body(emulation, client)
+           finally:
+               await client.close()
+               await emulation.close()
+       return asyncio.run(main())
+
+   def test_frames_are_deltas_of_the_screen(self):
+       program = [0xa5, 0xff, 0x8d, 0x00, 0x02, 0x4c, 0x00, 0x86]  # LDA $ff; STA $0200; JMP
+
+       async def body(emulation, client):
+           first = await client.read_frame()
+           self.assertEqual((first.ack, first.flags, client.screen[0]), (0, 0, 0))
+           seq = client.send(server.KEY, 7)
+           update = await client.read_frame()
+           while update.ack < seq:
+               update = await client.read_frame()
+           self.assertEqual(client.screen[0], 7)
+           ram = emulation.sessions[0].cpu.bus.cpu_vram
+           self.assertEqual(client.screen, bytes(ram[0x0200:0x0600]))
+           self.assertEqual(emulation.sessions[0].screen, client.screen)
+
+       self.run_session(make_test_rom(program), body)
+
+   def test_game_over_and_reset(self):
+       with open("snake.nes", "rb") as f:
+           rom = Rom.new(f.read())
+
+       async def body(emulation, client):
+           update = await client.read_frame()
+           while not update.flags & server.HALTED:
+               update = await client.read_frame()
+           halted_frame = update.frame
+           seq = client.send(server.RESET)
+           update = await client.read_frame()
+           while update.ack < seq:
+               update = await client.read_frame()
+           self.assertEqual(update.frame, halted_frame + 1)
+           self.assertLess(emulation.sessions[0].cpu.cycles, cpu_module.CYCLES_PER_FRAME * 2)
+
+       self.run_session(rom, body)
+
+   def test_failing_session_halts_and_others_keep_running(self):
+       async def body(emulation, client):
+           other = await server.Client.connect(port=emulation._server.sockets[0].getsockname()[1])
+           try:
+               for c in (client, other):
+                   update = await c.read_frame()
+                   self.assertEqual(update.flags, server.HALTED | server.ERROR)
+               seq = client.send(server.RESET)
+               update = await client.read_frame()
+               while update.ack < seq:
+                   update = await client.read_frame()
+               self.assertEqual(update.flags, server.HALTED | server.ERROR)
+               self.assertFalse(emulation._scheduler.done())
+               self.assertEqual(len(emulation.sessions), 2)
+           finally:
+               await other.close()
+
+       with mock.patch("sys.stderr"):
+           self.run_session(make_test_rom([0x02]), body)  # unknown opcode
+
+   def test_halting_frame_is_sent_to_a_full_buffer(self):
+       class Transport:
+           def get_write_buffer_size(self):
+               return server.MAX_BUFFERED + 1
+
+       class Writer:
+           transport = Transport()
+
+           def __init__(self):
+               self.frames = []
+
+           def is_closing(self):
+               return False
+
+           def write(self, data):
+               self.frames.append(server.FRAME_HEADER.unpack(data[:server.FRAME_HEADER.size]))
+
+       writer = Writer()
+       session = server.Session(make_test_rom([0xea, 0x00]), writer, cpu_module.PyCPU)  # NOP; BRK
+       session.step()
+       self.assertEqual(session.skipped, 0)
+       self.assertEqual([flags for _, _, flags, _ in writer.frames], [server.HALTED])
+
+   def test_latency_measurement(self):
+       with open("snake.nes", "rb") as f:
+           rom = Rom.new(f.read())
+       latencies = asyncio.run(server.measure_latency(rom, sessions=3, frames=5, fps=None))
+       self.assertEqual(len(latencies), 15)
+       self.assertTrue(all(latency > 0 for latency in latencies))
+
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class TestEnv(unittest.TestCase):
+
+   def setUp(self):
+       with open("snake.nes", "rb") as f:
+           self.rom = Rom.new(f.read())
+
+   def test_observations_are_views_of_ram(self):
+       vec = env.VecEnv(self.rom, num_envs=3)
+       obs = vec.reset()
+       self.assertEqual(obs.shape, (3, 32, 32))
+       self.assertTrue(numpy.shares_memory(obs, vec.ram))
+       vec.cpus[1].mem_write(0x0200 + 32 + 2, 7)
+       self.assertEqual(obs[1, 1, 2], 7)
+       vec.close()
+
+   def test_step_runs_one_tick_and_resets_on_game_over(self):
+       vec = env.VecEnv(self.rom, num_envs=2)
+       vec.reset()
+       start = [cpu.cycles for cpu in vec.cpus]
+       _, rewards, dones, infos = vec.step([0, 0])
+       self.assertEqual(list(dones), [False, False])
+       for cpu, cycles in zip(vec.cpus, start):
+           self.assertGreaterEqual(cpu.cycles - cycles, env.SNAKE_TICK_CYCLES)
+       for _ in range(100):
+           _, rewards, dones, infos = vec.step([1, 0])  # up, into the wall
+           if dones[0]:
+               break
+       self.assertTrue(dones[0])
+       self.assertEqual(rewards[0], -1)
+       self.assertNotIn("truncated", infos[0])
+       self.assertEqual(infos[0]["terminal_observation"].shape, (32, 32))
+       self.assertEqual(vec.cpus[0].cycles, vec.start_state.registers[-1])
+       vec.close()
+
+   def test_truncation_after_max_steps(self):
+       vec = env.VecEnv(self.rom, num_envs=1, max_steps=2)
+       vec.reset()
+       self.assertFalse(vec.step([0])[2][0])
+       _, _, dones, infos = vec.step([0])
+       self.assertTrue(dones[0])
+       self.assertTrue(infos[0]["truncated"])
+       vec.close()
+
+   def test_shared_env_matches_in_process_env(self):
+       shared = env.SharedVecEnv(self.rom, num_envs=4, num_workers=2)
+       local = env.VecEnv(self.rom, num_envs=2)
+       try:
+           shared.reset()
+           local.reset()
+           rng = random.Random(5)
+           for _ in range(20):
+               actions = [rng.randrange(len(env.ACTIONS)) for _ in range(4)]
+               obs, rewards, dones, _ = shared.step(actions)
+               expected = local.step(actions[:2])
+               self.assertTrue((obs[:2] == expected[0]).all())
+               self.assertTrue((rewards[:2] == expected[1]).all())
+               self.assertTrue((dones[:2] == expected[2]).all())
+       finally:
+           shared.close()
+           local.close()
+
+
+class TestSharedRam(unittest.TestCase):
+
+   def setUp(self):
+       program = [0xe8, 0x8a, 0x9d, 0x00, 0x02, 0xe0, 0x10, 0xd0, 0xf7,  # INX; TXA; STA $0200,X; CPX #$10; BNE
+                  0xa9, 0x02, 0x8d, 0x14, 0x40, 0x00]                    # LDA #$02; STA $4014; BRK
+       self.cpu = profiles.create(make_test_rom(program), "fast", shared=True)
+       self.bus = self.cpu.bus
+       self.cpu.reset()
+       self.cpu.run()
+
+   def tearDown(self):
+       if isinstance(self.cpu, cpu_module.NativeCPU):
+           self.cpu.release_buffers()
+       self.bus.shared.close()
+
+   def test_ram_and_oam_live_in_the_block(self):
+       view = sharedram.SharedRam.attach(self.bus.shared.name)
+       try:
+           self.assertEqual(bytes(view.ram[0x0201:0x0211]), bytes(range(1, 17)))
+           self.assertEqual(bytes(view.oam), bytes(self.bus.cpu_vram[0x0200:0x0300]))
+           self.assertEqual(view.oam[1], 1)
+       finally:
+           view.close()
+
+   def test_other_process_reads_live_memory(self):
+       code = ("import sharedram; view = sharedram.SharedRam.attach(%r); "
+               "print(bytes(view.ram[0x0201:0x0211]).hex()); view.close()" % self.bus.shared.name)
+       for _ in range(2):  # the block must outlive the first reader
+           output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+           self.assertEqual(output.stdout.strip(), bytes(range(1, 17)).hex())
+           self.assertEqual(output.stderr, "")
+
+   def test_save_states_restore_in_place(self):
+       state = savestate.save(self.cpu)
+       ram = self.bus.cpu_vram
+       ram[0x0201] = 0xff
+       savestate.load(self.cpu, state)
+       self.assertIs(self.bus.cpu_vram, ram)
+       self.assertEqual(self.bus.shared.ram[0x0201], 1)
+
+
+class TestAccessStats(unittest.TestCase):
+
+   def test_counts_regions_pages_and_addresses(self):
+       program = [0xad, 0x05, 0x00,              # LDA $0005
+                  0x8d, 0x05, 0x08,              # STA $0805
+                  0xad, 0x00, 0x50,              # LDA $5000 (unmapped)
+                  0xa9, 0x03, 0x8d, 0x14, 0x40,  # LDA #3; STA $4014
+                  0x00]
+       classes = [cpu_module.PyCPU] + ([cpu_module.NativeCPU] if cpu_module.NATIVE_AVAILABLE else [])
+       for cpu_class in classes:
+           cpu = profiles.create(make_test_rom(program), cpu_class=cpu_class, stats=True)
+           bus = cpu.bus
+           cpu.reset()
+           with mock.patch("builtins.print"):
+               cpu.run()
+           regions = bus.stats.regions()
+           self.assertEqual(regions["ram"], (1 + 256, 0), cpu_class.__name__)
+           self.assertEqual(regions["ram mirrors"], (0, 1))
+           self.assertEqual(regions["oam dma"], (0, 1))
+           self.assertEqual(regions["unmapped"], (1, 0))
+           self.assertEqual(regions["prg rom"][0], 2 + 15)  # reset vector + program bytes
+           self.assertEqual(int(bus.stats.writes[0x0805]), 1)
+           self.assertEqual(int(bus.stats.page_reads()[0x03]), 256)
+           self.assertEqual(bus.stats.heatmap_rgb().shape, (256, 256, 3))
+
+   def test_default_bus_is_not_instrumented(self):
+       bus = Bus(make_test_rom())
+       self.assertIsNone(bus.stats)
+       self.assertIs(type(bus), Bus)
+       self.assertIs(type(Bus(make_test_rom(), stats=True)), CountingBus)
+
+
+def reference_flags(result, carry=False, overflow=False):
+    flags = CpuFlags(0)
+    if carry:
+        flags |= CpuFlags.CARRY
+    if result == 0:
+        flags |= CpuFlags.ZERO
+    if overflow:
+        flags |= CpuFlags.OVERFLOW
+    if result & 0x80:
+        flags |= CpuFlags.NEGATIVE
+    return int(flags)
+
+
+class TestAluTables(unittest.TestCase):
+
+   def test_adc_and_sbc_tables(self):
+       for carry in (0, 1):
+           for a in range(256):
+               for operand in range(256):
+                   index = carry << 16 | a << 8 | operand
+                   total = a + operand + carry
+                   result = total % 256
+                   overflow = (a < 0x80) == (operand < 0x80) and (a < 0x80) != (result < 0x80)
+                   self.assertEqual(alu.ADC[index], result | reference_flags(result, total > 255, overflow) << 8)
+
+                   difference = a - operand - (1 - carry)
+                   result = difference % 256
+                   signed = (a - 256 * (a >= 0x80)) - (operand - 256 * (operand >= 0x80)) - (1 - carry)
+                   overflow = not -128 <= signed <= 127
+                   self.assertEqual(alu.SBC[index], result | reference_flags(result, difference >= 0, overflow) << 8)
+
+   def test_compare_table(self):
+       for register in range(256):
+           for operand in range(256):
+               self.assertEqual(alu.CMP[register << 8 | operand],
+                                reference_flags((register - operand) % 256, register >= operand))
+
+   def test_shift_and_rotate_tables(self):
+       for carry in (0, 1):
+           for value in range(256):
+               index = carry << 8 | value
+               for table, result, carry_out in (
+                       (alu.ASL, value * 2 % 256, value >= 0x80),
+                       (alu.LSR, value // 2, value % 2),
+                       (alu.ROL, (value * 2 + carry) % 256, value >= 0x80),
+                       (alu.ROR, value // 2 + 0x80 * carry, value % 2)):
+                   self.assertEqual(table[index], result | reference_flags(result, carry_out) << 8)
+
+   def test_flag_masks_match_status_layout(self):
+       self.assertEqual(alu.ADC_FLAGS, int(CpuFlags.CARRY | CpuFlags.ZERO | CpuFlags.OVERFLOW | CpuFlags.NEGATIVE))
+       self.assertEqual(alu.CMP_FLAGS, int(CpuFlags.CARRY | CpuFlags.ZERO | CpuFlags.NEGATIVE))
+
+   def test_cached_tables_match_built_tables(self):
+       with tempfile.TemporaryDirectory() as tmp, mock.patch.object(cache, "CACHE_DIR", tmp):
+           built = alu.load_tables()
+           self.assertEqual(os.listdir(os.path.join(tmp, "alu")), [f"tables-{sys.byteorder}-v{alu.TABLES_CACHE_VERSION}.marshal"])
+           with mock.patch.object(alu, "build_tables", side_effect=AssertionError("rebuilt")):
+               cached = alu.load_tables()
+       self.assertEqual(cached, built)
+       for name in alu.TABLES:
+           self.assertEqual(cached[name], getattr(alu, name))
+
+   def test_core_import_is_lazy(self):
+       code = ("import sys, alu, cpu, bus, savestate, rewind, export, debugger; "
+               "print(sorted(set(alu.TABLES) & set(vars(alu))), "
+               "sorted(m for m in ('numpy', 'pygame', 'memstats', 'pickle') if m in sys.modules))")
+       output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+       self.assertEqual(output.strip(), "[] []")
+
+
+class TestDisassembler(unittest.TestCase):
+
+   def setUp(self):
+       with open("snake.nes", "rb") as f:
+           self.rom = Rom.new(f.read())
+       self.cfg = disasm.build_cfg(self.rom)
+
+   def test_follows_code_from_reset_vector(self):
+       self.assertEqual(self.cfg.entry_points["reset"], 0x8600)
+       entry = self.cfg.blocks[0x8600]
+       self.assertEqual(disasm.format_instruction(entry.instructions[0]), "8600  20 06 86  JSR $8606")
+       self.assertEqual(entry.calls, [0x8606])
+       self.assertEqual(entry.successors, [0x8603])
+
+   def test_blocks_split_at_branch_targets(self):
+       loop = self.cfg.block_at(0x8731)
+       self.assertEqual(loop.start, 0x872f)
+       self.assertEqual([ins.op.mnemonic for ins in loop.instructions],
+                        ["NOP", "NOP", "DEX", "BNE"])
+       self.assertEqual(sorted(loop.successors), [0x872f, 0x8734])
+       self.assertEqual(self.cfg.blocks[0x872d].successors, [0x872f])
+       self.assertIsNone(self.cfg.block_at(0x8736))  # padding after the final BRK
+
+   def test_call_and_return_edges(self):
+       self.assertIn((0x8600, 0x8606), self.cfg.call_edges)
+       self.assertIn((0x8606, 0x860d), self.cfg.call_edges)
+       self.assertIn((0x860c, 0x8603), self.cfg.return_edges)
+       self.assertIn(0x860c, self.cfg.functions[0x8606])
+
+   def test_bad_decodes_are_not_external_targets(self):
+       program = [0x4c, 0x10, 0x86] + [0x00] * 13 + [0x02]  # JMP $8610; ...; $8610: invalid opcode
+       cfg = disasm.build_cfg(make_test_rom(program))
+       self.assertEqual(cfg.invalid, {0x8610})
+       self.assertEqual(cfg.external, {0x0000})  # the NMI and IRQ vectors are zero
+       self.assertEqual(disasm.listing(cfg).splitlines()[-3:],
+                        ["; targets outside PRG ROM: $0000", "", "; bad decodes: $8610"])
+
+   def test_graph_is_cached_by_rom_hash(self):
+       with tempfile.TemporaryDirectory() as tmp, mock.patch.object(cache, "CACHE_DIR", tmp):
+           first = disasm.load_cfg(self.rom)
+           self.assertEqual(len(os.listdir(os.path.join(tmp, "cfg"))), 1)
+           with mock.patch.object(disasm, "build_cfg", side_effect=AssertionError):
+               second = disasm.load_cfg(self.rom)
+       self.assertEqual(sorted(first.blocks), sorted(second.blocks))
+       self.assertEqual(first.rom_hash, second.rom_hash)
+
+
+class TestCoverage(unittest.TestCase):
+
+   def setUp(self):
+       with open("snake.nes", "rb") as f:
+           self.rom = Rom.new(f.read())
+
+   def run_program(self, cpu_class):
+       # LDA #$01; BNE +2; (skipped LDX #$05); LDY #$00; BRK
+       rom = make_test_rom([0xa9, 0x01, 0xd0, 0x02, 0xa2, 0x05, 0xa0, 0x00, 0x00])
+       cpu = profiles.create(rom, cpu_class=cpu_class)
+       coverage = romcov.Coverage(rom)
+       coverage.attach(cpu)
+       cpu.reset()
+       cpu.run()
+       coverage.detach(cpu)
+       return coverage.bitmap[0x0600:0x0609]
+
+   def test_marks_opcodes_and_operands(self):
+       op, arg = romcov.OPCODE, romcov.OPERAND
+       classes = [cpu_module.PyCPU, cpu_module.InlineCPU] + [cpu_module.CPU] * cpu_module.NATIVE_AVAILABLE
+       for cpu_class in classes:
+           with self.subTest(cpu=cpu_class.__name__):
+               self.assertEqual(bytes(self.run_program(cpu_class)),
+                                bytes([op, arg, op, arg, 0, 0, op, arg, op]))
+
+   @unittest.skipUnless(cpu_module.NATIVE_AVAILABLE, "native core not built")
+   def test_native_and_python_cores_agree_on_snake(self):
+       native = romcov.run_snake(self.rom, 7, 300, cpu_module.NativeCPU)
+       self.assertEqual(romcov.run_snake(self.rom, 7, 300, cpu_module.PyCPU), native)
+       self.assertTrue(any(native))
+
+   def test_merge_and_annotated_listing(self):
+       coverage = romcov.Coverage(self.rom)
+       for seed in range(3):
+           coverage.merge(romcov.run_snake(self.rom, seed, 200))
+       single = romcov.Coverage(self.rom).merge(romcov.run_snake(self.rom, 0, 200))
+       self.assertTrue(all(a | b == a for a, b in zip(coverage.bitmap, single.bitmap)))
+       with tempfile.TemporaryDirectory() as tmp:
+           path = os.path.join(tmp, "snake.cov")
+           coverage.save(path)
+           self.assertEqual(romcov.Coverage.load(self.rom, path).bitmap, coverage.bitmap)
+
+       cfg = disasm.build_cfg(self.rom)
+       lines = romcov.report(cfg, coverage).splitlines()
+       self.assertIn("+ 8600  20 06 86  JSR $8606", lines)
+       self.assertIn("- 865F  60        RTS", lines)  # no key other than w/a/s/d is sent
+       hit, total = coverage.summary(cfg)
+       self.assertIn(f"; {hit}/{total} instructions executed ({hit / total:.1%})", lines)
+       self.assertEqual(coverage.outside(cfg), [])
+       self.assertEqual(disasm.listing(cfg).splitlines()[3], "  8600  20 06 86  JSR $8606")
+
+
+class TestRunHash(unittest.TestCase):
+
+   def setUp(self):
+       with open("snake.nes", "rb") as f:
+           self.rom = Rom.new(f.read())
+       self.movie = bytes([ord("w"), 3, ord("a"), 7, ord("s"), 1, 0, 9, 0, 5, 0, 5])
+
+   def signatures(self, movie, cpu_class=cpu_module.PyCPU, interval=None):
+       cpu = profiles.create(self.rom, cpu_class=cpu_class)
+       cpu.reset()
+       return runhash.signatures(cpu, movie, interval)
+
+   def test_cores_produce_identical_signatures(self):
+       expected = self.signatures(self.movie)
+       self.assertEqual(len(expected), 5)  # game over in the fifth frame
+       for cpu_class in (cpu_module.CPU, cpu_module.InlineCPU, cpu_module.LazyFlagsCPU):
+           with self.subTest(cpu=cpu_class.__name__):
+               self.assertEqual(self.signatures(self.movie, cpu_class), expected)
+               self.assertIsNone(runhash.first_divergence(self.signatures(self.movie, cpu_class), expected))
+
+   def test_first_divergent_checkpoint(self):
+       changed = bytearray(self.movie)
+       changed[3] = 8  # random byte of frame 1
+       a, b = self.signatures(self.movie), self.signatures(bytes(changed))
+       self.assertEqual(runhash.first_divergence(a, b), 1)
+       self.assertEqual(a[0], b[0])
+       self.assertEqual(runhash.first_divergence(a, a[:4]), 4)
+
+       interval = 5000
+       fine = self.signatures(self.movie, interval=interval)
+       per_frame = runhash.checkpoints_per_frame(interval)
+       self.assertEqual(per_frame, 6)
+       self.assertEqual(runhash.first_divergence(fine, self.signatures(bytes(changed), interval=interval))
+                        // per_frame, 1)
+
+   def test_trace_of_one_frame(self):
+       cpu = profiles.create(self.rom, "fast")
+       cpu.reset()
+       lines = runhash.trace_frame(cpu, self.movie, 0)
+       self.assertTrue(lines[0].startswith("8600 20 06 86  JSR $8606"))
+       self.assertGreater(len(lines), 1000)
+       self.assertTrue(any(line.startswith("8732 D0 FB     BNE $872F") for line in lines))
+       cpu = profiles.create(self.rom, "fast")
+       cpu.reset()
+       second = runhash.trace_frame(cpu, self.movie, 1)
+       self.assertNotEqual(second[0], lines[0])
+       self.assertGreater(cpu.cycles, cpu_module.CYCLES_PER_FRAME)
+
+
+def nes2_image(mapper, prg, chr_, submapper=0, prg_ram_shift=0):
+    header = bytearray(b"NES\x1a" + bytes(12))
+    header[4], header[5] = len(prg) // 0x4000, len(chr_) // 0x2000
+    header[6] = (mapper & 0x0f) << 4 | 0b1
+    header[7] = (mapper & 0xf0) | 0b1000
+    header[8] = submapper << 4 | mapper >> 8
+    header[10] = prg_ram_shift
+    return bytes(header) + prg + chr_
+
+
+class TestRomCatalog(unittest.TestCase):
+
+   def setUp(self):
+       self.tmp = tempfile.TemporaryDirectory()
+       self.addCleanup(self.tmp.cleanup)
+       self.roms = os.path.join(self.tmp.name, "roms")
+       os.makedirs(os.path.join(self.roms, "sub"))
+       with open("snake.nes", "rb") as f:
+           self.snake = f.read()
+       self.write("snake.nes", self.snake)
+       self.write("sub/mmc3.nes", nes2_image(0x104, bytes(0x8000), bytes(0x2000), submapper=1))
+       self.write("broken.nes", b"not a rom")
+       self.index = os.path.join(self.tmp.name, "index.pickle")
+
+   def write(self, name, data):
+       with open(os.path.join(self.roms, name), "wb") as f:
+           f.write(data)
+
+   def test_parses_nes2_header(self):
+       header = parse_header(nes2_image(0x104, bytes(0x8000), bytes(0x2000), submapper=1, prg_ram_shift=7))
+       self.assertTrue(header.nes2)
+       self.assertEqual((header.mapper, header.submapper), (0x104, 1))
+       self.assertEqual((header.prg_rom_size, header.chr_rom_size), (0x8000, 0x2000))
+       self.assertEqual(header.prg_ram_size, 8192)
+       self.assertEqual(header.screen_mirroring, Mirroring.VERTICAL)
+
+   def test_nes2_exponent_sizes(self):
+       raw = bytearray(nes2_image(0, b"", b""))
+       raw[4], raw[9] = (10 << 2) | 1, 0x0f  # 2^10 * 3 bytes of PRG ROM
+       self.assertEqual(parse_header(raw).prg_rom_size, 3072)
+
+   def test_scan_indexes_roms_by_content_hash(self):
+       catalog = romdb.RomCatalog(self.roms, self.index).scan()
+       self.assertEqual(catalog.parsed, 3)
+       self.assertEqual(len(catalog.entries), 2)
+       self.assertEqual(list(catalog.errors), [os.path.join(self.roms, "broken.nes")])
+       [snake] = catalog.supported()
+       self.assertEqual(snake.sha1, cache.content_hash(self.snake[16:]))
+       [mmc3] = catalog.find(mapper=0x104)
+       self.assertEqual(mmc3.header.submapper, 1)
+
+       rom = catalog.open(snake.sha1)
+       self.assertEqual(rom.prg_rom, Rom.new(self.snake).prg_rom)
+
+   def test_rescan_skips_unchanged_files(self):
+       romdb.RomCatalog(self.roms, self.index).scan()
+       with mock.patch.object(romdb, "parse_header", side_effect=AssertionError), \
+            mock.patch.object(Rom, "new", side_effect=AssertionError):
+           catalog = romdb.RomCatalog(self.roms, self.index).scan()
+           self.assertEqual(catalog.parsed, 0)
+           catalog.open(catalog.supported()[0].sha1)
+
+       self.write("sub/mmc3.nes", nes2_image(0, bytes(0x4000), bytes(0x2000)))
+       catalog = romdb.RomCatalog(self.roms, self.index).scan()
+       self.assertEqual(catalog.parsed, 1)
+       self.assertEqual(len(catalog.supported()), 2)
+
+   def test_copies_share_one_entry(self):
+       self.write("a-copy.nes", self.snake)
+       catalog = romdb.RomCatalog(self.roms, self.index).scan()
+       self.assertEqual(len(catalog.by_path), 3)
+       self.assertEqual(len(catalog.entries), 2)
+       [snake] = catalog.supported()
+       self.assertEqual(snake.path, os.path.join(self.roms, "a-copy.nes"))
+       self.assertEqual(catalog.scan().entries[snake.sha1], snake)
+
+
+class TestSingleStepVectors(unittest.TestCase):
+
+   def test_bundled_vectors(self):
+       for code in fuzz.bundled_opcodes():
+           for vector in fuzz.load_vectors(code):
+               with self.subTest(opcode=f"{code:02x}", vector=vector["name"]):
+                   self.assertEqual(fuzz.run_vector(vector), [])
+
+   @unittest.skipUnless(cpu_module.NATIVE_AVAILABLE, "native core not built")
+   def test_native_core_runs_vectors_through_the_flat_bus(self):
+       self.assertIs(fuzz.CPU_CLASSES["native"], cpu_module.NativeCPU)
+       for code in fuzz.bundled_opcodes():
+           for vector in fuzz.load_vectors(code)[:4]:
+               with self.subTest(opcode=f"{code:02x}", vector=vector["name"]):
+                   self.assertEqual(fuzz.run_vector(vector, cpu_module.NativeCPU), [])
+       checked, failures = fuzz.random_streams((1, 50, 16, "native"))
+       self.assertGreater(checked, 0)
+       self.assertEqual(failures, [])
+
+   def test_random_streams_match_reference(self):
+       checked, failures = fuzz.random_streams((1, 50, 16, "python"))
+       self.assertGreater(checked, 0)
+       self.assertEqual(failures, [])
+
+   def test_reference_takes_brk_vector(self):
+       memory = bytearray(0x10000)
+       memory[0xfffe:0x10000] = bytes([0x34, 0x12])
+       ref = fuzz.ReferenceCPU(memory, pc=0x8000, s=0xff, p=0x20)
+       ref.step()
+       self.assertEqual(ref.pc, 0x1234)
+       self.assertEqual(memory[0x1fd:0x200], bytes([0x30, 0x02, 0x80]))
 
 if __name__ == '__main__':
    unittest.main()
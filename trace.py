@@ -1,12 +1,10 @@
 from cpu import AddressingMode
 from cpu import CPU
-from opcodes import OpCode, CPU_OPS_CODES
+from opcodes import OPCODES_MAP
 
 def trace(cpu: CPU) -> str:
-    opcode = OpCode
-    opcodes = CPU_OPS_CODES
     code = cpu.mem_read(cpu.program_counter)
-    ops = opcode.get(code)
+    ops = OPCODES_MAP.get(code)
     if ops is None:
         raise ValueError(f"Unknown opcode {code}")
     begin = cpu.program_counter
@@ -41,7 +39,7 @@ def trace(cpu: CPU) -> str:
                 case AddressingMode.Indirect_Y:
                     tmp = f"(${address:02X}),Y = ${mem_addr - cpu.register_y:04X} @ ${mem_addr:04X} = {stored_value:02X}"
                 case AddressingMode.NoneAddressing:
-                    address = (begin + 2) + address
+                    address = (begin + 2 + (address ^ 0x80) - 0x80) & 0xFFFF
                     tmp = f"${address:04X}"
                 case _:
                     raise Exception(f"Unexpected addressing mode {ops.mode} has ops-len 2. code {ops.code:02X}")